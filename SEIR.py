@@ -6,6 +6,7 @@ Created on Sun Jun 21 23:48:32 2020
 @author: lamho
 """
 
+from concurrent.futures import ProcessPoolExecutor
 from scipy.integrate import odeint
 from scipy.optimize import curve_fit
 import numpy as np
@@ -27,35 +28,159 @@ def SEIR(y, t, N, logbeta, logkappa, loggamma):
                      kappa*y[1] - gamma*y[2], 
                      gamma*y[2]])
     
-def minimization(y0, t, C, N, niter = 1):
+def SEIR_jacobian(y, t, N, logbeta, logkappa, loggamma):
+    # d SEIR / d y, Dfun of odeint
+    beta, kappa, gamma = np.exp((logbeta, logkappa, loggamma))
+    return np.array([[-beta*y[2] / N, 0, -beta*y[0] / N, 0],
+                     [beta*y[2] / N, -kappa, beta*y[0] / N, 0],
+                     [0, kappa, -gamma, 0],
+                     [0, 0, gamma, 0]])
+
+def SEIR_sensitivity(z, t, N, beta, kappa, gamma):
+    # States y followed by their sensitivities s = d y / d (logbeta, logkappa, loggamma), a 4 x 3 matrix flattened.
+    # Forward sensitivity equations: d s / dt = J s + d SEIR / d params, written out since odeint calls it a lot.
+    # Takes the rates, not their logs, so they are computed once per solve
+    S, E, I, R, sS0, sS1, sS2, sE0, sE1, sE2, sI0, sI1, sI2, sR0, sR1, sR2 = z.tolist()
+    infection = beta*S*I / N
+    dinfection0 = beta*(I*sS0 + S*sI0) / N + infection
+    dinfection1 = beta*(I*sS1 + S*sI1) / N
+    dinfection2 = beta*(I*sS2 + S*sI2) / N
+    return np.array([-infection, infection - kappa*E, kappa*E - gamma*I, gamma*I,
+                     -dinfection0, -dinfection1, -dinfection2,
+                     dinfection0 - kappa*sE0, dinfection1 - kappa*(sE1 + E), dinfection2 - kappa*sE2,
+                     kappa*sE0 - gamma*sI0, kappa*(sE1 + E) - gamma*sI1, kappa*sE2 - gamma*(sI2 + I),
+                     gamma*sI0, gamma*sI1, gamma*(sI2 + I)])
+
+def SEIR_sensitivity_jacobian(z, t, N, beta, kappa, gamma):
+    # d SEIR_sensitivity / d z, Dfun of odeint for the sensitivity system
+    y, s = z[:4], z[4:].reshape(4, 3)
+    J = SEIR_jacobian(y, t, N, *np.log((beta, kappa, gamma)))
+    jac = np.zeros((16, 16))
+    jac[:4, :4] = J
+    jac[4:, 4:] = np.kron(J, np.eye(3))
+    # d (J s) / d y, only the infection terms of J depend on y
+    d_ds = np.zeros((4, 3, 4))
+    d_ds[0, :, 0] = -beta / N * s[2]
+    d_ds[0, :, 2] = -beta / N * s[0]
+    d_ds[1, :, 0] = beta / N * s[2]
+    d_ds[1, :, 2] = beta / N * s[0]
+    # d (d SEIR / d params) / d y
+    d_ds[0, 0, 0] -= beta*y[2] / N
+    d_ds[0, 0, 2] -= beta*y[0] / N
+    d_ds[1, 0, 0] += beta*y[2] / N
+    d_ds[1, 0, 2] += beta*y[0] / N
+    d_ds[1, 1, 1] -= kappa
+    d_ds[2, 1, 1] += kappa
+    d_ds[2, 2, 2] -= gamma
+    d_ds[3, 2, 2] += gamma
+    jac[4:, :4] = d_ds.reshape(12, 4)
+    return jac
+
+def solve_sensitivity(y0, t, N, logbeta, logkappa, loggamma):
+    # States and their sensitivities to the log parameters at each t, arrays len(t) x 4 and len(t) x 4 x 3
+    z0 = np.concatenate((np.asarray(y0, dtype=float), np.zeros(12)))
+    rates = tuple(np.exp((logbeta, logkappa, loggamma)).tolist())
+    out = odeint(SEIR_sensitivity, z0, t, args=(N,) + rates, Dfun=SEIR_sensitivity_jacobian)
+    return out[:, :4], out[:, 4:].reshape(-1, 4, 3)
+
+def fit_start(y0, t, C, N, p0):
+    # One local fit from p0, (popt, sum of squared residuals) or None when curve_fit fails
     
+    # curve_fit asks for the values then the Jacobian at the same parameters, one solve gives both
+    last = {}
+    def solve(params):
+        if last.get('params') != params:
+            last['params'] = params
+            last['states'], last['sensitivities'] = solve_sensitivity(y0, t, N, *params)
+        return last['states'], last['sensitivities']
+
     def fit_odeint(t, logbeta, logkappa, loggamma):
-        out_odeint = odeint(SEIR, y0, t, args=(N, logbeta, logkappa, loggamma))
-        return out_odeint[:,2]+out_odeint[:,3]
-    
+        states, _ = solve((logbeta, logkappa, loggamma))
+        return states[:,2]+states[:,3]
+
+    def fit_jacobian(t, logbeta, logkappa, loggamma):
+        _, sensitivities = solve((logbeta, logkappa, loggamma))
+        return sensitivities[:,2]+sensitivities[:,3]
+
+    try:
+        popt, pcov = curve_fit(fit_odeint, t, C, p0=p0, method='lm', jac=fit_jacobian, maxfev=5000)
+    except RuntimeError:
+        print("Error - curve_fit failed")
+        return None
+    fitted = fit_odeint(t, *popt)
+    value = np.sum((fitted - C)**2)
+    #value = mape(C,fitted)
+    return popt, value
+
+def get_start(seed):
+    # Random initial (logbeta, logkappa, loggamma) of one restart
+    rng = np.random.default_rng(seed)
+    return np.asarray([1 * rng.standard_normal() + 1,
+                       1 * rng.standard_normal(),
+                       0.1 * rng.standard_normal()+-0.1])
+
+def minimization(y0, t, C, N, niter = 1, seed = None, n_jobs = 1, tol = None, n_agree = 3, p0 = None):
+    # niter restarts, each from its own seed spawned from seed, on n_jobs processes (None for all CPUs).
+    # The best fit is chosen in restart order so the result only depends on seed.
+    # With tol, stop once n_agree restarts reach a sum of squares within relative tol of the best one.
+    # p0 (logbeta, logkappa, loggamma), e.g. the previous fit, is tried first as a warm start
+    starts = [get_start(child) for child in np.random.SeedSequence(seed).spawn(niter)]
+    if p0 is not None:
+        starts = [np.asarray(p0, dtype=float)] + starts
     best = np.inf
     res = (0, 0, 0)
-    for i in range(niter):
-        init_logbeta = 0.5 * np.random.randn() + 1
-        init_logkappa = 0.5 * np.random.randn()
-        init_loggamma = 0.5 * np.random.randn()
-        init_logbeta = 1 * np.random.randn() + 1
-        init_logkappa = 1 * np.random.randn()
-        init_loggamma = 0.1 * np.random.randn()+-0.1
-        try:
-            popt, pcov = curve_fit(fit_odeint, t, C,
-                                   p0=np.asarray([init_logbeta,init_logkappa,init_loggamma]), method='lm',
-                                   maxfev=5000)
-        except RuntimeError:
-            print("Error - curve_fit failed")
-            continue
-        fitted = fit_odeint(t, *popt)
-        value = np.sum((fitted - C)**2)
-        #value = mape(C,fitted)
-        if (value < best): 
-            res = popt
-            best = value
+    values = []
+    executor = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs != 1 else None
+    try:
+        if executor is None:
+            fits = (fit_start(y0, t, C, N, p0) for p0 in starts)
+        else:
+            futures = [executor.submit(fit_start, y0, t, C, N, p0) for p0 in starts]
+            fits = (future.result() for future in futures)
+        for fit in fits:
+            if fit is None:
+                continue
+            popt, value = fit
+            values.append(value)
+            if (value < best): 
+                res = popt
+                best = value
+            if tol is not None and sum(v <= best*(1+tol) for v in values) >= n_agree:
+                break
+    finally:
+        if executor is not None:
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
     return (res, best)
 
 def dynamics(y0, t, N, logbeta, logkappa, loggamma):
-    return odeint(SEIR, y0, t, args=(N, logbeta, logkappa, loggamma))
\ No newline at end of file
+    return odeint(SEIR, y0, t, args=(N, logbeta, logkappa, loggamma), Dfun=SEIR_jacobian)
+
+def SEIR_ensemble(S, E, I, R, N, beta, kappa, gamma):
+    # SEIR of every member at once, each argument an array over members
+    infection = beta*S*I / N
+    return -infection, infection - kappa*E, kappa*E - gamma*I, gamma*I
+
+def dynamics_ensemble(y0, t, N, logbeta, logkappa, loggamma, max_step = 0.25):
+    # dynamics of many parameter sets at once with fixed step RK4, steps of at most max_step between each t.
+    # y0: 4 states or array members x 4, N: number or array of members, log parameters: arrays of members.
+    # Returns array members x len(t) x 4. RK4 is not stable for very fast rates, keep max_step*rate small
+    logbeta, logkappa, loggamma = np.broadcast_arrays(*np.atleast_1d(logbeta, logkappa, loggamma))
+    beta, kappa, gamma = np.exp((logbeta, logkappa, loggamma))
+    n = len(beta)
+    N = np.broadcast_to(np.asarray(N, dtype=float), (n,))
+    y = np.array(np.broadcast_to(np.asarray(y0, dtype=float), (n, 4))).T
+    out = np.empty((len(t), 4, n))
+    out[0] = y
+    for i in range(1, len(t)):
+        n_steps = max(int(np.ceil((t[i] - t[i-1]) / max_step)), 1)
+        h = (t[i] - t[i-1]) / n_steps
+        for _ in range(n_steps):
+            k1 = SEIR_ensemble(*y, N, beta, kappa, gamma)
+            k2 = SEIR_ensemble(*(y + h/2*np.array(k1)), N, beta, kappa, gamma)
+            k3 = SEIR_ensemble(*(y + h/2*np.array(k2)), N, beta, kappa, gamma)
+            k4 = SEIR_ensemble(*(y + h*np.array(k3)), N, beta, kappa, gamma)
+            y = y + h/6*(np.array(k1) + 2*np.array(k2) + 2*np.array(k3) + np.array(k4))
+        out[i] = y
+    return out.transpose(2, 0, 1)
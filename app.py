@@ -1,13 +1,13 @@
 import streamlit as st
 import datetime as dt
-from pandas import date_range, to_datetime
-import numpy as np
+import time
+from pandas import date_range
+from pandas.util import hash_pandas_object
 import model_utils as mu
-import plotly.graph_objects as go
-import plotly.offline as py_offline
-import cufflinks as cf
-cf.go_offline()
-py_offline.__PLOTLY_OFFLINE_INITIALIZED = True
+import plot_utils as pu
+import forecast_runner as fr
+import forecast_store as fs
+import tracing
 
 mu.DEATH_RATE = 0.36
 mu.ICU_RATE = 0.78
@@ -34,164 +34,128 @@ st.markdown('COVID-19:  Dự báo cho 2 tháng tới. '
             ' Cần bao nhiêu giường bệnh hoặc ICU?')
 
 
-def main(scope, local, local_sub_level, policy_change_dates, forecast_horizon, forecast_fun, debug_fun, metrics, show_debug,
-         show_data, back_test, last_data_date, use_vaccine_data):
-    data_load_state = st.text('Forecasting...')
-    try:
-        daily, cumulative, model_beta = forecast_fun(local, local_sub_level,
-                                                     scope=scope,
-                                                     forecast_horizon=forecast_horizon,
-                                                     policy_change_dates=policy_change_dates,
-                                                     back_test=back_test, last_data_date=last_data_date,
-                                                     use_vaccine_data=use_vaccine_data)
-
-    except ValueError as e:
-        st.error('Chưa đủ số liệu về tử vong để dự báo. Kiểm tra lại thông tin đầu vào và ngày giãn cách')
-        mu.append_row_2_logs([dt.datetime.today(), scope, local, local_sub_level, policy_change_dates, forecast_horizon,
-                              last_data_date, e], 'logs/app_errors.log')
-        return None
-    except IndexError as e:
-        st.error('Code có lỗi. Báo ngay cho tác giả!')
-        mu.append_row_2_logs([dt.datetime.today(), scope, local, local_sub_level, policy_change_dates, forecast_horizon,
-                              last_data_date, e], 'logs/app_errors.log')
-        return None
+DEFAULT_FORECAST_HORIZON = 60
+STAGE_TEXT = {None: 'Forecasting...',
+              'fetch': 'Đang tải dữ liệu..',
+              'fit': 'Đang khớp mô hình..',
+              'derive': 'Đang tính các chỉ số..',
+              'plot': 'Đang vẽ đồ thị..'}
+
+
+def get_forecast_job_key(forecast_fun, scope, local, local_sub_level, policy_change_dates, forecast_horizon,
+                         back_test, last_data_date, use_vaccine_data, engine):
+    """Every input of a forecast run, used to share identical runs and to cancel stale ones"""
+    return (forecast_fun.__name__, scope, local, local_sub_level, tuple(policy_change_dates), forecast_horizon,
+            back_test, last_data_date, use_vaccine_data, engine,
+            mu.DEATH_RATE, mu.ICU_RATE, mu.HOSPITAL_RATE, mu.SYMPTOM_RATE, mu.INFECT_2_HOSPITAL_TIME,
+            mu.HOSPITAL_2_ICU_TIME, mu.ICU_2_DEATH_TIME, mu.ICU_2_RECOVER_TIME, mu.NOT_ICU_DISCHARGE_TIME)
+
+
+def style_metrics_figure(fig):
+    """Forecast metrics are dotted, observed data solid"""
+    fig.update_traces(line=dict(dash='dot'))
+    for observe_ln in ['death', 'confirmed']:
+        fig.update_traces(
+            line=dict(dash='solid'),
+            selector=dict(name=observe_ln)
+        )
+    return fig
 
-    data_load_state.text('Đang dự báo.. Hoàn thành!')
+
+def is_default_request(scope, local, policy_change_dates, forecast_horizon, back_test, use_vaccine_data, engine):
+    """Forecasts with default settings are precomputed every night by precompute.py"""
+    return not back_test and forecast_horizon == DEFAULT_FORECAST_HORIZON and engine == 'piecewise' and \
+        use_vaccine_data == (scope != 'VN') and mu.get_params() == mu.DEFAULT_PARAMS[scope] and \
+        sorted(policy_change_dates) == mu.get_default_policy_change_dates(scope, local)
+
+
+def main(scope, local, local_sub_level, policy_change_dates, forecast_horizon, forecast_fun, debug_fun, metrics, show_debug,
+         show_data, back_test, last_data_date, use_vaccine_data, engine):
+    data_load_state = st.text(STAGE_TEXT[None])
+    progress_bar = st.progress(0)
+    stored = None
+    if is_default_request(scope, local, policy_change_dates, forecast_horizon, back_test, use_vaccine_data, engine):
+        with tracing.span('load_stored'):
+            stored = fs.load_forecast(scope, local, local_sub_level)
+    if stored is not None:
+        daily, cumulative, model_beta = stored
+    else:
+        job_key = get_forecast_job_key(forecast_fun, scope, local, local_sub_level, policy_change_dates,
+                                       forecast_horizon, back_test, last_data_date, use_vaccine_data, engine)
+        job = st.session_state.get('forecast_job')
+        if job is None or job.key != job_key or job.cancelled:
+            job = fr.submit_forecast(job_key, forecast_fun, local, local_sub_level,
+                                     scope=scope,
+                                     forecast_horizon=forecast_horizon,
+                                     policy_change_dates=policy_change_dates,
+                                     back_test=back_test, last_data_date=last_data_date,
+                                     use_vaccine_data=use_vaccine_data, engine=engine)
+            st.session_state['forecast_job'] = job
+        with tracing.span('wait_forecast'):
+            while not job.done():
+                data_load_state.text(STAGE_TEXT[job.stage])
+                progress_bar.progress(job.progress)
+                time.sleep(0.1)
+        try:
+            daily, cumulative, model_beta = job.result()
+        except (mu.ForecastCancelled, fr.CancelledError):
+            return None
+        except ValueError as e:
+            st.error('Chưa đủ số liệu về tử vong để dự báo. Kiểm tra lại thông tin đầu vào và ngày giãn cách')
+            mu.append_row_2_logs([dt.datetime.today(), scope, local, local_sub_level, policy_change_dates,
+                                  forecast_horizon, last_data_date, e], 'logs/app_errors.log')
+            return None
+        except IndexError as e:
+            st.error('Code có lỗi. Báo ngay cho tác giả!')
+            mu.append_row_2_logs([dt.datetime.today(), scope, local, local_sub_level, policy_change_dates,
+                                  forecast_horizon, last_data_date, e], 'logs/app_errors.log')
+            return None
+
+    data_load_state.text(STAGE_TEXT['plot'])
+    progress_bar.progress(1.)
+
+    # Same forecast result and display options give the same figures, whichever session asks for them
+    figure_key = (int(hash_pandas_object(daily).sum()), scope, local, local_sub_level, tuple(metrics),
+                  back_test and last_data_date)
+    backtest_date = last_data_date if back_test else None
 
     st.subheader('Số tử vong')
-    show_metrics = ['death', 'predicted_death', '7d_avg_death']
-    fig = daily[show_metrics].rename(columns={'death': 'công bố',
-                                              'predicted_death': 'dự báo',
-                                              '7d_avg_death': 'trung bình 7 ngày'})\
-        .drop(columns=['ICU', 'hospital_beds'], errors='ignore').iplot(asFigure=True)
-    x = daily.index
-    y_upper = daily.upper_bound.values
-    y_lower = daily.lower_bound.values
-
-    fig.add_trace(go.Scatter(
-        x=x,
-        y=y_upper,
-        fill=None,
-        line_color='rgba(128,128,128,0)',
-        legendgroup='Confidence Interval',
-        showlegend=True,
-        name='Cận trên'))
-
-    fig.add_trace(go.Scatter(
-        x=x,
-        y=y_lower,
-        fill='tonexty',
-        fillcolor='rgba(66, 164, 245,0.1)',
-        line_color='rgba(128,128,128,0)',
-        showlegend=True,
-        legendgroup='Confidence Interval',
-        name='Cận dưới'
-    ))
-    if back_test:
-        max_y = np.nanmax(y_upper)
-        fig.add_trace(go.Scatter(
-            x=[last_data_date,last_data_date],
-            y=[0, max_y],
-            opacity=0.5,
-            line_color='grey',
-            mode='lines',
-            hovertext=str(last_data_date),
-            hoverinfo="x+name",
-            name='Dùng dữ liệu đến ngày'
-        ))
-    fig.update_layout(
+    fig = pu.figure_cache.get(('daily_death',) + figure_key, lambda: pu.forecast_figure(
+        daily, ['death', 'predicted_death', '7d_avg_death'],
+        names={'death': 'công bố', 'predicted_death': 'dự báo', '7d_avg_death': 'trung bình 7 ngày'},
+        bounds=('lower_bound', 'upper_bound'), last_data_date=backtest_date).update_layout(
         title="Covid19 Số Hàng Ngày " + local + ", " + local_sub_level,
         yaxis_title="Tử vong",
         hovermode='x',
         legend_title='<b> Tử vong </b>',
-    )
+    ))
     st.plotly_chart(fig)
 
-    show_metrics = ['death', 'predicted_death']
-    fig = cumulative[show_metrics].rename(columns={'death': 'công bố',
-                                                   'predicted_death': 'dự báo'})\
-        .iplot(asFigure=True)
-    x = cumulative.index
-    y_upper = cumulative.upper_bound.values
-    y_lower = cumulative.lower_bound.values
-    fig.add_trace(go.Scatter(
-        x=x,
-        y=y_upper,
-        fill=None,
-        line_color='rgba(128,128,128,0)',
-        legendgroup = 'CI',
-        name='Cận trên'))
-
-    fig.add_trace(go.Scatter(
-        x=x,
-        y=y_lower,
-        fill='tonexty',
-        fillcolor='rgba(66, 164, 245,0.1)',
-        line_color='rgba(128,128,128,0)',
-        legendgroup='CI',
-        name='Cận dưới'
-    ))
-    if back_test:
-        max_y = np.nanmax(y_upper)
-        fig.add_trace(go.Scatter(
-            x=[last_data_date,last_data_date],
-            y=[0, max_y],
-            opacity=0.5,
-            line_color='grey',
-            mode='lines',
-            hovertext=str(last_data_date),
-            hoverinfo="x+name",
-            name='Ngày dữ liệu cuối'
-        ))
-
-    fig.update_layout(
+    fig = pu.figure_cache.get(('cumulative_death',) + figure_key, lambda: pu.forecast_figure(
+        cumulative, ['death', 'predicted_death'],
+        names={'death': 'công bố', 'predicted_death': 'dự báo'},
+        bounds=('lower_bound', 'upper_bound'), last_data_date=backtest_date,
+        last_data_name='Ngày dữ liệu cuối').update_layout(
         title="Covid19 Tích lũy " + local + ", " + local_sub_level,
         yaxis_title="Tử vong",
         hovermode='x',
         legend_title='<b> Tử vong </b>'
-    )
-
+    ))
     st.plotly_chart(fig)
 
     if show_debug:
-        log_fit, _ = debug_fun(local, local_sub_level, scope=scope, forecast_horizon=forecast_horizon, policy_change_dates=policy_change_dates,
-                               back_test=back_test, last_data_date=last_data_date)
-        fig = log_fit.rename(columns={'death': 'trung bình 7 ngày' , 'orig_death': 'công bố', 'predicted_death': 'dự báo'})\
-            .drop(columns=['lower_bound', 'upper_bound', 'time_idx'], errors='ignore').iplot(asFigure=True)
-        x = log_fit.index
-        y_upper = log_fit.upper_bound.values
-        y_lower = log_fit.lower_bound.values
-        fig.add_trace(go.Scatter(
-            x=x,
-            y=y_upper,
-            fill=None,
-            line_color='rgba(128,128,128,0)',
-            legendgroup='CI',
-            name='Cận trên'))
-
-        fig.add_trace(go.Scatter(
-            x=x,
-            y=y_lower,
-            fill='tonexty',
-            fillcolor='rgba(66, 164, 245,0.1)',
-            line_color='rgba(128,128,128,0)',
-            legendgroup='CI',
-            name='Cận dưới'
-        ))
-        if back_test:
-            max_y = np.nanmax(y_upper)
-            fig.add_trace(go.Scatter(
-                x=[last_data_date, last_data_date],
-                y=[0, max_y],
-                opacity=0.5,
-                line_color='grey',
-                mode='lines',
-                hovertext=str(last_data_date),
-                hoverinfo="x+name",
-                name='Dùng dữ liệu đến ngày'
-            ))
+        with tracing.span('debug_fit'):
+            log_fit, _ = debug_fun(local, local_sub_level, scope=scope, forecast_horizon=forecast_horizon,
+                                   policy_change_dates=policy_change_dates, back_test=back_test,
+                                   last_data_date=last_data_date)
+        # The log fit is the piecewise linear model, say so when the forecast comes from another engine
+        fit_name = '' if engine == 'piecewise' else ' (mô hình tuyến tính từng đoạn)'
+        fig = pu.forecast_figure(
+            log_fit, ['orig_death', 'predicted_death', 'death'],
+            names={'death': 'trung bình 7 ngày', 'orig_death': 'công bố', 'predicted_death': 'dự báo' + fit_name},
+            bounds=('lower_bound', 'upper_bound'), last_data_date=backtest_date)
         fig.update_layout(
-            title="Đường logarithm của số ca tử vong hàng ngày",
+            title="Đường logarithm của số ca tử vong hàng ngày" + fit_name,
             yaxis_title="Logarithm của số ca tử vong hàng ngày",
             hovermode='x',
             legend_title='<b> Tử vong </b>',
@@ -201,145 +165,60 @@ def main(scope, local, local_sub_level, policy_change_dates, forecast_horizon, f
     st.subheader('Dự báo số ca và các nguồn lực y tế thiết yếu')
     st.markdown('Do hệ thống y tế ở các địa phương khác nhau, nếu dùng các chỉ số này để lập kế hoạch, '
                 'cần kiểm tra hộp thông số nâng cao để cập nhật các thông số tương ứng. ')
-    fig = daily.rename(columns={'ICU': 'Số bệnh nhân ở ICU', 'hospital_beds': 'số bệnh nhân nằm viện'})\
-        .drop(columns=['lower_bound', 'upper_bound', '7d_avg_death'], errors='ignore').iplot(asFigure=True)
-    x = daily.index
-    y_upper = daily.upper_bound.values
-    y_lower = daily.lower_bound.values
-    # fig.add_trace(go.Scatter(
-    #     x=x,
-    #     y=y_upper,
-    #     fill=None,
-    #     line_color='rgba(128,128,128,0)',
-    #     showlegend=False,
-    #     name='Upper Bound'))
-    #
-    # fig.add_trace(go.Scatter(
-    #     x=x,
-    #     y=y_lower,
-    #     fill='tonexty',
-    #     fillcolor='rgba(128,128,128,0.1)',
-    #     line_color='rgba(128,128,128,0)',
-    #     showlegend=False,
-    #     name='Lower Bound'
-    # ))
-    for invisible in metrics:
-        fig.update_traces(
-            visible='legendonly',
-            selector=dict(name=invisible)
-        )
-    fig.update_traces(line=dict(dash='dot'))
-    for observe_ln in ['death', 'confirmed']:
-        fig.update_traces(
-            line=dict(dash='solid'),
-            selector=dict(name=observe_ln)
-        )
-    fig.update_traces(
-        line=dict(color='teal'),
-        selector=dict(name='confirmed'))
-    if back_test:
-        max_y = np.nanmax(y_upper)
-        fig.add_trace(go.Scatter(
-            x=[last_data_date,last_data_date],
-            y=[0, max_y],
-            opacity=0.5,
-            line_color='grey',
-            mode='lines',
-            hovertext=str(last_data_date),
-            hoverinfo="x+name",
-            name='Dùng dữ liệu đến ngày'
-        ))
-    if scope == 'US' and local_sub_level == 'All':
-        hospital_cap = mu.get_US_State_hospital_cap_data()
-        try:
-            fig.add_trace(go.Scatter(
-                x=x,
-                y=[hospital_cap.loc[local].Total_Hospital_Beds]*len(x),
-                mode='lines',
-                visible='legendonly',
-                name='total hospital beds capacity'
-            ))
-            fig.add_trace(go.Scatter(
-                x=x,
-                y=[hospital_cap.loc[local].Total_ICU_Beds] * len(x),
-                mode='lines',
-                visible='legendonly',
-                name='total ICU beds capacity'
-            ))
-        except KeyError:
-            pass
-    fig.update_layout(
-        title="Covid19 Hàng Ngày " + local + ", " + local_sub_level,
-        hovermode='x',
-        legend_title='<b> Số ... </b>',
-    )
-
-    st.plotly_chart(fig)
 
-    fig = cumulative.drop(columns=['lower_bound', 'upper_bound', '7d_avg_death'], errors='ignore').iplot(asFigure=True)
-    x = cumulative.index
-    y_upper = cumulative.upper_bound.values
-    y_lower = cumulative.lower_bound.values
-    # fig.add_trace(go.Scatter(
-    #     x=x,
-    #     y=y_upper,
-    #     fill=None,
-    #     line_color='rgba(128,128,128,0)',
-    #     showlegend=False,
-    #     name='Upper Bound'))
-    #
-    # fig.add_trace(go.Scatter(
-    #     x=x,
-    #     y=y_lower,
-    #     fill='tonexty',
-    #     fillcolor='rgba(128,128,128,0.1)',
-    #     line_color='rgba(128,128,128,0)',
-    #     showlegend=False,
-    #     name='Lower Bound'
-    # ))
-    for invisible in metrics:
+    def build_daily_metrics_figure():
+        fig = pu.forecast_figure(
+            daily, [column for column in daily.columns if column not in ('lower_bound', 'upper_bound', '7d_avg_death')],
+            names={'ICU': 'Số bệnh nhân ở ICU', 'hospital_beds': 'số bệnh nhân nằm viện'},
+            hidden=metrics, last_data_date=backtest_date)
+        style_metrics_figure(fig)
         fig.update_traces(
-            visible='legendonly',
-            selector=dict(name=invisible)
+            line=dict(color='teal'),
+            selector=dict(name='confirmed'))
+        if scope == 'US' and local_sub_level == 'All':
+            hospital_cap = mu.get_US_State_hospital_cap_data()
+            try:
+                pu.add_constant_line(fig, daily.index, hospital_cap.loc[local].Total_Hospital_Beds,
+                                     'total hospital beds capacity')
+                pu.add_constant_line(fig, daily.index, hospital_cap.loc[local].Total_ICU_Beds,
+                                     'total ICU beds capacity')
+            except KeyError:
+                pass
+        return fig.update_layout(
+            title="Covid19 Hàng Ngày " + local + ", " + local_sub_level,
+            hovermode='x',
+            legend_title='<b> Số ... </b>',
         )
-    fig.update_traces(line=dict(dash='dot'))
-    for observe_ln in ['death', 'confirmed']:
-        fig.update_traces(
-            line=dict(dash='solid'),
-            selector=dict(name=observe_ln)
+    st.plotly_chart(pu.figure_cache.get(('daily_metrics',) + figure_key, build_daily_metrics_figure))
+
+    def build_cumulative_metrics_figure():
+        fig = pu.forecast_figure(
+            cumulative,
+            [column for column in cumulative.columns if column not in ('lower_bound', 'upper_bound', '7d_avg_death')],
+            hidden=metrics, last_data_date=backtest_date)
+        style_metrics_figure(fig)
+        return fig.update_layout(
+            title="Covid19 Tích lũy " + local + ", " + local_sub_level,
+            hovermode='x',
+            legend_title='<b> Số ... </b>',
         )
-    if back_test:
-        max_y = np.nanmax(y_upper)
-        fig.add_trace(go.Scatter(
-            x=[last_data_date, last_data_date],
-            y=[0, max_y],
-            opacity=0.5,
-            line_color='grey',
-            mode='lines',
-            hovertext=str(last_data_date),
-            hoverinfo="x+name",
-            name='Dùng dữ liệu đến ngày'
-        ))
-
-    fig.update_layout(
-        title="Covid19 Tích lũy " + local + ", " + local_sub_level,
-        hovermode='x',
-        legend_title='<b> Số ... </b>',
-    )
-
-    st.plotly_chart(fig)
+    st.plotly_chart(pu.figure_cache.get(('cumulative_metrics',) + figure_key, build_cumulative_metrics_figure))
 
+    # Keep the last forecast so the export files are only built when the user asks for them
+    st.session_state['export_tables'] = {
+        'daily_' + local + '_' + local_sub_level + '_' + str(dt.date.today()): daily,
+        'cumulative_' + local + '_' + local_sub_level + '_' + str(dt.date.today()): cumulative,
+    }
     if show_data:
         st.subheader('Dữ liệu xuất')
-        st.markdown(mu.get_table_download_link(daily,
-                    filename='daily_'+local+'_'+local_sub_level+'_'+str(dt.date.today())+'.csv'),
-                    unsafe_allow_html=True)
         st.write('Hàng ngày', daily)
-        st.markdown(mu.get_table_download_link(cumulative,
-                    filename='cumulative_' + local + '_'+local_sub_level+'_' + str(dt.date.today()) + '.csv'),
-                    unsafe_allow_html=True)
         st.write('Tích lũy', cumulative)
-    mu.append_row_2_logs([dt.datetime.today(), scope, local, model_beta], 'logs/fitted_models.csv')
+    data_load_state.text('Đang dự báo.. Hoàn thành!')
+    progress_bar.empty()
+    if engine == 'ensemble':
+        # One flat row, the parameters of each engine in the order of ENSEMBLE_ENGINES
+        model_beta = [value for name in mu.ENSEMBLE_ENGINES for value in model_beta[name]]
+    mu.append_row_2_logs([dt.datetime.today(), scope, local, model_beta, engine], 'logs/fitted_models.csv')
 
 
 run_click = st.sidebar.button('Click to run')
@@ -353,7 +232,6 @@ if scope == 'World':
                                                         .format(local)).State.dropna().unique().tolist(), index=0)
     forecast_fun = mu.get_metrics_by_country
     debug_fun = mu.get_log_daily_predicted_death_by_country
-    policy_date_fun = mu.get_policy_change_dates_by_country
 elif scope == 'US':
     #data_load_state = st.text('Loading data...')
     death_data = mu.get_data(scope=scope, type='deaths')
@@ -364,7 +242,6 @@ elif scope == 'US':
 
     forecast_fun = mu.get_metrics_by_state
     debug_fun = mu.get_log_daily_predicted_death_by_state
-    policy_date_fun = mu.get_policy_change_dates_by_state_US
 elif scope == 'VN':
     mu.DEATH_RATE = 1.25
     mu.ICU_RATE = 3.75
@@ -385,22 +262,25 @@ elif scope == 'VN':
 
     forecast_fun = mu.get_metrics_by_state
     debug_fun = mu.get_log_daily_predicted_death_by_state
-    policy_date_fun = mu.get_policy_change_dates_by_state_VN
 
-default_dates = policy_date_fun(local)
-default_dates = [to_datetime(pdate).date() for pdate in default_dates]
-default_dates = list(filter(None, default_dates))
+default_dates = mu.get_default_policy_change_dates(scope, local)
 date_options = date_range(start='2020/02/01', end=dt.date.today()+dt.timedelta(7)).tolist()
 date_options = default_dates + [s.date() for s in date_options[::-1]]
 policy_change_dates = st.sidebar.multiselect('Ngày thay đổi chính sách, như giãn cách, phong tỏa..'
                                              ' RẤT QUAN TRỌNG để có dự báo chính xác',
                                              options=date_options, default=default_dates)
 policy_change_dates.sort()
-forecast_horizon = st.sidebar.slider('Độ dài dự báo (ngày)', value=60, min_value=30, max_value=90)
+forecast_horizon = st.sidebar.slider('Độ dài dự báo (ngày)', value=DEFAULT_FORECAST_HORIZON, min_value=30,
+                                     max_value=90)
 show_debug = st.sidebar.checkbox('Hiển thị đường logarithm số ca tử vong', value=True)
 use_vaccine_data = st.sidebar.checkbox('Dùng dữ liệu về vắc xin trong mô hình', value=True)
 if scope == 'VN':
     use_vaccine_data = False
+# SEIR needs the population, only known for the World and US scopes
+engine = 'piecewise'
+if scope != 'VN':
+    engine = st.sidebar.selectbox('Mô hình: log tuyến tính từng đoạn, SEIR hoặc trung bình cả hai',
+                                  ['piecewise', 'seir', 'ensemble'], index=0)
 'Bạn chọn: ', local, ', ', local_sub_level, 'với ngày thay đổi chính sách:', \
     [date_obj.strftime('%Y-%m-%d') for date_obj in policy_change_dates], \
     'Nhấn **Run** ở bên trái màn hình để xem dự báo. Đồ thị tương tác được. Chạy tốt nhất trên máy tính.'
@@ -441,14 +321,34 @@ if st.sidebar.checkbox('Nâng cao: thay đổi các giả định'):
         mu.NOT_ICU_DISCHARGE_TIME = st.sidebar.slider('Thời gian xuất viện nếu không vào ICU',
                                                       value=mu.NOT_ICU_DISCHARGE_TIME, min_value=1, max_value=21)
 
+# Inputs changed while a forecast is still running: stop it, nobody will look at the result
+previous_job = st.session_state.get('forecast_job')
+if previous_job is not None and \
+        previous_job.key != get_forecast_job_key(forecast_fun, scope, local, local_sub_level, policy_change_dates,
+                                                 forecast_horizon, back_test, last_data_date, use_vaccine_data,
+                                                 engine):
+    previous_job.release()
+    del st.session_state['forecast_job']
+
 if run_click:
-    main(scope, local, local_sub_level, policy_change_dates, forecast_horizon, forecast_fun, debug_fun, metrics, show_debug,
-         show_data, back_test, last_data_date, use_vaccine_data)
+    with tracing.span('app.main', scope=scope, local=local, local_sub_level=local_sub_level,
+                      forecast_horizon=forecast_horizon, back_test=back_test, engine=engine):
+        main(scope, local, local_sub_level, policy_change_dates, forecast_horizon, forecast_fun, debug_fun, metrics,
+             show_debug, show_data, back_test, last_data_date, use_vaccine_data, engine)
+    # The server runs until stopped, write the spans of each run now
+    tracing.flush()
     model_params = [dt.datetime.today(), scope, local, local_sub_level, policy_change_dates,
                     mu.DEATH_RATE, mu.ICU_RATE, mu.HOSPITAL_RATE,
                     mu.SYMPTOM_RATE, mu.INFECT_2_HOSPITAL_TIME, mu.HOSPITAL_2_ICU_TIME, mu.ICU_2_DEATH_TIME, 
                     mu.ICU_2_RECOVER_TIME, mu.NOT_ICU_DISCHARGE_TIME, back_test, last_data_date]
     mu.append_row_2_logs(model_params)
+if show_data and 'export_tables' in st.session_state:
+    export_format = st.sidebar.selectbox('Định dạng file xuất', list(mu.EXPORT_FORMATS.keys()), index=0)
+    if st.sidebar.button('Tạo file tải về'):
+        for filename, table in st.session_state['export_tables'].items():
+            st.sidebar.markdown(mu.get_table_download_link(table, filename=filename + '.' + export_format,
+                                                           file_format=export_format),
+                                unsafe_allow_html=True)
 st.sidebar.subheader('Tác giả')
 st.sidebar.info(
 """
@@ -558,7 +458,8 @@ with st.beta_expander('Về mô hình'):
             1. Need to understand how long since infection, patient is no longer a source of infection to forecast
             curve after lock down period relaxed.          
             2. Upgrade the calculation using mean to use distribution if enough data is available.
-            3. Use SEIR model when number of infected cases near 20% of population.''')
+            3. Use SEIR model when number of infected cases near 20% of population. The SEIR and ensemble models
+            can be chosen on the left, the log linear model is still the default.''')
 with st.beta_expander('Medical myths'):
     st.markdown('I am not a medical doctor. I am a statistician but I strongly believe in this:')
     st.subheader('How Vietnamese doctors treat SARS before and COVID19 now?')
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Rolling origin back test: forecast each region as if the data stopped at each cut-off date and compare with the
+deaths reported afterwards. Use it to evaluate a model change on many regions and dates at once."""
+import argparse
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import model_utils as mu
+import tracing
+import precompute as pc
+
+DEFAULT_FORECAST_HORIZON = 28
+RESULT_COLUMNS = ['scope', 'local', 'local_sub_level', 'cutoff_date', 'target_date', 'days_ahead',
+                  'predicted_death', 'lower_bound', 'upper_bound', 'death', '7d_avg_death']
+
+# Cumulative death and confirmed series of the regions this process already forecast, fetched once per region
+_series = {}
+
+
+def get_cutoff_dates(start, end, every_days=7):
+    """Cut-off dates from start to end, every_days apart"""
+    return [date.date() for date in pd.date_range(start, end, freq='{}D'.format(every_days))]
+
+
+def get_region_series(scope, local, local_sub_level):
+    key = (scope, local, local_sub_level)
+    if key not in _series:
+        if scope == 'World':
+            _series[key] = (mu.get_data_by_country(local, local_sub_level, type='deaths'),
+                            mu.get_data_by_country(local, local_sub_level, type='confirmed'))
+        else:
+            _series[key] = (mu.get_data_by_state(local, local_sub_level, scope=scope, type='deaths'),
+                            mu.get_data_by_state(local, local_sub_level, scope=scope, type='confirmed'))
+    return _series[key]
+
+
+@tracing.flushed
+def backtest_region(scope, local, local_sub_level, cutoff_date, forecast_horizon=DEFAULT_FORECAST_HORIZON):
+    """Forecast of one region from the data up to cutoff_date, one row per day after it with the realized deaths"""
+    mu.set_params(mu.DEFAULT_PARAMS[scope])
+    local_death_data, local_confirmed_data = get_region_series(scope, local, local_sub_level)
+    # Policy changes announced after the cut-off were not known at that time
+    policy_change_dates = [date for date in mu.get_default_policy_change_dates(scope, local) if date <= cutoff_date]
+    daily_metrics, _, _ = mu.get_metrics_from_series(local_death_data, local_confirmed_data,
+                                                     'World' if scope == 'World' else 'US', local, local_sub_level,
+                                                     forecast_horizon=forecast_horizon,
+                                                     policy_change_dates=policy_change_dates,
+                                                     last_data_date=cutoff_date,
+                                                     use_vaccine_data=(scope != 'VN'))
+    cutoff = pd.Timestamp(cutoff_date)
+    forecast = daily_metrics.loc[(daily_metrics.index > cutoff) &
+                                 (daily_metrics.index <= cutoff + pd.Timedelta(days=forecast_horizon)),
+                                 ['predicted_death', 'lower_bound', 'upper_bound', 'death', '7d_avg_death']]
+    forecast = forecast.rename_axis('target_date').reset_index()
+    forecast.insert(0, 'scope', scope)
+    forecast.insert(1, 'local', local)
+    forecast.insert(2, 'local_sub_level', local_sub_level)
+    forecast.insert(3, 'cutoff_date', cutoff)
+    forecast.insert(5, 'days_ahead', (forecast.target_date - cutoff).dt.days)
+    return forecast
+
+
+def run_backtest(regions, cutoff_dates, forecast_horizon=DEFAULT_FORECAST_HORIZON, n_jobs=None):
+    """Back test every (scope, local, local_sub_level) region at every cut-off date in parallel.
+    out: (tidy frame with RESULT_COLUMNS, list of (region, cut-off date, error) that failed)"""
+    mu.preload_data(sorted({region[0] for region in regions}))
+    tasks = [(scope, local, local_sub_level, cutoff_date)
+             for scope, local, local_sub_level in regions for cutoff_date in cutoff_dates]
+    print('Back testing {} regions at {} cut-off dates'.format(len(regions), len(cutoff_dates)))
+    start = time.time()
+    results, failed = [], []
+    # fork so the workers inherit the preloaded data instead of downloading it again
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {executor.submit(backtest_region, *task, forecast_horizon=forecast_horizon): task for task in tasks}
+        for future in as_completed(futures):
+            scope, local, local_sub_level, cutoff_date = futures[future]
+            try:
+                results.append(future.result())
+            except (ValueError, IndexError, KeyError) as e:
+                failed.append(((scope, local, local_sub_level), cutoff_date, repr(e)))
+    print('Done {} forecasts in {:.1f}s, {} failed'.format(len(results), time.time() - start, len(failed)))
+    if not results:
+        return pd.DataFrame(columns=RESULT_COLUMNS), failed
+    backtest = pd.concat(results, ignore_index=True)
+    return backtest.sort_values(['scope', 'local', 'local_sub_level', 'cutoff_date', 'target_date'])\
+                   .reset_index(drop=True)[RESULT_COLUMNS], failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Back test the forecast over regions and cut-off dates')
+    parser.add_argument('-s', '--scope', default='US', choices=['World', 'US', 'VN'])
+    parser.add_argument('-r', '--regions', nargs='+', default=None,
+                        help='countries or states to back test, default to every one of the scope')
+    parser.add_argument('--start', required=True, help='first cut-off date')
+    parser.add_argument('--end', required=True, help='last cut-off date')
+    parser.add_argument('--every', type=int, default=7, help='days between cut-off dates')
+    parser.add_argument('-H', '--horizon', type=int, default=DEFAULT_FORECAST_HORIZON, help='days forecast')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes, default to CPUs')
+    parser.add_argument('-o', '--output', default='data_processed/backtest.csv')
+    args = parser.parse_args()
+    if args.regions is None:
+        mu.preload_data([args.scope])
+        regions = [(args.scope, local, 'All') for local, sub_level in pc.get_regions(args.scope) if sub_level == 'All']
+    else:
+        regions = [(args.scope, local, 'All') for local in args.regions]
+    backtest, failed = run_backtest(regions, get_cutoff_dates(args.start, args.end, args.every),
+                                    forecast_horizon=args.horizon, n_jobs=args.jobs)
+    for region, cutoff_date, error in failed:
+        print('{} at {}: {}'.format(region, cutoff_date, error))
+    backtest.to_csv(args.output, index=False)
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+import model_utils as mu
+
+# Shared memory blocks opened by this process, kept here so the frames built on them stay valid
+_attached = []
+
+
+def share_frame(df):
+    """Copy the trailing numeric columns of a frame, the daily counts of a JHU time series, into one shared memory
+    block. Leading columns are small and go with the spec.
+    out: (shared memory to close and unlink when done, picklable spec to rebuild the frame with attach_frame)"""
+    is_numeric = [pd.api.types.is_numeric_dtype(dtype) for dtype in df.dtypes]
+    n_leading = len(is_numeric)
+    while n_leading > 0 and is_numeric[n_leading - 1]:
+        n_leading -= 1
+    values = np.ascontiguousarray(df.iloc[:, n_leading:].values, dtype=np.float64)
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+    spec = {'name': shm.name,
+            'shape': values.shape,
+            'columns': df.columns[n_leading:],
+            'leading': df.iloc[:, :n_leading]}
+    return shm, spec
+
+
+def attach_frame(spec):
+    """Rebuild in a worker process a frame shared with share_frame, the shared values are not copied"""
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    _attached.append(shm)
+    values = np.ndarray(spec['shape'], dtype=np.float64, buffer=shm.buf)
+    values.flags.writeable = False
+    shared = pd.DataFrame(values, index=spec['leading'].index, columns=spec['columns'], copy=False)
+    return pd.concat([spec['leading'], shared], axis=1, copy=False)
+
+
+def share_data_cache():
+    """Put every frame of model_utils.DATA_CACHE in shared memory
+    out: (shared memory blocks owned by the caller, specs to give to init_worker)"""
+    blocks, specs = [], {}
+    for key, df in mu.DATA_CACHE.items():
+        shm, specs[key] = share_frame(df)
+        blocks.append(shm)
+    return blocks, specs
+
+
+def release(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+
+def init_worker(specs, params):
+    """Process pool initializer: model_utils reads its input data from the shared blocks"""
+    mu.set_params(params)
+    mu.enable_data_cache()
+    for key, spec in specs.items():
+        mu.DATA_CACHE[key] = attach_frame(spec)
@@ -0,0 +1 @@
+"""Benchmarks of the forecast pipeline on synthetic data, see benchmarks/run.py"""
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""Time the hot paths of the forecast pipeline on synthetic data at several scales and compare with a baseline.
+Run from the repository root: python -m benchmarks.run [-s small medium] [-o results.json].
+Each case is run once to warm up, then timed repeat times; the peak of the memory allocated by Python during one more
+run is measured with tracemalloc. The fastest timing is compared with the one of the baseline, a case slower by more
+than the tolerance and its noise floor, or using more memory by more than the tolerance, is a regression and the exit
+status is 1.
+Timings only compare on the same machine and packages: the baseline records them and the exit status is 2 when they
+differ. BASELINE_FILE is the baseline of the machine the reference timings were taken on, CI runners generate their own,
+for example on the base commit before the change:
+    python -m benchmarks.run --save-baseline -b base.json
+then on the change:
+    python -m benchmarks.run -b base.json"""
+import io
+import os
+import sys
+import json
+import time
+import inspect
+import warnings
+import argparse
+import platform
+import tracemalloc
+import contextlib
+import datetime as dt
+import numpy as np
+import pandas as pd
+import forecast_utils as fu
+import model_utils as mu
+import pwlf_mod as pwlf
+import SEIR as seir
+from benchmarks import synthetic
+
+BASELINE_FILE = 'benchmarks/baseline.json'
+# Days of data, counties of the wide table and days of the SEIR fit of each scale
+SCALES = {'small': {'n_days': 200, 'n_regions': 300, 'seir_days': 28},
+          'medium': {'n_days': 500, 'n_regions': 1000, 'seir_days': 56},
+          'large': {'n_days': 1000, 'n_regions': 3000, 'seir_days': 112}}
+FORECAST_HORIZON = 60
+# Relative slow down or memory increase over the baseline reported as a regression
+TOLERANCE = 0.25
+# Memory increase in MB under which a case does not regress, tracemalloc peaks of small cases vary by a few KB
+MEMORY_NOISE_MB = 0.05
+# Environment keys a baseline must share with the results to be compared
+ENVIRONMENT_KEYS = ['python', 'numpy', 'pandas', 'machine', 'cpus']
+# Fast cases are run this many seconds per timing, as their single runs are too noisy
+MIN_SECONDS = 0.2
+RESULT_COLUMNS = ['case', 'scale', 'size', 'repeat', 'min_s', 'median_s', 'peak_mb']
+
+
+def get_policy_change_dates(break_dates):
+    """Policy dates that show in the deaths on the break dates of the synthetic data"""
+    delay = mu.INFECT_2_HOSPITAL_TIME + mu.HOSPITAL_2_ICU_TIME + mu.ICU_2_DEATH_TIME
+    return [date - dt.timedelta(delay) for date in break_dates]
+
+
+def get_log_daily_death(local_death_data, break_dates):
+    """Smoothed log daily death and break points as fit_log_daily_death passes them to remove_outliers"""
+    daily_death = mu.get_daily_data(local_death_data).rolling(7, min_periods=3).mean()
+    daily_death.columns = ['death']
+    log_daily_death = np.log(daily_death[daily_death.death > 0.01])
+    start_date = local_death_data.index[0]
+    log_daily_death['time_idx'] = (log_daily_death.index - start_date).days.values
+    break_points = np.array([0] + [(pd.Timestamp(date) - start_date).days for date in break_dates] +
+                            [(local_death_data.index[-1] - start_date).days + FORECAST_HORIZON])
+    return log_daily_death, break_points
+
+
+def setup_daily_metrics(scale):
+    local_death_data, break_dates = synthetic.make_local_death_data(scale['n_days'])
+    policy_change_dates = get_policy_change_dates(break_dates)
+    return lambda: mu.get_daily_metrics_from_death_data(local_death_data, FORECAST_HORIZON, policy_change_dates)
+
+
+def setup_remove_outliers(scale):
+    log_daily_death, break_points = get_log_daily_death(*synthetic.make_local_death_data(scale['n_days']))
+    return lambda: mu.remove_outliers(log_daily_death, break_points)
+
+
+def setup_piecewise_fit(scale):
+    log_daily_death, break_points = get_log_daily_death(*synthetic.make_local_death_data(scale['n_days']))
+    x = np.arange(break_points[-1] + 1)
+
+    def run():
+        regr_pw = pwlf.PiecewiseLinFit(x=log_daily_death.time_idx.values, y=log_daily_death.death)
+        regr_pw.fit_with_breaks(break_points)
+        return regr_pw.predict(x), regr_pw.prediction_variance(x)
+    return run
+
+
+def setup_format_forecast(scale):
+    local_death_data, break_dates = synthetic.make_local_death_data(scale['n_days'])
+    daily_metrics, _ = mu.get_daily_metrics_from_death_data(local_death_data, FORECAST_HORIZON,
+                                                            get_policy_change_dates(break_dates))
+    input_forecast = daily_metrics.rename_axis('date').reset_index()
+    forecast_date = local_death_data.index[-1].date()
+    return lambda: fu.format_forecast(input_forecast, 'Texas', forecast_date, 'death', 'inc')
+
+
+def setup_seir_minimization(scale):
+    y0, t, infections = synthetic.make_seir_data(scale['seir_days'])
+    return lambda: seir.minimization(y0, t, infections, 1e7, niter=2, seed=0)
+
+
+def setup_data_by_state(scale):
+    """get_data_by_state on a wide table of n_regions counties, put in the data cache in place of the download"""
+    mu.enable_data_cache()
+    deaths_url = inspect.signature(mu.get_data).parameters['file_template'].default.format(type='deaths', scope='US')
+    mu.DATA_CACHE[(deaths_url, (('error_bad_lines', False),))] = synthetic.make_jhu_deaths(scale['n_regions'],
+                                                                                           scale['n_days'])
+    return lambda: mu.get_data_by_state('State7')
+
+
+# Setup of each case from a scale, returning the function to time, the size of the scale it depends on and the noise
+# floor in seconds, slow downs under it are not regressions however big the ratio: the solvers of remove_outliers and
+# SEIR take a varying number of iterations, and timings of a few milliseconds move with the machine load
+CASES = {'get_daily_metrics_from_death_data': (setup_daily_metrics, 'n_days', 0.03),
+         'remove_outliers': (setup_remove_outliers, 'n_days', 0.03),
+         'PiecewiseLinFit': (setup_piecewise_fit, 'n_days', 0.002),
+         'format_forecast': (setup_format_forecast, 'n_days', 0.005),
+         'SEIR.minimization': (setup_seir_minimization, 'seir_days', 0.1),
+         'get_data_by_state': (setup_data_by_state, 'n_regions', 0.02)}
+
+
+@contextlib.contextmanager
+def quiet():
+    """The models print and warn, keep it out of the report"""
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
+
+
+def time_case(run, repeat=3):
+    """Seconds of a run, averaged over enough runs to last MIN_SECONDS, repeat times, and peak MB allocated during one
+    run"""
+    with quiet():
+        start = time.perf_counter()
+        run()
+        number = max(1, int(MIN_SECONDS/(time.perf_counter() - start)))
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                run()
+            seconds.append((time.perf_counter() - start)/number)
+        tracemalloc.start()
+        try:
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return seconds, peak/2**20
+
+
+def run_benchmarks(cases=None, scales=None, repeat=3):
+    """Frame of the min and median seconds and peak MB of every case at every scale"""
+    mu.set_params(mu.DEFAULT_PARAMS['US'])
+    rows = []
+    for case in cases or CASES:
+        setup, size_name, _ = CASES[case]
+        for scale_name in scales or SCALES:
+            scale = SCALES[scale_name]
+            with quiet():
+                run = setup(scale)
+            seconds, peak_mb = time_case(run, repeat)
+            rows.append((case, scale_name, scale[size_name], repeat, min(seconds), float(np.median(seconds)),
+                         peak_mb))
+            print('{} {} ({} {}): {:.4f}s, {:.2f}MB'.format(case, scale_name, scale[size_name], size_name,
+                                                           rows[-1][4], peak_mb))
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+
+def get_environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'created_at': dt.datetime.now().isoformat(timespec='seconds')}
+
+
+def save_results(results, file):
+    with open(file, 'w') as f:
+        json.dump({'environment': get_environment(), 'results': results.to_dict(orient='records')}, f, indent=1)
+
+
+def load_results(file):
+    with open(file) as f:
+        return pd.DataFrame(json.load(f)['results'], columns=RESULT_COLUMNS)
+
+
+def load_environment(file):
+    with open(file) as f:
+        return json.load(f)['environment']
+
+
+def get_environment_changes(baseline_environment):
+    """Keys of ENVIRONMENT_KEYS that differ between the baseline and this run, as 'key: baseline -> current'"""
+    environment = get_environment()
+    return ['{}: {} -> {}'.format(key, baseline_environment.get(key), environment[key]) for key in ENVIRONMENT_KEYS
+            if baseline_environment.get(key) != environment[key]]
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Ratios of the min seconds and peak MB of the results over the baseline, for the cases of both.
+    A case regresses when a ratio is over 1 + tolerance and the increase is over the noise floor of the case, or
+    MEMORY_NOISE_MB"""
+    comparison = results.merge(baseline, on=['case', 'scale'], suffixes=('', '_baseline'))
+    noise_s = comparison.case.map({case: noise_s for case, (_, _, noise_s) in CASES.items()})
+    comparison['time_ratio'] = comparison.min_s/comparison.min_s_baseline
+    comparison['memory_ratio'] = comparison.peak_mb/comparison.peak_mb_baseline
+    comparison['regression'] = \
+        ((comparison.time_ratio > 1 + tolerance) & (comparison.min_s - comparison.min_s_baseline > noise_s)) | \
+        ((comparison.memory_ratio > 1 + tolerance) &
+         (comparison.peak_mb - comparison.peak_mb_baseline > MEMORY_NOISE_MB))
+    return comparison[['case', 'scale', 'min_s', 'min_s_baseline', 'time_ratio', 'peak_mb',
+                       'peak_mb_baseline', 'memory_ratio', 'regression']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the forecast pipeline on synthetic data')
+    parser.add_argument('-c', '--cases', nargs='+', default=None, choices=list(CASES), help='default to all cases')
+    parser.add_argument('-s', '--scales', nargs='+', default=None, choices=list(SCALES), help='default to all scales')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='timed runs of each case')
+    parser.add_argument('-o', '--output', default=None, help='json file for the results')
+    parser.add_argument('-b', '--baseline', default=BASELINE_FILE, help='json results to compare with')
+    parser.add_argument('-t', '--tolerance', type=float, default=TOLERANCE,
+                        help='relative slow down or memory increase reported as a regression')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline file')
+    args = parser.parse_args()
+    results = run_benchmarks(args.cases, args.scales, args.repeat)
+    if args.output is not None:
+        save_results(results, args.output)
+    if args.save_baseline:
+        save_results(results, args.baseline)
+        sys.exit(0)
+    comparison = compare(results, load_results(args.baseline), args.tolerance)
+    print(comparison.to_string(index=False))
+    changes = get_environment_changes(load_environment(args.baseline))
+    if changes:
+        print('Baseline taken in another environment ({}), generate one on this machine with --save-baseline'
+              .format(', '.join(changes)))
+        sys.exit(2)
+    if comparison.regression.any():
+        print('Regressions: {}'.format(', '.join(comparison[comparison.regression].case + ' ' +
+                                                 comparison[comparison.regression].scale)))
+        sys.exit(1)
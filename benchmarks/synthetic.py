@@ -0,0 +1,94 @@
+"""Deterministic synthetic epidemic data for the benchmarks, no download needed.
+Daily deaths follow waves of log-linear growth and decline, with Poisson noise and outliers: days with no report and
+backlog days reporting several days at once. The same seed always gives the same data"""
+import datetime as dt
+import numpy as np
+import pandas as pd
+import SEIR as seir
+
+START_DATE = dt.date(2020, 1, 22)
+# Meta columns of the JHU US time series, the dates follow
+JHU_US_COLUMNS = ['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Admin2', 'Province_State', 'Country_Region', 'Lat', 'Long_',
+                  'Combined_Key', 'Population']
+
+
+def get_log_daily_death(n_regions, n_days, n_waves=3, rng=None):
+    """Log of the expected daily deaths of every region, piecewise linear with a growth and a decline segment per wave.
+    out: (array regions x days, array regions x 2*n_waves - 1 of the days the slope changes)"""
+    rng = np.random.RandomState(0) if rng is None else rng
+    n_segments = 2*n_waves
+    # Segment lengths vary by region, the last segment runs to the end
+    lengths = rng.uniform(0.5, 1.5, (n_regions, n_segments))
+    break_days = np.floor(np.cumsum(lengths, axis=1)[:, :-1]/lengths.sum(axis=1, keepdims=True)*n_days).astype(int)
+    slopes = np.where(np.arange(n_segments) % 2 == 0, rng.uniform(0.03, 0.08, (n_regions, n_segments)),
+                      rng.uniform(-0.05, -0.01, (n_regions, n_segments)))
+    days = np.arange(n_days)
+    segment = (days[None, :, None] >= break_days[:, None, :]).sum(axis=2)
+    log_daily_death = rng.uniform(-1, 1, (n_regions, 1)) + \
+        np.cumsum(np.take_along_axis(slopes, segment, axis=1), axis=1)
+    return np.minimum(log_daily_death, 9), break_days
+
+
+def add_outliers(daily_death, outlier_rate=0.02, rng=None):
+    """Daily deaths with a share outlier_rate of the days not reported, and the next day after each reporting a
+    backlog of 2 to 10 times its deaths"""
+    rng = np.random.RandomState(0) if rng is None else rng
+    daily_death = daily_death.astype(np.float64)
+    missing = rng.uniform(size=daily_death.shape) < outlier_rate
+    backlog = np.roll(missing, 1, axis=-1) & ~missing
+    backlog[..., 0] = False
+    daily_death[missing] = 0
+    daily_death[backlog] *= rng.uniform(2, 10, backlog.sum())
+    return np.round(daily_death)
+
+
+def make_daily_death(n_regions, n_days, n_waves=3, outlier_rate=0.02, seed=0):
+    """Daily deaths of regions x days with outliers, and the days the slope of each region changes"""
+    rng = np.random.RandomState(seed)
+    log_daily_death, break_days = get_log_daily_death(n_regions, n_days, n_waves, rng)
+    daily_death = rng.poisson(np.exp(log_daily_death))
+    return add_outliers(daily_death, outlier_rate, rng), break_days
+
+
+def make_local_death_data(n_days, n_waves=3, outlier_rate=0.02, seed=0):
+    """Cumulative deaths of one region as model_utils.get_data_by_state returns them, a one column frame indexed by
+    date starting with 0.
+    out: (frame, list of the dates the slope of the log daily deaths changes)"""
+    daily_death, break_days = make_daily_death(1, n_days, n_waves, outlier_rate, seed)
+    dates = pd.date_range(START_DATE, periods=n_days + 1)
+    cum_death = np.concatenate([[0], np.cumsum(daily_death[0])])
+    return pd.DataFrame({0: cum_death}, index=dates), [dates[day + 1].date() for day in break_days[0]]
+
+
+def make_jhu_deaths(n_regions, n_days, n_states=50, n_waves=3, outlier_rate=0.02, seed=0):
+    """Cumulative deaths of n_regions counties in n_states states in the wide layout of the JHU US time series, one
+    row per county and one column per date. Counties start reporting on different days, zeros before"""
+    rng = np.random.RandomState(seed)
+    daily_death, _ = make_daily_death(n_regions, n_days, n_waves, outlier_rate, seed)
+    first_day = rng.randint(0, n_days//3, n_regions)
+    daily_death[np.arange(n_days)[None, :] < first_day[:, None]] = 0
+    # Counties of a state have the same waves at different sizes
+    daily_death = np.round(daily_death*rng.uniform(0.05, 1, (n_regions, 1)))
+    dates = pd.date_range(START_DATE, periods=n_days)
+    states = np.array(['State{}'.format(i) for i in range(n_states)])[np.arange(n_regions) % n_states]
+    counties = np.array(['County{}'.format(i) for i in range(n_regions)])
+    meta = pd.DataFrame({'UID': 84000000 + np.arange(n_regions), 'iso2': 'US', 'iso3': 'USA', 'code3': 840,
+                         'FIPS': 1000.0 + np.arange(n_regions), 'Admin2': counties, 'Province_State': states,
+                         'Country_Region': 'US', 'Lat': rng.uniform(25, 48, n_regions),
+                         'Long_': rng.uniform(-124, -67, n_regions),
+                         'Combined_Key': np.char.add(np.char.add(counties, ', '), np.char.add(states, ', US')),
+                         'Population': rng.randint(10000, 1000000, n_regions)}, columns=JHU_US_COLUMNS)
+    deaths = pd.DataFrame(np.cumsum(daily_death, axis=1).astype(np.int64),
+                          columns=[date.strftime('%-m/%-d/%y') for date in dates])
+    return pd.concat([meta, deaths], axis=1)
+
+
+def make_seir_data(n_days, population=1e7, params=(np.log(0.4), np.log(1/5.2), np.log(1/7)), noise=0.02, seed=0):
+    """Cumulative infections of a SEIR epidemic with multiplicative noise, as SEIR.minimization fits them.
+    out: (initial S, E, I, R; days; infections)"""
+    rng = np.random.RandomState(seed)
+    y0 = [population - 100, 0, 50, 50]
+    t = np.arange(n_days, dtype=np.float64)
+    states = seir.dynamics(y0, t, population, *params)
+    infections = (states[:, 2] + states[:, 3])*np.exp(rng.normal(0, noise, n_days))
+    return y0, t, np.maximum.accumulate(infections)
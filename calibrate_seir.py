@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Batch SEIR calibration: fit the SEIR model of model_utils.predict_death_seir for every country or state of a scope.
+The regions x days matrix of cumulative deaths is put once in shared memory for the worker processes. Each fit is warm
+started from the previous run of the region, or else from the nearest region already fitted in this run.
+Fitted parameters, residuals and timings go to the seir_fits table of the forecast store"""
+import os
+import argparse
+import time
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+import model_utils as mu
+import batch_utils as bu
+import forecast_store as fs
+import SEIR as seir
+import tracing
+
+# Column of the region and coordinate columns of the JHU time series of each scope
+REGION_COLUMNS = {'World': ('Country', 'Lat', 'Long'), 'US': ('State', 'Lat', 'Long_'), 'VN': ('State', 'Lat', 'Long')}
+TIMING_COLUMNS = ['local', 'seconds', 'rmse', 'warm_start', 'error']
+# Population of the VN provinces, 2019 census, the VN time series leave it empty
+VN_POPULATION_FILE = 'data/population_VN.csv'
+
+# Cumulative deaths of every region, attached from shared memory in each worker
+_deaths = None
+
+
+def get_region_table(scope):
+    """Cumulative deaths of every country (World) or state (US, VN), with the mean coordinates and the population
+    of each. Population of the countries is looked up, of the VN provinces read from VN_POPULATION_FILE, regions
+    without one are left out. Raise ValueError when no region has a population.
+    out: (frame regions x dates, frame of lat, long and population by region)"""
+    region_column, lat_column, long_column = REGION_COLUMNS[scope]
+    data = mu.get_data(scope={'World': 'global'}.get(scope, scope), type='deaths')
+    date_columns = data.columns[4:] if scope == 'World' else data.columns[12:]
+    deaths = data.groupby(region_column)[date_columns].sum().astype(np.float64)
+    info = data.groupby(region_column)[[lat_column, long_column]].mean()
+    info.columns = ['lat', 'long']
+    if scope == 'World':
+        population = {}
+        for country in deaths.index:
+            try:
+                population[country] = mu.get_population('World', country)
+            except IndexError:
+                continue
+        info['population'] = pd.Series(population, dtype=np.float64)
+    elif scope == 'VN':
+        info['population'] = pd.read_csv(VN_POPULATION_FILE, index_col='State').Population.reindex(info.index)
+    else:
+        info['population'] = data.groupby(region_column).Population.sum()
+    missing = info.index[~(info.population > 0)]
+    if len(missing) > 0:
+        print('No population for {}, left out'.format(', '.join(missing)))
+    info = info[info.population > 0]
+    if info.empty:
+        raise ValueError('No region of {} has a population'.format(scope))
+    return deaths.loc[info.index], info
+
+
+def init_worker(spec, params):
+    """Process pool initializer: the deaths of every region are read from the shared block"""
+    global _deaths
+    mu.set_params(params)
+    _deaths = bu.attach_frame(spec)
+
+
+@tracing.flushed
+def calibrate_region(local, population, policy_change_dates=[], warm_start=None):
+    """SEIR fit of one region of the shared deaths, a dict for forecast_store.save_seir_fit without warm_start"""
+    start = time.time()
+    local_death_data = mu.process_local_data(_deaths.loc[local].to_frame())
+    window, t, y0 = mu.get_seir_fit_data(local_death_data, policy_change_dates, population)
+    params, ssr = mu.fit_seir(window, t, y0, population, warm_start)
+    states = seir.dynamics(y0, t, population, *params)
+    residuals = pd.Series(window.values - states[:, 2] - states[:, 3], index=window.index)
+    return {'fit_start_date': window.index[0].date(), 'params': params, 'ssr': ssr,
+            'rmse': np.sqrt(np.mean(residuals.values**2)), 'residuals': residuals, 'seconds': time.time() - start}
+
+
+def get_warm_start(local, previous, fitted, info):
+    """Parameters to start the fit of a region from, and where they come from: the previous run of the region, else
+    the nearest region fitted in this run, else none and the fit uses random restarts only"""
+    if local in previous:
+        return previous[local], 'previous'
+    if not fitted:
+        return None, 'none'
+    fitted_info = info.loc[list(fitted)]
+    distances = (fitted_info.lat - info.lat[local])**2 + (fitted_info.long - info.long[local])**2
+    neighbour = distances.idxmin() if distances.notna().any() else fitted_info.index[0]
+    return fitted[neighbour], 'neighbour: {}'.format(neighbour)
+
+
+def calibrate(scope='US', regions=None, n_jobs=None, store_file=fs.STORE_FILE, run_date=None):
+    """Calibrate every region of a scope, or the given countries or states, on a process pool and store the fits.
+    At most two fits per worker are submitted at a time so the later regions can warm start from their neighbours.
+    out: frame of the seconds, rmse, warm start and error of every region"""
+    run_date = dt.date.today() if run_date is None else run_date
+    mu.set_params(mu.DEFAULT_PARAMS[scope])
+    mu.preload_data([scope])
+    deaths, info = get_region_table(scope)
+    if regions is not None:
+        deaths, info = deaths.loc[deaths.index.isin(regions)], info.loc[info.index.isin(regions)]
+    previous = {local: params for (local, local_sub_level), params in
+                fs.load_seir_params(scope, run_date, store_file).items() if local_sub_level == 'All'}
+    # Regions with a previous run first, they do not need a neighbour
+    todo = sorted(deaths.index, key=lambda local: local not in previous)
+    print('Calibrating SEIR for {} regions, {} with a previous run'.format(len(todo),
+                                                                          sum(local in previous for local in todo)))
+    n_workers = n_jobs or os.cpu_count()
+    fitted, timings = {}, []
+    start = time.time()
+    shm, spec = bu.share_frame(deaths)
+    conn = fs.connect(store_file)
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker,
+                                 initargs=(spec, mu.get_params())) as executor:
+            running = {}
+            while todo or running:
+                while todo and len(running) < 2*n_workers:
+                    local = todo.pop(0)
+                    warm_start, source = get_warm_start(local, previous, fitted, info)
+                    future = executor.submit(calibrate_region, local, info.population[local],
+                                             mu.get_default_policy_change_dates(scope, local), warm_start)
+                    running[future] = (local, source)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    local, source = running.pop(future)
+                    try:
+                        fit = future.result()
+                    except (ValueError, IndexError, KeyError) as e:
+                        timings.append((local, np.nan, np.nan, source, repr(e)))
+                        print('{}: failed {!r}'.format(local, e))
+                        continue
+                    fit['warm_start'] = source
+                    fitted[local] = fit['params']
+                    fs.save_seir_fit(conn, scope, local, 'All', run_date, fit)
+                    timings.append((local, fit['seconds'], fit['rmse'], source, ''))
+                    print('{}/{} {}: {:.1f}s, rmse {:.3g}, warm start {}'.format(len(timings), len(deaths), local,
+                                                                               fit['seconds'], fit['rmse'], source))
+    finally:
+        conn.close()
+        bu.release([shm])
+    print('Calibrated {} regions in {:.1f}s, {} failed'.format(len(fitted), time.time() - start,
+                                                             len(timings) - len(fitted)))
+    return pd.DataFrame(timings, columns=TIMING_COLUMNS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calibrate the SEIR model for every region of a scope')
+    parser.add_argument('-s', '--scope', default='US', choices=['World', 'US', 'VN'])
+    parser.add_argument('-r', '--regions', nargs='+', default=None,
+                        help='countries or states to calibrate, default to every one of the scope')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes, default to CPUs')
+    parser.add_argument('--store', default=fs.STORE_FILE, help='sqlite file of the forecast store')
+    parser.add_argument('-o', '--timings', default=None, help='csv file for the timings of every region')
+    args = parser.parse_args()
+    timings = calibrate(args.scope, args.regions, n_jobs=args.jobs, store_file=args.store)
+    if args.timings is not None:
+        timings.to_csv(args.timings, index=False)
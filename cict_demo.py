@@ -1,25 +1,12 @@
 import streamlit as st
 import datetime as dt
-import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
-import plotly.express as px
-import plotly.offline as py_offline
-import cufflinks as cf
-cf.go_offline()
-py_offline.__PLOTLY_OFFLINE_INITIALIZED = True
 
 import model_utils as mu
+import plot_utils as pu
+import response_surface as rs
 
-mu.DEATH_RATE = 0.36
-mu.ICU_RATE = 0.78
-mu.HOSPITAL_RATE = 2.18
-mu.SYMPTOM_RATE = 10.2
-mu.INFECT_2_HOSPITAL_TIME = 11
-mu.HOSPITAL_2_ICU_TIME = 4
-mu.ICU_2_DEATH_TIME = 4
-mu.ICU_2_RECOVER_TIME = 7
-mu.NOT_ICU_DISCHARGE_TIME = 5
+mu.set_params(mu.DEFAULT_PARAMS['US'])
 
 st.title('C*apacity* I*ncidence* C*ontaining* T*esting* (CICT) Demo')
 hide_menu_style = """
@@ -37,84 +24,36 @@ ct = st.sidebar.slider('Contact Tracing', value=0.2)
 test_value = ct
 contain_value = ct
 contain_rate = contain_rate_slot.slider('Containing', value=contain_value)
-test_rate = test_rate_slot.slider('Testing', value=test_value)
-days_till_lock_down_end = st.sidebar.slider('How many days until lock down end?', value=7, min_value=1, max_value=60)
-relax_date = dt.date.today()+dt.timedelta(days_till_lock_down_end)
-forecast_horizon = st.sidebar.slider('Forecast Horizon', value=90, min_value=60, max_value=180)
+test_rate = test_rate_slot.slider('Testing', value=max(test_value, 0.01), min_value=0.01)
+days_till_lock_down_end = st.sidebar.slider('How many days until lock down end?', value=7,
+                                            min_value=int(rs.RELAX_DAYS[0]), max_value=int(rs.RELAX_DAYS[-1]))
+forecast_horizon = st.sidebar.slider('Forecast Horizon', value=90, min_value=60, max_value=rs.MAX_FORECAST_HORIZON)
+incidence = st.sidebar.selectbox('Incidence', ['predicted_death', 'ICU', 'hospital_beds'], index=0)
 state = 'New York'
 #state = 'Washington'
-daily, cumulative, model_beta = mu.get_metrics_by_state_US(state, lockdown_date='20200322',
-                                                           forecast_horizon=forecast_horizon,
-                                                           relax_date=relax_date, contain_rate=contain_rate,
-                                                           test_rate=test_rate)
-
-model_beta_new = np.append(model_beta, ((model_beta[1]+model_beta[2])*contain_rate+model_beta[1]*(1-contain_rate))-
-                                        (model_beta[1]+model_beta[2]))
-incidence = 'predicted_death'
-#incidence = 'ICU'
-incidence_func = mu.get_number_ICU_need
-daily['Incidence'] = daily[[incidence]]
-
+policy_change_dates = mu.get_default_policy_change_dates('US', state)
+
+# Same forecast as get_metrics_by_state without vaccine data and with the relax date added to the policy change dates,
+# for every relax date and contain rate of the sliders. Built once a day, sliders only look it up
+surface = rs.surface_cache.get(('US', state, tuple(policy_change_dates)), lambda: rs.build_surface(
+    mu.get_data_by_state(state, scope='US', type='deaths'), policy_change_dates))
+# Days are counted from the last data date, the data may be a few days old
+relax_date = surface['relax_dates'][days_till_lock_down_end - rs.RELAX_DAYS[0]]
+log_predicted_death, model_beta = rs.lookup(surface, relax_date, contain_rate)
+forecast_end_date = surface['data_end_date'] + dt.timedelta(forecast_horizon)
+metrics = rs.get_daily_metrics(log_predicted_death, test_rate).loc[:forecast_end_date]
+
+daily = metrics[incidence].rename(columns={'value': 'Incidence'})
 daily['Capacity'] = cap_ratio*current_capacity
-fig = daily[['Incidence', 'Capacity']].iplot(asFigure=True)
-#fig = go.Figure()
-#     layout=go.Layout(
-#         title=go.layout.Title(text="A Figure Specified By A Graph Object")
-#     )
-# )
-y_upper = daily.upper_bound
-y_lower = daily.lower_bound
-#y_upper = incidence_func(daily.upper_bound.to_frame()).dropna()
-#y_lower = incidence_func(daily.lower_bound.to_frame()).dropna()
-#x = daily.index.to_pydatetime()
-#x = daily.index[(daily.index>=min(y_upper.index))&(daily.index<=max(y_upper.index))].to_pydatetime()
-x = y_upper.index.date
-#x = pd.to_datetime(x).date
-#y_upper.reset_index(drop=False,inplace=True)
-fig.add_trace(go.Scatter(
-    x=x,
-    y=y_upper.values.flatten(),
-    fill=None,
-    showlegend=True,
-    name='Upper Bound'))
-
-fig.add_trace(go.Scatter(
-    x=x,
-    y=y_lower.values.flatten(),
-    fill='tonexty',
-    fillcolor='rgba(128,128,128,0.2)',
-    showlegend=True,
-    name='Lower Bound'
-))
+fig = pu.forecast_figure(daily, ['Incidence', 'Capacity'], bounds=('lower_bound', 'upper_bound'))
 st.plotly_chart(fig)
 
-
-log_fit, model_beta_log = mu.get_log_daily_predicted_death_by_state_US(state, lockdown_date='20200322',
-                                                                       forecast_horizon=forecast_horizon,
-                                                                       relax_date=relax_date, contain_rate=contain_rate)
 st.subheader('Fitted log of incidences')
-log_fit.rename(columns={'predicted_death':'Predicted_Incidence', 'death': 'Incidence'}, inplace=True)
-fig = log_fit.drop(columns=['lower_bound', 'upper_bound', 'Incidence'], errors='ignore').iplot(asFigure=True)
-x = log_fit.index
-y_upper = log_fit.upper_bound.values
-y_lower = log_fit.lower_bound.values
-fig.add_trace(go.Scatter(
-    x=x,
-    y=y_upper,
-    fill=None,
-    showlegend=False,
-    name='Upper Bound'))
-
-fig.add_trace(go.Scatter(
-    x=x,
-    y=y_lower,
-    fill='tonexty',
-    fillcolor='rgba(128,128,128,0.1)',
-    showlegend=False,
-    name='Lower Bound'
-))
+log_fit = pd.concat([surface['log_daily_death'].rename(columns={'death': 'Incidence'}),
+                     log_predicted_death.rename(columns={'predicted_death': 'Predicted_Incidence'})],
+                    axis=1, sort=True).loc[:forecast_end_date]
+fig = pu.forecast_figure(log_fit, ['Incidence', 'Predicted_Incidence'], bounds=('lower_bound', 'upper_bound'))
 st.plotly_chart(fig)
 
-
-st.write(pd.concat([pd.Series(model_beta), pd.Series(model_beta_new)], axis=1))
-st.write('Will be available at https://aipert.org')
\ No newline at end of file
+st.write(pd.concat([pd.Series(surface['model_beta'][0][:-1]), pd.Series(model_beta)], axis=1))
+st.write('Will be available at https://aipert.org')
@@ -0,0 +1,292 @@
+"""Death model of model_utils on arrays: smoothing, masking of the days after policy changes, piecewise linear fit,
+prediction, derived metrics and occupancy, on integer day offsets and float arrays from start to finish.
+The DataFrame functions of model_utils convert their inputs to day offsets from the first data date, call these and
+rebuild their frames; batch jobs that only need the numbers call get_daily_metrics and never build a frame.
+Model rates and times are given as params, a dict like model_utils.DEFAULT_PARAMS['World']"""
+import numpy as np
+from scipy import linalg
+from sklearn import linear_model
+import pwlf_mod as pwlf
+import tracing
+
+SMOOTHING_DAYS = 7
+SMOOTHING_MIN_PERIODS = 3
+# Deaths after the horizon predicted so the occupancy at its end counts the patients who die later
+EXTRA_DAYS = 19
+DAILY_COLUMNS = ['death', '7d_avg_death', 'predicted_death', 'lower_bound', 'upper_bound', 'infected', 'symptomatic',
+                 'hospitalized', 'hospital_beds', 'ICU']
+
+
+def get_delay(params):
+    """Days from infection to death"""
+    return params['INFECT_2_HOSPITAL_TIME'] + params['HOSPITAL_2_ICU_TIME'] + params['ICU_2_DEATH_TIME']
+
+
+def get_daily(cum_values):
+    """Daily values of cumulative values, 0 on the first row and where either row is missing"""
+    daily = np.zeros(len(cum_values))
+    daily[1:] = np.diff(np.asarray(cum_values, dtype=np.float64))
+    daily[np.isnan(daily)] = 0
+    return daily
+
+
+def rolling_mean(values, window=SMOOTHING_DAYS, min_periods=SMOOTHING_MIN_PERIODS):
+    """Mean of the last window rows, labelled on the last one, nan with less than min_periods known values"""
+    n_rows = len(values)
+    padded = np.concatenate([np.full(window - 1, np.nan), values])
+    total, count = np.zeros(n_rows), np.zeros(n_rows)
+    for lag in range(window):
+        window_values = padded[lag:lag + n_rows]
+        is_known = ~np.isnan(window_values)
+        total += np.where(is_known, window_values, 0)
+        count += is_known
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count >= min_periods, total/count, np.nan)
+
+
+def lookup(days, values, query_days):
+    """Values on query_days of values given on sorted days, nan on days not given"""
+    days, values, query_days = np.asarray(days), np.asarray(values, dtype=np.float64), np.asarray(query_days)
+    position = np.searchsorted(days, query_days).clip(max=max(len(days) - 1, 0))
+    found = (days[position] == query_days) if len(days) else np.zeros(len(query_days), dtype=bool)
+    return np.where(found, values[position] if len(days) else np.nan, np.nan)
+
+
+def get_regression_matrix(breaks, x):
+    """Regression matrix of pwlf for the breaks on days x"""
+    breaks = np.sort(np.asarray(breaks))
+    x = np.asarray(x)
+    return np.column_stack([np.ones(len(x)), x - breaks[0]] +
+                           [np.where(x > break_point, x - break_point, 0.0) for break_point in breaks[1:-1]])
+
+
+@tracing.traced('remove_outliers')
+def get_outliers(time_idx, log_death, break_points):
+    """Outliers of a robust linear regression in each section between break points, for days time_idx in
+    increasing order"""
+    robust_reg = linear_model.HuberRegressor(fit_intercept=True)
+    outliers = []
+    for start, end in zip(break_points[:-1], break_points[1:]):
+        in_section = (time_idx >= start) & (time_idx < end)
+        try:
+            robust_reg.fit(time_idx[in_section].reshape(-1, 1), log_death[in_section])
+            outliers.append(robust_reg.outliers_)
+        except Exception:
+            outliers.append(np.zeros(in_section.sum(), dtype=bool))
+    outliers = np.concatenate(outliers) if outliers else np.array([], dtype=bool)
+    if len(outliers) != len(time_idx):
+        raise ValueError('Break points must be in increasing order')
+    return outliers
+
+
+def get_beta_covariance(regr_pw):
+    """Covariance of the betas of a fitted pwlf model, same assumptions as its prediction_variance"""
+    A = regr_pw.assemble_regression_matrix(regr_pw.fit_breaks, regr_pw.x_data)
+    residuals = np.dot(A, regr_pw.beta) - regr_pw.y_data
+    variance = np.dot(residuals, residuals) / (regr_pw.n_data - regr_pw.beta.size)
+    return variance * np.linalg.pinv(np.dot(A.T, A))
+
+
+def get_prediction_variance(regr_pw, x):
+    """pwlf prediction_variance without the days x days matrix it takes the diagonal of"""
+    Ad = get_regression_matrix(regr_pw.fit_breaks, regr_pw.x_data)
+    residuals = np.dot(Ad, regr_pw.beta) - regr_pw.y_data
+    variance = np.dot(residuals, residuals) / (regr_pw.n_data - regr_pw.beta.size)
+    A = get_regression_matrix(regr_pw.fit_breaks, x)
+    return variance * np.einsum('ij,ij->i', np.dot(A, linalg.pinv(np.dot(Ad.T, Ad))), A)
+
+
+@tracing.traced('fit_log_daily_death')
+def fit_log_daily_death(days, cum_death, forecast_horizon=60, policy_days=[], contain_rate=0.8, pop_ratio=None):
+    """Fit of model_utils.fit_log_daily_death on arrays.
+    days: day offsets of the rows of cum_death, increasing
+    policy_days: day offsets the policy changes show in the deaths, nan for unknown
+    pop_ratio: ratio to divide the daily deaths of each row by, see model_utils.get_metrics_from_series
+    out: dict of the fitted pwlf model regr_pw, model_beta, break_points and forecast_time_idx in days from start_day,
+    the first day of the fitted data, beta_cov, default_last_slope, log_predicted_death_pred_var, log_daily_death
+    the fitted data before outliers are removed and log_daily_death_rows the rows of the input it is on"""
+    days = np.asarray(days)
+    with tracing.span('smoothing'):
+        daily_death = get_daily(cum_death)
+        if pop_ratio is not None:
+            daily_death = daily_death/pop_ratio
+        daily_death_avg = rolling_mean(daily_death)
+        # Turn 0 to nan to avoid log of 0
+        daily_death_avg[daily_death_avg <= 0.01] = np.nan
+        # The smoothing mixes the curves before and after a policy change in the first days after it
+        rows = np.ones(len(days), dtype=bool)
+        for policy_day in np.asarray(policy_days):
+            rows &= (days > policy_day + SMOOTHING_DAYS) | (days <= policy_day)
+        log_daily_death = np.log(daily_death_avg[rows])
+
+    start_day = days[rows][0]
+    data_end_idx = days[rows][-1] - start_day
+    forecast_end_idx = data_end_idx + forecast_horizon
+    forecast_time_idx = np.arange(forecast_end_idx + 1)
+    time_idx = days[rows] - start_day
+    is_known = np.isfinite(log_daily_death)
+    time_idx, log_death = time_idx[is_known], log_daily_death[is_known]
+    policy_idx = np.asarray(policy_days) - start_day
+    break_points = np.array([0] + policy_idx[(~np.isnan(policy_idx)) & (policy_idx < forecast_end_idx)].tolist() +
+                            [forecast_end_idx])
+    outliers = get_outliers(time_idx, log_death, break_points)
+    with tracing.span('pwlf_fit', n_breaks=len(break_points)):
+        regr_pw = pwlf.PiecewiseLinFit(x=time_idx[~outliers], y=log_death[~outliers])
+        regr_pw.fit_with_breaks(break_points)
+    model_beta = regr_pw.beta
+    with tracing.span('variance'):
+        log_predicted_death_pred_var = SMOOTHING_DAYS * get_prediction_variance(regr_pw, forecast_time_idx)
+        beta_cov = SMOOTHING_DAYS * get_beta_covariance(regr_pw)
+
+    # Use default slope when data is not enough to fit last line, less than 4 data point, with contain_rate=1 mean slope
+    # is the same as previous slope (same policy) and 0 mean (relax 100%) slope will be same as before lockdown
+    default_last_slope = ((data_end_idx - break_points[-2]) < 4) | (model_beta[-1] > max(0.3, abs(model_beta[1])))
+    if default_last_slope:
+        if model_beta[-2] < 0:
+            model_beta[-1] = (-model_beta[-2])*(1-contain_rate)
+        else:
+            model_beta[-1] = (-model_beta[-2])*(1+contain_rate)
+        print("Use default last slope due to not enough data")
+        n_before = np.count_nonzero(forecast_time_idx <= break_points[-2])
+        log_predicted_death_pred_var = np.concatenate(
+            (log_predicted_death_pred_var[:n_before],
+             log_predicted_death_pred_var[n_before] * (forecast_time_idx[n_before:] - break_points[-2])))
+
+    return {'regr_pw': regr_pw, 'model_beta': model_beta, 'break_points': break_points, 'beta_cov': beta_cov,
+            'default_last_slope': default_last_slope, 'start_day': start_day, 'forecast_time_idx': forecast_time_idx,
+            'log_predicted_death_pred_var': log_predicted_death_pred_var, 'log_daily_death': log_daily_death,
+            'log_daily_death_rows': rows}
+
+
+def predict_log_daily_death(fit, log_pop_ratio=None):
+    """Log daily death forecast of a fit on its forecast_time_idx, with the bounds of the 95% interval.
+    log_pop_ratio: log of the population ratio added on each forecast day
+    out: (predicted, lower bound, upper bound)"""
+    with tracing.span('predict'):
+        log_predicted_death = np.dot(get_regression_matrix(fit['break_points'], fit['forecast_time_idx']),
+                                     fit['model_beta'])
+        log_predicted_death_sd = np.sqrt(fit['log_predicted_death_pred_var'])
+        lower_bound = log_predicted_death - 1.96 * log_predicted_death_sd
+        upper_bound = log_predicted_death + 1.96 * log_predicted_death_sd
+        if log_pop_ratio is not None:
+            log_predicted_death = log_predicted_death + log_pop_ratio
+            lower_bound = lower_bound + log_pop_ratio
+            upper_bound = upper_bound + log_pop_ratio
+    return log_predicted_death, lower_bound, upper_bound
+
+
+def get_occupancy_kernel(metric, params):
+    """Beds occupied by the patients of one death, by day around the death date, as in
+    model_utils.get_hospital_beds_from_death and get_ICU_from_death.
+    metric: 'hospital_beds' or 'ICU'
+    out: (offset in days of the first weight from the death date, weights of consecutive days, number of last days
+    dropped from the result because patients still to come are missing)"""
+    recovered_weight = (params['ICU_RATE'] - params['DEATH_RATE'])/params['DEATH_RATE']
+    hospital_2_icu, icu_2_death = params['HOSPITAL_2_ICU_TIME'], params['ICU_2_DEATH_TIME']
+    icu_2_recover, not_icu_discharge = params['ICU_2_RECOVER_TIME'], params['NOT_ICU_DISCHARGE_TIME']
+    if metric == 'hospital_beds':
+        # (periods, end date offset, weight) of each stay
+        stays = [(hospital_2_icu + icu_2_death, 0, 1.0),
+                 (hospital_2_icu + icu_2_recover + not_icu_discharge,
+                  icu_2_recover - icu_2_death + not_icu_discharge, recovered_weight),
+                 (not_icu_discharge, -hospital_2_icu - icu_2_death + not_icu_discharge,
+                  (params['HOSPITAL_RATE'] - params['ICU_RATE'])/params['DEATH_RATE'])]
+        n_dropped = hospital_2_icu + icu_2_recover + not_icu_discharge
+    else:
+        stays = [(icu_2_death, 0, 1.0),
+                 (icu_2_recover, icu_2_recover - icu_2_death, recovered_weight)]
+        n_dropped = icu_2_recover
+    first_offset = min(end_offset - periods + 1 for periods, end_offset, _ in stays)
+    last_offset = max(end_offset for _, end_offset, _ in stays)
+    weights = np.zeros(last_offset - first_offset + 1)
+    for periods, end_offset, weight in stays:
+        weights[end_offset - periods + 1 - first_offset:end_offset + 1 - first_offset] += weight
+    return first_offset, weights, n_dropped
+
+
+def convolve_occupancy(daily_death, kernel):
+    """Beds occupied each day from daily deaths on consecutive days, along the last axis of an array of any shape.
+    Missing deaths count as 0, a day is missing only when all deaths it depends on are.
+    out: array starting kernel[0] days from the first death date"""
+    _, weights, n_dropped = kernel
+    daily_death = np.asarray(daily_death, dtype=np.float64)
+    is_known = ~np.isnan(daily_death)
+    known_death = np.where(is_known, daily_death, 0)
+    n_days = daily_death.shape[-1]
+    occupancy = np.zeros(daily_death.shape[:-1] + (n_days + len(weights) - 1,))
+    n_known = np.zeros(occupancy.shape)
+    for lag, weight in enumerate(weights):
+        occupancy[..., lag:lag + n_days] += weight*known_death
+        n_known[..., lag:lag + n_days] += is_known
+    occupancy[n_known == 0] = np.nan
+    return occupancy[..., :occupancy.shape[-1] - n_dropped]
+
+
+def derive_metrics(daily_death, params):
+    """Metrics derived from daily deaths on consecutive days, along the last axis of an array of any shape.
+    out: dict of (offset in days of the first value from the first death day, values) by metric"""
+    delay_time = get_delay(params)
+    hospital_delay_time = params['HOSPITAL_2_ICU_TIME'] + params['ICU_2_DEATH_TIME']
+    metrics = {'infected': (-delay_time, (100/params['DEATH_RATE'])*daily_death),
+               'symptomatic': (-hospital_delay_time, (params['SYMPTOM_RATE']/params['DEATH_RATE'])*daily_death),
+               'hospitalized': (-hospital_delay_time, (params['HOSPITAL_RATE']/params['DEATH_RATE'])*daily_death)}
+    with tracing.span('occupancy'):
+        for metric in ['hospital_beds', 'ICU']:
+            kernel = get_occupancy_kernel(metric, params)
+            metrics[metric] = (kernel[0], convolve_occupancy(daily_death, kernel))
+    return metrics
+
+
+def get_daily_metric_arrays(days, cum_death, first_day, predicted_death, forecast_horizon, params):
+    """Columns of model_utils.get_daily_metrics_from_death_data on consecutive days up to forecast_horizon days after
+    the last data day.
+    first_day: day of the first predicted death
+    predicted_death: array of predicted death, lower and upper bound x consecutive days
+    out: dict of first_day, rows, True on the days the DataFrame has a row for, the data or a metric, and the array of
+    each column of DAILY_COLUMNS"""
+    days = np.asarray(days)
+    with tracing.span('derive'):
+        daily_death = get_daily(cum_death)
+        # (first day, values) of every column
+        columns = {'death': (days, daily_death), '7d_avg_death': (days, rolling_mean(daily_death))}
+        for i, column in enumerate(['predicted_death', 'lower_bound', 'upper_bound']):
+            columns[column] = (first_day, predicted_death[i])
+        for metric, (offset, values) in derive_metrics(predicted_death[0], params).items():
+            columns[metric] = (first_day + offset, values)
+    last_day = days[-1] + forecast_horizon
+    grid_first_day = min(days[0], min(first for first, _ in columns.values() if np.ndim(first) == 0))
+    n_days = last_day - grid_first_day + 1
+    metrics = {'first_day': grid_first_day, 'rows': np.zeros(n_days, dtype=bool)}
+    metrics['rows'][days[days <= last_day] - grid_first_day] = True
+    for column in DAILY_COLUMNS:
+        first, values = columns[column]
+        metrics[column] = np.full(n_days, np.nan)
+        if np.ndim(first) == 1:
+            metrics[column][first[first <= last_day] - grid_first_day] = values[first <= last_day]
+            continue
+        values = values[:max(last_day - first + 1, 0)]
+        metrics[column][first - grid_first_day:first - grid_first_day + len(values)] = values
+        metrics['rows'][first - grid_first_day:first - grid_first_day + len(values)] = True
+    return metrics
+
+
+def get_daily_metrics(days, cum_death, forecast_horizon=60, policy_days=[], contain_rate=0.8, pop_ratio=None,
+                      params=None):
+    """Piecewise model forecast and derived metrics of model_utils.get_daily_metrics_from_death_data as arrays, for
+    batch jobs that do not need the frame.
+    days, cum_death, policy_days: see fit_log_daily_death
+    pop_ratio: (sorted days, ratios) or None
+    params: model rates and times, default to the current ones of model_utils
+    out: (dict of get_daily_metric_arrays, model_beta)"""
+    if params is None:
+        import model_utils as mu
+        params = mu.get_params()
+    days = np.asarray(days)
+    fit = fit_log_daily_death(days, cum_death, forecast_horizon + EXTRA_DAYS, policy_days, contain_rate,
+                              None if pop_ratio is None else lookup(pop_ratio[0], pop_ratio[1], days))
+    first_day = fit['start_day']
+    log_pop_ratio = None if pop_ratio is None else \
+        np.log(lookup(pop_ratio[0], pop_ratio[1], first_day + fit['forecast_time_idx']))
+    predicted_death = np.exp(np.array(predict_log_daily_death(fit, log_pop_ratio)))
+    return get_daily_metric_arrays(days, cum_death, first_day, predicted_death, forecast_horizon, params), \
+        fit['model_beta']
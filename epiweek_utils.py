@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+# CDC epiweeks run Sunday to Saturday. Day 0 of datetime64[D] is Thursday 1970-01-01, so Saturdays are day 2 mod 7
+SATURDAY = 2
+
+
+def to_days(dates):
+    """Dates (strings, date, datetime or datetime64 array-like) to a datetime64[D] array"""
+    return pd.to_datetime(pd.Series(np.asarray(dates).ravel())).values.astype('datetime64[D]')
+
+
+def get_epiweek_enddates(dates):
+    """Saturday ending the CDC epiweek of each date, datetime64[D] array"""
+    days = to_days(dates)
+    return days + (SATURDAY - days.astype(np.int64)) % 7
+
+
+def get_weeks_ahead(target_end_dates, forecast_date):
+    """Number of the week ahead of forecast_date for each epiweek end date, 1 is the epiweek of forecast_date"""
+    forecast_week_end = get_epiweek_enddates([forecast_date])[0]
+    return (to_days(target_end_dates) - forecast_week_end).astype(np.int64)//7 + 1
+
+
+def get_target_labels(weeks_ahead, target_metric, target_aggr):
+    """Target strings like '1 wk ahead inc death', formatting each distinct week only once"""
+    weeks, codes = np.unique(weeks_ahead, return_inverse=True)
+    categories = ['{week} wk ahead {target_aggr} {target_metric}'.format(week=week,
+                                                                        target_aggr=target_aggr,
+                                                                        target_metric=target_metric)
+                  for week in weeks]
+    return np.asarray(pd.Categorical.from_codes(codes, categories=categories), dtype=object)
+
+
+def validate_against_epiweeks(start='2019-12-01', end='2026-12-31'):
+    """Check the vectorized end dates and week numbers match the epiweeks package day by day"""
+    import epiweeks
+    dates = pd.date_range(start, end)
+    expected = np.array([epiweeks.Week.fromdate(date.date()).enddate() for date in dates], dtype='datetime64[D]')
+    if not (get_epiweek_enddates(dates) == expected).all():
+        raise AssertionError('Epiweek end dates differ from epiweeks between {} and {}'.format(start, end))
+    for forecast_date in dates[::17]:
+        forecast_week_end = epiweeks.Week.fromdate(forecast_date.date()).enddate()
+        expected_weeks = np.array([(end_date.astype(object) - forecast_week_end).days//7 + 1 for end_date in expected])
+        if not (get_weeks_ahead(expected, forecast_date) == expected_weeks).all():
+            raise AssertionError('Weeks ahead of {} differ from epiweeks'.format(forecast_date.date()))
+    return True
@@ -0,0 +1,184 @@
+"""Append only archive of every forecast made, to look up what was forecast for a region on any date.
+Forecasts are parquet files partitioned by forecast date, one row group per region, and a sqlite index gives the file
+and row group of each (region, forecast date) so a query only reads the row groups it needs.
+Daily metrics, betas, breaks and quantiles are stored as typed list columns, one row per region"""
+import os
+import sqlite3
+import datetime as dt
+from contextlib import closing
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ARCHIVE_DIR = 'data_store/archive'
+PART_FILE = 'forecast_date={forecast_date}/part-{created_at}-{pid}.parquet'
+KEY_COLUMNS = ['scope', 'local', 'local_sub_level', 'forecast_date', 'start_date']
+METRIC_COLUMNS = ['death', '7d_avg_death', 'predicted_death', 'lower_bound', 'upper_bound', 'infected',
+                  'symptomatic', 'hospitalized', 'hospital_beds', 'ICU', 'confirmed']
+SCHEMA = pa.schema([('scope', pa.string()),
+                    ('local', pa.string()),
+                    ('local_sub_level', pa.string()),
+                    ('forecast_date', pa.date32()),
+                    ('start_date', pa.date32()),
+                    ('model_beta', pa.list_(pa.float64())),
+                    ('breaks', pa.list_(pa.date32())),
+                    ('quantile_levels', pa.list_(pa.float64())),
+                    ('quantile_targets', pa.list_(pa.string())),
+                    ('quantile_end_dates', pa.list_(pa.date32())),
+                    ('quantile_values', pa.list_(pa.float64()))] +
+                   [(column, pa.list_(pa.float64())) for column in METRIC_COLUMNS])
+
+
+def connect_index(archive_dir=ARCHIVE_DIR):
+    os.makedirs(archive_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(archive_dir, 'index.sqlite'), timeout=60)
+    conn.execute('''CREATE TABLE IF NOT EXISTS forecasts (
+                        scope TEXT NOT NULL,
+                        local TEXT NOT NULL,
+                        local_sub_level TEXT NOT NULL,
+                        forecast_date TEXT NOT NULL,
+                        created_at TEXT NOT NULL,
+                        part_file TEXT NOT NULL,
+                        row_group INTEGER NOT NULL)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS forecasts_region '
+                 'ON forecasts (scope, local, local_sub_level, forecast_date, created_at)')
+    return conn
+
+
+def to_row(scope, local, local_sub_level, forecast_date, daily=None, model_beta=None, breaks=None, quantiles=None):
+    """One archive row.
+    daily: frame of daily metrics indexed by date, METRIC_COLUMNS it does not have are left empty
+    breaks: dates of the break points of the fit, see model_utils.get_policy_effective_dates
+    quantiles: frame indexed by (target, target_end_date) with one column per quantile level"""
+    row = {'scope': scope, 'local': local, 'local_sub_level': local_sub_level,
+           'forecast_date': pd.to_datetime(forecast_date).date(),
+           'start_date': None,
+           'model_beta': None if model_beta is None else np.asarray(model_beta, dtype=np.float64),
+           'breaks': None if breaks is None else [date.date() for date in pd.to_datetime(list(breaks))],
+           'quantile_levels': None, 'quantile_targets': None, 'quantile_end_dates': None, 'quantile_values': None}
+    row.update({column: None for column in METRIC_COLUMNS})
+    if daily is not None:
+        dates = pd.to_datetime(daily.index)
+        daily = daily.set_axis(dates, axis=0).reindex(pd.date_range(dates.min(), dates.max()))
+        row['start_date'] = daily.index[0].date()
+        row.update({column: daily[column].values.astype(np.float64)
+                    for column in METRIC_COLUMNS if column in daily.columns})
+    if quantiles is not None:
+        row['quantile_levels'] = quantiles.columns.values.astype(np.float64)
+        row['quantile_targets'] = quantiles.index.get_level_values(0).tolist()
+        row['quantile_end_dates'] = pd.to_datetime(quantiles.index.get_level_values(1)).date.tolist()
+        row['quantile_values'] = quantiles.values.astype(np.float64).ravel()
+    return row
+
+
+def append_forecasts(rows, archive_dir=ARCHIVE_DIR):
+    """Write rows of to_row in a new part file of each forecast date and index them. Nothing is ever overwritten,
+    a region archived again for the same date shadows the earlier row in queries"""
+    created_at = dt.datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    by_date = {}
+    for row in rows:
+        by_date.setdefault(row['forecast_date'], []).append(row)
+    with closing(connect_index(archive_dir)) as conn:
+        for forecast_date, date_rows in sorted(by_date.items()):
+            part_file = PART_FILE.format(forecast_date=forecast_date, created_at=created_at, pid=os.getpid())
+            path = os.path.join(archive_dir, part_file)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename, readers never see a half written part file
+            with pq.ParquetWriter(path + '.tmp', SCHEMA, compression='zstd') as parquet_writer:
+                for row in date_rows:
+                    parquet_writer.write_table(pa.Table.from_pydict({key: [row[key]] for key in SCHEMA.names},
+                                                                    schema=SCHEMA))
+            os.replace(path + '.tmp', path)
+            conn.executemany('INSERT INTO forecasts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             [(row['scope'], row['local'], row['local_sub_level'], str(forecast_date), created_at,
+                               part_file, row_group) for row_group, row in enumerate(date_rows)])
+            conn.commit()
+
+
+def _values(table, column):
+    """Values of the list cell of a one row table, None when the column was not read or left empty"""
+    if column not in table.column_names or table.column(column).null_count > 0:
+        return None
+    return table.column(column).chunk(0).flatten()
+
+
+def from_row(table):
+    """Archive row read from parquet to a dict of forecast_date, daily frame, model_beta, breaks and quantiles,
+    each None when it was not archived or read"""
+    forecast = {column: table.column(column).to_pylist()[0] for column in KEY_COLUMNS[:4]}
+    model_beta = _values(table, 'model_beta')
+    forecast['model_beta'] = None if model_beta is None else model_beta.to_numpy()
+    breaks = _values(table, 'breaks')
+    forecast['breaks'] = None if breaks is None else pd.to_datetime(breaks.to_pandas())
+    forecast['daily'] = None
+    start_date = table.column('start_date').to_pylist()[0]
+    metrics = {column: _values(table, column) for column in METRIC_COLUMNS}
+    metrics = {column: values.to_numpy(zero_copy_only=False) for column, values in metrics.items()
+               if values is not None}
+    if start_date is not None and metrics:
+        n_days = max(len(values) for values in metrics.values())
+        forecast['daily'] = pd.DataFrame(metrics, index=pd.date_range(start_date, periods=n_days))
+    forecast['quantiles'] = None
+    quantile_values = _values(table, 'quantile_values')
+    if quantile_values is not None:
+        levels = _values(table, 'quantile_levels').to_numpy()
+        index = pd.MultiIndex.from_arrays([_values(table, 'quantile_targets').to_pylist(),
+                                           pd.to_datetime(_values(table, 'quantile_end_dates').to_pandas())],
+                                          names=['target', 'target_end_date'])
+        forecast['quantiles'] = pd.DataFrame(quantile_values.to_numpy().reshape(-1, len(levels)),
+                                             index=index, columns=levels)
+    return forecast
+
+
+def _read(archive_dir, entries, columns=None):
+    if columns is not None:
+        columns = list(dict.fromkeys(KEY_COLUMNS + list(columns)))
+        if any(column.startswith('quantile_') for column in columns):
+            columns = list(dict.fromkeys(columns + ['quantile_levels', 'quantile_targets', 'quantile_end_dates',
+                                                    'quantile_values']))
+    files = {}
+    forecasts = []
+    for part_file, row_group in entries:
+        if part_file not in files:
+            files[part_file] = pq.ParquetFile(os.path.join(archive_dir, part_file))
+        forecasts.append(from_row(files[part_file].read_row_group(row_group, columns=columns)))
+    return forecasts
+
+
+def load_forecasts(scope, local, local_sub_level='All', start_date=None, end_date=None, columns=None,
+                   archive_dir=ARCHIVE_DIR):
+    """Latest archived forecast of a region for each forecast date from start_date to end_date included, in date order.
+    columns: archive columns to read, default all"""
+    if not os.path.exists(os.path.join(archive_dir, 'index.sqlite')):
+        return []
+    start_date = '0000-00-00' if start_date is None else str(pd.to_datetime(start_date).date())
+    end_date = '9999-99-99' if end_date is None else str(pd.to_datetime(end_date).date())
+    with closing(connect_index(archive_dir)) as conn:
+        entries = conn.execute('SELECT part_file, row_group FROM forecasts AS f '
+                               'WHERE scope=? AND local=? AND local_sub_level=? AND forecast_date BETWEEN ? AND ? '
+                               'AND created_at=(SELECT MAX(created_at) FROM forecasts WHERE scope=f.scope '
+                               'AND local=f.local AND local_sub_level=f.local_sub_level '
+                               'AND forecast_date=f.forecast_date) ORDER BY forecast_date',
+                               (scope, local, local_sub_level, start_date, end_date)).fetchall()
+    return _read(archive_dir, entries, columns)
+
+
+def load_forecast(scope, local, local_sub_level='All', forecast_date=None, columns=None, archive_dir=ARCHIVE_DIR):
+    """Latest archived forecast of a region made on forecast_date (default today), None if there is none"""
+    forecast_date = dt.date.today() if forecast_date is None else forecast_date
+    forecasts = load_forecasts(scope, local, local_sub_level, forecast_date, forecast_date, columns, archive_dir)
+    return forecasts[0] if forecasts else None
+
+
+def load_forecast_date(forecast_date, columns=None, archive_dir=ARCHIVE_DIR):
+    """Latest archived forecast of every region made on forecast_date"""
+    if not os.path.exists(os.path.join(archive_dir, 'index.sqlite')):
+        return []
+    with closing(connect_index(archive_dir)) as conn:
+        entries = conn.execute('SELECT part_file, row_group FROM forecasts AS f WHERE forecast_date=? '
+                               'AND created_at=(SELECT MAX(created_at) FROM forecasts WHERE scope=f.scope '
+                               'AND local=f.local AND local_sub_level=f.local_sub_level '
+                               'AND forecast_date=f.forecast_date) ORDER BY part_file, row_group',
+                               (str(pd.to_datetime(forecast_date).date()),)).fetchall()
+    return _read(archive_dir, entries, columns)
@@ -0,0 +1,80 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+import model_utils as mu
+
+# Stages reported by model_utils.get_metrics_by_*, plus 'plot' reported by the app once results are back
+STAGES = ['fetch', 'fit', 'derive', 'plot']
+MAX_WORKERS = 4
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='forecast')
+_jobs = {}
+_jobs_lock = threading.RLock()
+
+
+class ForecastJob(object):
+    """One forecast running on the worker pool, shared by every session asking for the same inputs.
+    The job is cancelled, at the next stage boundary, when the last session waiting on it releases it"""
+
+    def __init__(self, key):
+        self.key = key
+        self.stage = None
+        self.future = None
+        self._cancel_event = threading.Event()
+        self._subscribers = 0
+
+    def report(self, stage):
+        """Progress callback given to the forecast function"""
+        if self._cancel_event.is_set():
+            raise mu.ForecastCancelled('Forecast {} cancelled at stage {}'.format(self.key, stage))
+        # Vaccine adjusted forecasts fit twice, do not let the progress bar go back
+        if self.stage is None or STAGES.index(stage) > STAGES.index(self.stage):
+            self.stage = stage
+
+    @property
+    def progress(self):
+        """Fraction of stages started, between 0 and 1"""
+        if self.stage is None:
+            return 0.
+        return (STAGES.index(self.stage) + 1) / len(STAGES)
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def release(self):
+        """Called by a session that does not need the result anymore"""
+        with _jobs_lock:
+            self._subscribers -= 1
+            if self._subscribers > 0:
+                return
+            self._cancel_event.set()
+            if _jobs.get(self.key) is self:
+                del _jobs[self.key]
+        self.future.cancel()
+
+
+def submit_forecast(key, forecast_fun, *args, **kwargs):
+    """Run forecast_fun(*args, progress=job.report, **kwargs) on the worker pool.
+    key must identify every input of the forecast, including the model_utils rate and time constants. A running job
+    with the same key is shared instead of starting a second identical computation"""
+    with _jobs_lock:
+        job = _jobs.get(key)
+        if job is None:
+            job = ForecastJob(key)
+            job.future = _executor.submit(forecast_fun, *args, progress=job.report, **kwargs)
+            _jobs[key] = job
+            job.future.add_done_callback(lambda _, job=job: _forget(job))
+        job._subscribers += 1
+    return job
+
+
+def _forget(job):
+    with _jobs_lock:
+        if _jobs.get(job.key) is job:
+            del _jobs[job.key]
@@ -0,0 +1,90 @@
+import os
+import pickle
+import sqlite3
+import datetime as dt
+from contextlib import closing
+
+STORE_FILE = 'data_store/forecasts.sqlite'
+
+
+def connect(store_file=STORE_FILE):
+    os.makedirs(os.path.dirname(store_file) or '.', exist_ok=True)
+    conn = sqlite3.connect(store_file, timeout=60)
+    conn.execute('''CREATE TABLE IF NOT EXISTS forecasts (
+                        scope TEXT NOT NULL,
+                        local TEXT NOT NULL,
+                        local_sub_level TEXT NOT NULL,
+                        run_date TEXT NOT NULL,
+                        created_at TEXT NOT NULL,
+                        daily BLOB NOT NULL,
+                        cumulative BLOB NOT NULL,
+                        model_beta BLOB NOT NULL,
+                        PRIMARY KEY (scope, local, local_sub_level, run_date))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS seir_fits (
+                        scope TEXT NOT NULL,
+                        local TEXT NOT NULL,
+                        local_sub_level TEXT NOT NULL,
+                        run_date TEXT NOT NULL,
+                        created_at TEXT NOT NULL,
+                        fit_start_date TEXT NOT NULL,
+                        logbeta REAL NOT NULL,
+                        logkappa REAL NOT NULL,
+                        loggamma REAL NOT NULL,
+                        ssr REAL NOT NULL,
+                        rmse REAL NOT NULL,
+                        residuals BLOB NOT NULL,
+                        warm_start TEXT NOT NULL,
+                        seconds REAL NOT NULL,
+                        PRIMARY KEY (scope, local, local_sub_level, run_date))''')
+    return conn
+
+
+def save_forecast(conn, scope, local, local_sub_level, run_date, daily, cumulative, model_beta):
+    """Store the default forecast of one region, replacing an earlier one of the same run date"""
+    conn.execute('INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                 (scope, local, local_sub_level, str(run_date), dt.datetime.now().isoformat(),
+                  pickle.dumps(daily, protocol=pickle.HIGHEST_PROTOCOL),
+                  pickle.dumps(cumulative, protocol=pickle.HIGHEST_PROTOCOL),
+                  pickle.dumps(model_beta, protocol=pickle.HIGHEST_PROTOCOL)))
+    conn.commit()
+
+
+def load_forecast(scope, local, local_sub_level='All', run_date=None, store_file=STORE_FILE):
+    """Get (daily, cumulative, model_beta) of the default forecast computed on run_date (default today),
+    None when the batch has not stored it"""
+    if not os.path.exists(store_file):
+        return None
+    run_date = dt.date.today() if run_date is None else run_date
+    with closing(sqlite3.connect(store_file, timeout=60)) as conn:
+        row = conn.execute('SELECT daily, cumulative, model_beta FROM forecasts '
+                           'WHERE scope=? AND local=? AND local_sub_level=? AND run_date=?',
+                           (scope, local, local_sub_level, str(run_date))).fetchone()
+    if row is None:
+        return None
+    return tuple(pickle.loads(blob) for blob in row)
+
+
+def save_seir_fit(conn, scope, local, local_sub_level, run_date, fit):
+    """Store the SEIR calibration of one region, a dict of fit_start_date, params, ssr, rmse, residuals, warm_start
+    (where the first start came from) and seconds, replacing an earlier one of the same run date"""
+    conn.execute('INSERT OR REPLACE INTO seir_fits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (scope, local, local_sub_level, str(run_date), dt.datetime.now().isoformat(),
+                  str(fit['fit_start_date']), *[float(param) for param in fit['params']], float(fit['ssr']),
+                  float(fit['rmse']), pickle.dumps(fit['residuals'], protocol=pickle.HIGHEST_PROTOCOL),
+                  fit['warm_start'], float(fit['seconds'])))
+    conn.commit()
+
+
+def load_seir_params(scope, before_date=None, store_file=STORE_FILE):
+    """Latest SEIR parameters (logbeta, logkappa, loggamma) of every region of a scope calibrated before before_date
+    (default any date), by (local, local_sub_level)"""
+    if not os.path.exists(store_file):
+        return {}
+    before_date = '9999-99-99' if before_date is None else str(before_date)
+    with closing(connect(store_file)) as conn:
+        rows = conn.execute('SELECT local, local_sub_level, logbeta, logkappa, loggamma FROM seir_fits AS f '
+                            'WHERE scope=? AND run_date<? AND run_date=(SELECT MAX(run_date) FROM seir_fits '
+                            'WHERE scope=f.scope AND local=f.local AND local_sub_level=f.local_sub_level '
+                            'AND run_date<?)', (scope, before_date, before_date)).fetchall()
+    return {(local, local_sub_level): (logbeta, logkappa, loggamma)
+            for local, local_sub_level, logbeta, logkappa, loggamma in rows}
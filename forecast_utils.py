@@ -1,10 +1,21 @@
 #!/usr/bin/env python
 import argparse
+import os
+import re
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 import numpy as np
 import datetime as dt
 import epiweeks
 import model_utils as mu
+import epiweek_utils as ew
+import batch_utils as bu
+import work_queue as wq
+import forecast_archive as fa
+import tracing
 
 mu.DEATH_RATE = 0.36
 mu.ICU_RATE = 0.78
@@ -18,6 +29,12 @@ mu.NOT_ICU_DISCHARGE_TIME = 5
 
 fips = pd.read_csv('data/locations.csv')
 metric_map = {'death': 'predicted_death'}
+SHARD_DIR = 'data_processed/shards/{scope}-{forecast_date}'
+BATCH_DIR = 'data_processed/batches/{batch_id}/{task_id}'
+TOP_COUNTRY_LIST = ['US', 'India', 'Brazil', 'Russia', 'France', 'United Kingdom', 'Turkey', 'Italy', 'Spain',
+                    'Germany', 'Colombia', 'Argentina', 'Mexico', 'Poland', 'Iran', 'Iraq', 'Ukraine',
+                    'South Africa', 'Peru', 'Netherlands', 'Belgium', 'Chile', 'Romania', 'Canada',
+                    'Ecuador', 'Czechia', 'Pakistan', 'Hungary', 'Philippines', 'Switzerland']
 
 
 def get_epiweek_enddate(x):
@@ -33,76 +50,59 @@ def get_target_str(target_end_date, forecast_date, target_metric, target_aggr):
     return target
 
 
-def get_weekly_from_7day_avg(df):
-    output = df.iloc[[-1]]
-    output['value'] = output.value*7
-    return output
+LOWER_QUANTILES = np.array([0.010, 0.025, 0.050, 0.100, 0.150, 0.200, 0.250, 0.300, 0.350, 0.400, 0.450])
+UPPER_QUANTILES = np.array([0.550, 0.600, 0.650, 0.700, 0.750, 0.800, 0.850, 0.900, 0.950, 0.975, 0.990])
+# Rows of each target in the submission, in the order they are written
+QUANTILE_LABELS = np.array(LOWER_QUANTILES.tolist() + [0.500] + UPPER_QUANTILES.tolist() + ['NA'], dtype=object)
+TYPE_LABELS = np.array(['quantile'] * (len(LOWER_QUANTILES) + 1 + len(UPPER_QUANTILES)) + ['point'], dtype=object)
 
 
-def get_forecast_upper_quantile(input_forecast, quantile):
+def get_quantile_scales():
+    """Distance of each quantile from the median, in units of the 95% half interval"""
     import scipy.stats as stats
-    input_forecast['upper_bound_new'] = input_forecast.value + \
-                                        (input_forecast.upper_bound - input_forecast.value) * \
-                                        (stats.norm.ppf(quantile)/stats.norm.ppf(0.975))
-    output_ub = input_forecast[['forecast_date', 'target', 'target_end_date', 'upper_bound_new', 'location']]
-    output_ub.rename(columns={'upper_bound_new': 'value'}, inplace=True)
-    output_ub['quantile'] = quantile
-    output_ub['type'] = 'quantile'
-    return output_ub
-
-
-def get_forecast_lower_quantile(input_forecast, quantile):
-    import scipy.stats as stats
-    input_forecast['lower_bound_new'] = (input_forecast.value -
-                                        (input_forecast.value - input_forecast.lower_bound) *
-                                        (stats.norm.ppf(1-quantile)/stats.norm.ppf(0.975))).clip(lower=0)
-    output_lb = input_forecast[['forecast_date', 'target', 'target_end_date', 'lower_bound_new', 'location']]
-    output_lb.rename(columns={'lower_bound_new': 'value'}, inplace=True)
-    output_lb['quantile'] = quantile
-    output_lb['type'] = 'quantile'
-    return output_lb
+    half_interval = stats.norm.ppf(0.975)
+    return stats.norm.ppf(1-LOWER_QUANTILES)/half_interval, stats.norm.ppf(UPPER_QUANTILES)/half_interval
 
 
+@tracing.traced('format_forecast')
 def format_forecast(input_forecast, 
                     location_name, 
                     forecast_date,
                     target_metric,
                     target_aggr):
     forecast_date = pd.to_datetime(forecast_date).date()
-    input_forecast['target_end_date'] = input_forecast.date.apply(get_epiweek_enddate)
-    input_forecast['target'] = input_forecast.target_end_date.apply(get_target_str, args=(forecast_date,
-                                                                                          target_metric,
-                                                                                          target_aggr))
-    input_forecast['forecast_date'] = forecast_date
-    input_forecast['location'] = fips.query('location_name == @location_name').location.iloc[0]
-    input_forecast['quantile'] = 'NA'
-    input_forecast['type'] = 'point'
-    input_forecast.rename(columns={metric_map[target_metric]: 'value'}, inplace=True)
+    target_end_dates = pd.Series(ew.get_epiweek_enddates(input_forecast.date))
+    # Weekly value is 7 times the 7 day average at the end of the epiweek, last row of each week
+    week_last_rows = ~target_end_dates.duplicated(keep='last').values
+    weekly = input_forecast[week_last_rows]
+    weekly = weekly.assign(target_end_date=target_end_dates[week_last_rows].dt.date.values,
+                           target=ew.get_target_labels(ew.get_weeks_ahead(target_end_dates[week_last_rows],
+                                                                          forecast_date),
+                                                       target_metric, target_aggr))\
+        .sort_values('target', kind='mergesort')
+    value = weekly[metric_map[target_metric]].values
     # Adjust CI from daily to weekly
-    input_forecast['lower_bound'] = (input_forecast.value - \
-                                       (input_forecast.value - input_forecast.lower_bound)*np.sqrt(7)).clip(lower=0)
-    input_forecast['upper_bound'] = input_forecast.value + \
-                                       (input_forecast.upper_bound - input_forecast.value)*np.sqrt(7)
-
-    output = input_forecast[['forecast_date', 'target', 'target_end_date', 'quantile', 'type', 'value', 'location']]
-
-    output_md = input_forecast[['forecast_date', 'target', 'target_end_date', 'value', 'location']]
-    output_md['quantile'] = 0.500
-    output_md['type'] = 'quantile'
-
-    output = pd.concat([output, output_md])
-    for quantile in [0.010, 0.025, 0.050, 0.100, 0.150, 0.200, 0.250, 0.300, 0.350, 0.400, 0.450]:
-        output_lb = get_forecast_lower_quantile(input_forecast, quantile)
-        output = pd.concat([output, output_lb])
-    for quantile in [0.550, 0.600, 0.650, 0.700, 0.750, 0.800, 0.850, 0.900, 0.950, 0.975, 0.990]:
-        output_ub = get_forecast_upper_quantile(input_forecast, quantile)
-        output = pd.concat([output, output_ub])
-    return output.groupby(['forecast_date', 'target', 'target_end_date', 'quantile', 'type', 'location'],
-                          group_keys=False)\
-        .apply(get_weekly_from_7day_avg)\
-        .reset_index(drop=True).query('target_end_date>forecast_date')
+    lower_bound = (value - (value - weekly.lower_bound.values)*np.sqrt(7)).clip(min=0)
+    upper_bound = value + (weekly.upper_bound.values - value)*np.sqrt(7)
+    lower_scales, upper_scales = get_quantile_scales()
+    values = np.concatenate([
+        (value[:, None] - (value - lower_bound)[:, None]*lower_scales[None, :]).clip(min=0),
+        value[:, None],
+        value[:, None] + (upper_bound - value)[:, None]*upper_scales[None, :],
+        value[:, None]], axis=1)*7
 
+    n_weeks, n_rows = values.shape
+    output = pd.DataFrame({'forecast_date': forecast_date,
+                           'target': np.repeat(weekly.target.values, n_rows),
+                           'target_end_date': np.repeat(weekly.target_end_date.values, n_rows),
+                           'quantile': np.tile(QUANTILE_LABELS, n_weeks),
+                           'type': np.tile(TYPE_LABELS, n_weeks),
+                           'value': values.ravel(),
+                           'location': fips.query('location_name == @location_name').location.iloc[0]})
+    return output[np.repeat(weekly.target_end_date.values > forecast_date, n_rows)]
 
+
+@tracing.traced('generate_formatted_forecast')
 def generate_formatted_forecast(scope,
                                 location_name,
                                 forecast_date,
@@ -113,7 +113,7 @@ def generate_formatted_forecast(scope,
         forecast_fun = mu.get_metrics_by_country
         policy_date_fun = mu.get_policy_change_dates_by_country
     else:
-        forecast_fun = mu.get_metrics_by_state_US
+        forecast_fun = mu.get_metrics_by_state
         policy_date_fun = mu.get_policy_change_dates_by_state_US
     input_forecast, _, _ = forecast_fun(location_name, 
                                         forecast_horizon=60,
@@ -131,57 +131,247 @@ def add_cum_forecast(inc_forecast, last_epi_week_cum):
     return pd.concat([inc_forecast, cum_forecast])
 
 
-def generate_US_formatted_forecast(forecast_date, target_metric='death', target_aggr='inc'):
+@tracing.flushed
+def forecast_location(scope, location_name, forecast_date):
+    """Formatted incident and cumulative forecast of one location, and the seconds it took"""
+    start = time.time()
     forecast_date = pd.to_datetime(forecast_date).date()
-    last_epiweek_enddate = get_epiweek_enddate(forecast_date+epiweeks.timedelta(-7))
-    US_forecast = pd.DataFrame()
-    US_state_list = mu.get_data(scope='US', type='deaths').State.unique()
+    with tracing.span('forecast_location', scope=scope, location=location_name, forecast_date=str(forecast_date)):
+        last_epiweek_enddate = pd.Timestamp(get_epiweek_enddate(forecast_date+epiweeks.timedelta(-7)))
+        location_forecast = generate_formatted_forecast(scope, location_name, forecast_date)\
+            .query('target!="9 wk ahead inc death"')
+        if scope == 'World':
+            latest_cum = mu.get_data_by_country(location_name).loc[last_epiweek_enddate][0]
+        else:
+            latest_cum = mu.get_data_by_state(location_name).loc[last_epiweek_enddate][0]
+        location_forecast = add_cum_forecast(location_forecast, latest_cum)
+    return location_forecast, time.time() - start
 
-    for state in US_state_list:
-        try:
-            print(state)
-            state_forecast = generate_formatted_forecast('US', state, forecast_date)\
-                .query('target!="9 wk ahead inc death"')
-            latest_cum_state = mu.get_data_by_state(state).loc[last_epiweek_enddate][0]
-            state_forecast = add_cum_forecast(state_forecast, latest_cum_state)
-            US_forecast = pd.concat([US_forecast, state_forecast])
-        except (ValueError, IndexError):
-            pass
-    # Aggregate all states for US forecast
-    US_forecast_new = US_forecast.groupby(
-        ['forecast_date', 'target', 'target_end_date', 'quantile', 'type']).sum().reset_index()
-    US_forecast_new['location'] = "US"
-    US_forecast_new = pd.concat([US_forecast_new, US_forecast])
-    US_forecast_new.to_csv('data_processed/{}-AIpert-pwllnod.csv'.format(forecast_date), index=False)
-
-
-def generate_world_formatted_forecast(forecast_date, target_metric='death', target_aggr='inc'):
-    world_forecast = pd.DataFrame()
+
+def get_shard_file(shard_dir, location):
+    return os.path.join(shard_dir, re.sub(r'[^\w.-]', '_', location) + '.pkl')
+
+
+def load_manifest(shard_dir):
+    """Locations done, with their shard file and seconds, and failed, with the error and traceback"""
+    try:
+        with open(os.path.join(shard_dir, 'manifest.json')) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {'done': {}, 'failed': {}}
+
+
+def save_manifest(shard_dir, manifest):
+    # Write then rename, a crash never leaves a half written manifest
+    tmp_file = os.path.join(shard_dir, 'manifest.json.tmp')
+    with open(tmp_file, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(tmp_file, os.path.join(shard_dir, 'manifest.json'))
+
+
+def get_timings(manifest, locations):
+    """Seconds and error of each location from a batch manifest"""
+    timings = [(location, manifest['done'][location]['seconds'], '') if location in manifest['done'] else
+               (location, np.nan, manifest['failed'][location]['error'])
+               for location in locations if location in manifest['done'] or location in manifest['failed']]
+    return pd.DataFrame(timings, columns=['location', 'seconds', 'error'])
+
+
+def merge_shards(shard_dir, locations, manifest):
+    """Forecasts of every done location, in the order given"""
+    forecasts = [pd.read_pickle(os.path.join(shard_dir, manifest['done'][location]['shard']))
+                 for location in locations if location in manifest['done']]
+    return pd.concat(forecasts) if forecasts else pd.DataFrame()
+
+
+def run_forecast_batch(scope, locations, forecast_date, n_jobs=None, shard_dir=None, resume=True):
+    """Forecast all locations on a process pool. Input data is downloaded once and shared with the workers through
+    shared memory instead of each location downloading it again.
+    Each location is written to its own shard as soon as it is done and recorded in the manifest of shard_dir, with
+    the error of failed locations. With resume, locations already done in shard_dir are not forecasted again.
+    out: forecasts of all locations in the order given, timings and errors by location"""
     forecast_date = pd.to_datetime(forecast_date).date()
-    last_epiweek_enddate = get_epiweek_enddate(forecast_date+epiweeks.timedelta(-7))
-    country_list = mu.get_data(scope='global', type='deaths').Country.unique()
-    top_country_list = ['US', 'India', 'Brazil', 'Russia', 'France', 'United Kingdom', 'Turkey', 'Italy', 'Spain',
-                        'Germany', 'Colombia', 'Argentina', 'Mexico', 'Poland', 'Iran', 'Iraq', 'Ukraine',
-                        'South Africa', 'Peru', 'Netherlands', 'Belgium', 'Chile', 'Romania', 'Canada',
-                        'Ecuador', 'Czechia', 'Pakistan', 'Hungary', 'Philippines', 'Switzerland']
-
-    for country in top_country_list:
+    shard_dir = SHARD_DIR.format(scope=scope, forecast_date=forecast_date) if shard_dir is None else shard_dir
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest = load_manifest(shard_dir) if resume else {'done': {}, 'failed': {}}
+    todo = [location for location in locations
+            if location not in manifest['done'] or not os.path.exists(get_shard_file(shard_dir, location))]
+    print('{} locations to forecast, {} already done'.format(len(todo), len(locations) - len(todo)))
+    if todo:
+        with tracing.span('preload', scope=scope):
+            mu.preload_data([scope])
+            blocks, specs = bu.share_data_cache()
         try:
-            print(country)
-            country_forecast = generate_formatted_forecast('World', country, forecast_date)\
-                .query('target!="9 wk ahead inc death"')
-            latest_cum_country = mu.get_data_by_country(country).loc[last_epiweek_enddate][0]
-            country_forecast = add_cum_forecast(country_forecast, latest_cum_country)
-            world_forecast = pd.concat([world_forecast, country_forecast])
-        except (ValueError, IndexError):
-            pass
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=bu.init_worker,
+                                     initargs=(specs, mu.get_params())) as executor:
+                futures = {executor.submit(forecast_location, scope, location, forecast_date): location
+                           for location in todo}
+                for future in as_completed(futures):
+                    location = futures[future]
+                    try:
+                        location_forecast, seconds = future.result()
+                    except Exception as e:
+                        print('{}: failed {!r}'.format(location, e))
+                        manifest['done'].pop(location, None)
+                        manifest['failed'][location] = {
+                            'error': repr(e),
+                            'traceback': ''.join(traceback.format_exception(type(e), e, e.__traceback__))}
+                    else:
+                        shard_file = get_shard_file(shard_dir, location)
+                        location_forecast.to_pickle(shard_file)
+                        print('{}: {:.1f}s'.format(location, seconds))
+                        manifest['failed'].pop(location, None)
+                        manifest['done'][location] = {'shard': os.path.basename(shard_file), 'seconds': seconds}
+                    save_manifest(shard_dir, manifest)
+        finally:
+            bu.release(blocks)
+    return merge_shards(shard_dir, locations, manifest), get_timings(manifest, locations)
+
 
-    world_forecast.to_csv('data_processed/World-{}-AIpert-pwllnod.csv'.format(forecast_date), index=False)
+def get_locations(scope):
+    """Locations of a submission file"""
+    if scope == 'World':
+        return TOP_COUNTRY_LIST
+    return mu.get_data(scope='US', type='deaths').State.unique().tolist()
+
+
+def save_formatted_forecast(scope, forecast, timings, forecast_date):
+    if scope == 'World':
+        forecast_file = 'data_processed/World-{}-AIpert-pwllnod.csv'.format(forecast_date)
+    else:
+        # Aggregate all states for US forecast
+        US_forecast = forecast.groupby(
+            ['forecast_date', 'target', 'target_end_date', 'quantile', 'type']).sum().reset_index()
+        US_forecast['location'] = "US"
+        forecast = pd.concat([US_forecast, forecast])
+        forecast_file = 'data_processed/{}-AIpert-pwllnod.csv'.format(forecast_date)
+    forecast.to_csv(forecast_file, index=False)
+    timings.to_csv(forecast_file.replace('.csv', '-timings.csv'), index=False)
+    archive_formatted_forecast(scope, forecast, forecast_date)
+
+
+def archive_formatted_forecast(scope, forecast, forecast_date, archive_dir=fa.ARCHIVE_DIR):
+    """Add the quantiles of every location of a submission to the forecast archive, under the location name"""
+    quantiles = forecast[forecast['type'] == 'quantile']\
+        .set_index(['location', 'target', 'target_end_date', 'quantile']).value.unstack('quantile')
+    location_names = fips.drop_duplicates('location').set_index('location').location_name
+    fa.append_forecasts([fa.to_row(scope, location_names.get(location, location), 'All', forecast_date,
+                                   quantiles=location_quantiles.droplevel('location'))
+                         for location, location_quantiles in quantiles.groupby(level='location', sort=False)],
+                        archive_dir)
+
+
+def generate_US_formatted_forecast(forecast_date, target_metric='death', target_aggr='inc', n_jobs=None, resume=True):
+    forecast_date = pd.to_datetime(forecast_date).date()
+    US_forecast, timings = run_forecast_batch('US', get_locations('US'), forecast_date, n_jobs, resume=resume)
+    save_formatted_forecast('US', US_forecast, timings, forecast_date)
+
+
+def generate_world_formatted_forecast(forecast_date, target_metric='death', target_aggr='inc', n_jobs=None,
+                                      resume=True):
+    forecast_date = pd.to_datetime(forecast_date).date()
+    world_forecast, timings = run_forecast_batch('World', get_locations('World'), forecast_date, n_jobs,
+                                                 resume=resume)
+    save_formatted_forecast('World', world_forecast, timings, forecast_date)
+
+
+def get_batch_id(scope, forecast_date):
+    return '{}-{}'.format(scope, pd.to_datetime(forecast_date).date())
+
+
+def enqueue_forecast_batch(queue_file, scope, forecast_date, shard_size=5):
+    """Split the locations of a submission into tasks of shard_size locations on the work queue"""
+    locations = get_locations(scope)
+    batch_id = get_batch_id(scope, forecast_date)
+    wq.WorkQueue(queue_file).add_tasks(batch_id, [{'locations': locations[start:start+shard_size]}
+                                                  for start in range(0, len(locations), shard_size)])
+    print('{}: {} locations in tasks of {}'.format(batch_id, len(locations), shard_size))
+    return batch_id
+
+
+def run_forecast_worker(queue_file, scope, forecast_date, n_jobs=None, lease_seconds=900, max_attempts=3):
+    """Lease tasks of a batch from the work queue and forecast them until none is left. Start as many workers as
+    needed, on any machine seeing queue_file and data_processed. A task that a dead worker left half done is resumed
+    from its shards by the next worker"""
+    queue = wq.WorkQueue(queue_file)
+    worker_id = wq.get_worker_id()
+    batch_id = get_batch_id(scope, forecast_date)
+    while True:
+        task = queue.lease(batch_id, worker_id, lease_seconds)
+        if task is None:
+            break
+        task_id, payload = task
+        print('{} leased {} {}'.format(worker_id, task_id, payload['locations']))
+        with wq.LeaseKeeper(queue, batch_id, task_id, worker_id, lease_seconds) as lease_keeper:
+            try:
+                _, timings = run_forecast_batch(scope, payload['locations'], forecast_date, n_jobs,
+                                                shard_dir=BATCH_DIR.format(batch_id=batch_id, task_id=task_id))
+            except Exception as e:
+                queue.fail(batch_id, task_id, worker_id, repr(e), max_attempts)
+                continue
+        if lease_keeper.lost:
+            continue
+        failed = timings[timings.error != '']
+        if len(failed) > 0:
+            queue.fail(batch_id, task_id, worker_id, '; '.join(failed.location + ': ' + failed.error), max_attempts)
+        else:
+            queue.complete(batch_id, task_id, worker_id)
+    print('{} done, {}'.format(worker_id, queue.status(batch_id)))
+
+
+def merge_forecast_batch(queue_file, scope, forecast_date, allow_partial=False):
+    """Merge the shards of every task of a batch into the submission file.
+    The US row sums the states, so a batch with tasks not done is refused unless allow_partial"""
+    batch_id = get_batch_id(scope, forecast_date)
+    tasks = wq.WorkQueue(queue_file).tasks(batch_id)
+    if len(tasks) == 0:
+        raise ValueError('No task in batch {}, enqueue it first'.format(batch_id))
+    not_done = [task for task in tasks if task[2] != wq.DONE]
+    for task_id, _, status, _, attempts, error in not_done:
+        print('{} {} after {} attempts: {}'.format(task_id, status, attempts, error))
+    if not_done and not allow_partial:
+        raise ValueError('{} of {} tasks of batch {} not done, run the workers again or merge with allow_partial'
+                         .format(len(not_done), len(tasks), batch_id))
+    forecasts, timings = [], []
+    for task_id, payload, status, worker_id, attempts, error in tasks:
+        shard_dir = BATCH_DIR.format(batch_id=batch_id, task_id=task_id)
+        manifest = load_manifest(shard_dir)
+        forecasts.append(merge_shards(shard_dir, payload['locations'], manifest))
+        timings.append(get_timings(manifest, payload['locations']))
+    save_formatted_forecast(scope, pd.concat(forecasts), pd.concat(timings), pd.to_datetime(forecast_date).date())
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate US formatted forecast file')
     parser.add_argument('-d', '--date', default=dt.date.today(), help='date to run forecast, usually Monday,'
                                                                       ' default to today')
+    parser.add_argument('-s', '--scope', default='US', choices=['US', 'World'])
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes, default to CPUs')
+    parser.add_argument('--no-resume', action='store_true', help='forecast again locations done in an earlier run')
+    parser.add_argument('-q', '--queue', default=None, help='sqlite work queue file shared by several machines')
+    parser.add_argument('-m', '--mode', default='work', choices=['enqueue', 'work', 'merge'],
+                        help='with --queue: add the tasks, run a worker or merge the results')
+    parser.add_argument('--allow-partial', action='store_true',
+                        help='with --mode merge, write the submission even if some tasks are not done, the US row '
+                             'then misses their states')
+    parser.add_argument('--shard-size', type=int, default=5, help='locations per task of the work queue')
+    parser.add_argument('--trace', default=None, help='JSON lines file of the timing spans of every stage, '
+                                                      '{pid} is replaced by the process id, see tracing.py')
+    parser.add_argument('--trace-memory', type=int, nargs='?', const=tracing.MEMORY_FRAMES, default=0,
+                        metavar='FRAMES', help='with --trace, also record the memory allocated and the peak RSS of '
+                                               'every stage and the call sites holding the most memory for each '
+                                               'location, FRAMES deep in the allocation tracebacks')
     args = parser.parse_args()
-    generate_US_formatted_forecast(forecast_date=args.date)
+    if args.trace is not None:
+        tracing.enable(args.trace, memory=args.trace_memory)
+    if args.queue is None:
+        if args.scope == 'World':
+            generate_world_formatted_forecast(forecast_date=args.date, n_jobs=args.jobs, resume=not args.no_resume)
+        else:
+            generate_US_formatted_forecast(forecast_date=args.date, n_jobs=args.jobs, resume=not args.no_resume)
+    elif args.mode == 'enqueue':
+        enqueue_forecast_batch(args.queue, args.scope, args.date, args.shard_size)
+    elif args.mode == 'work':
+        run_forecast_worker(args.queue, args.scope, args.date, n_jobs=args.jobs)
+    else:
+        merge_forecast_batch(args.queue, args.scope, args.date, allow_partial=args.allow_partial)
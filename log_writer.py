@@ -0,0 +1,126 @@
+import os
+import glob
+import time
+import atexit
+import datetime as dt
+import threading
+import queue
+from csv import writer
+
+try:
+    import fcntl
+except ImportError:  # Windows, no advisory lock between processes
+    fcntl = None
+
+
+class LogWriter(object):
+    """Background csv log writer.
+    Rows are put on a queue and written by one daemon thread in batches, so callers (the app request thread) never
+    wait on disk I/O. Each batch is appended under an exclusive lock on '<log_file>.lock', which makes appends and
+    rotation safe when several app processes share the same logs folder.
+    max_bytes: rotate a log file when it grows over this size, None to disable
+    rotate_when: 'daily' to rotate a log file on the first write of a new day, None to disable
+    backup_count: number of rotated files to keep for each log file"""
+
+    def __init__(self, flush_interval=1.0, batch_size=500, max_bytes=10*1024*1024, rotate_when='daily',
+                 backup_count=30):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.rotate_when = rotate_when
+        self.backup_count = backup_count
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, row, log_file):
+        self._queue.put((log_file, list(row)))
+
+    def close(self, timeout=5):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            if batch:
+                self._write_batch(batch)
+            elif self._stop.is_set():
+                return
+
+    def _get_batch(self):
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0 or self._stop.is_set():
+                timeout = 0
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch):
+        rows_by_file = {}
+        for log_file, row in batch:
+            rows_by_file.setdefault(log_file, []).append(row)
+        for log_file, rows in rows_by_file.items():
+            try:
+                with _file_lock(log_file + '.lock'):
+                    self._rotate_if_needed(log_file)
+                    with open(log_file, 'a+', newline='') as write_obj:
+                        writer(write_obj).writerows(rows)
+            except OSError as e:
+                # Logging must never take the app down, report and drop this batch
+                print('Cannot write {} rows to {}: {}'.format(len(rows), log_file, e))
+
+    def _rotate_if_needed(self, log_file):
+        try:
+            stat = os.stat(log_file)
+        except FileNotFoundError:
+            return
+        too_big = self.max_bytes is not None and stat.st_size >= self.max_bytes
+        new_day = self.rotate_when == 'daily' and \
+            dt.date.fromtimestamp(stat.st_mtime) < dt.date.today()
+        if not (too_big or new_day):
+            return
+        os.rename(log_file, '{}.{}'.format(log_file, dt.datetime.now().strftime('%Y%m%d-%H%M%S-%f')))
+        backups = sorted(glob.glob(glob.escape(log_file) + '.[0-9]*'))
+        for old_backup in backups[:max(len(backups) - self.backup_count, 0)]:
+            os.remove(old_backup)
+
+
+class _file_lock(object):
+    """Exclusive advisory lock held on a sidecar file, no-op where fcntl is not available"""
+
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._fd = open(self.lock_file, 'a')
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
+
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    """One shared writer per process, started on first use and flushed at interpreter exit"""
+    global _log_writer
+    with _log_writer_lock:
+        if _log_writer is None:
+            _log_writer = LogWriter()
+            atexit.register(_log_writer.close)
+    return _log_writer
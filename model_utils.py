@@ -25,10 +25,14 @@ import json
 import matplotlib.pyplot as plt
 import numpy as np
 import datetime as dt
-from sklearn import linear_model
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-import pwlf_mod as pwlf
-from csv import writer
+import death_kernel as dk
+import SEIR as seir
+import tracing
+from log_writer import get_log_writer
 
 #DEATH_RATE = 0.01
 #ICU_RATE = 0.05
@@ -40,14 +44,91 @@ from csv import writer
 #ICU_2_RECOVER_TIME = 11
 #NOT_ICU_DISCHARGE_TIME = 7
 
+# Default assumptions used by the app for each scope, see the 'Về mô hình' section in app.py
+DEFAULT_PARAMS = {
+    'World': {'DEATH_RATE': 0.36, 'ICU_RATE': 0.78, 'HOSPITAL_RATE': 2.18, 'SYMPTOM_RATE': 10.2,
+              'INFECT_2_HOSPITAL_TIME': 11, 'HOSPITAL_2_ICU_TIME': 4, 'ICU_2_DEATH_TIME': 4, 'ICU_2_RECOVER_TIME': 7,
+              'NOT_ICU_DISCHARGE_TIME': 5},
+    'US': {'DEATH_RATE': 0.36, 'ICU_RATE': 0.78, 'HOSPITAL_RATE': 2.18, 'SYMPTOM_RATE': 10.2,
+           'INFECT_2_HOSPITAL_TIME': 11, 'HOSPITAL_2_ICU_TIME': 4, 'ICU_2_DEATH_TIME': 4, 'ICU_2_RECOVER_TIME': 7,
+           'NOT_ICU_DISCHARGE_TIME': 5},
+    'VN': {'DEATH_RATE': 1.25, 'ICU_RATE': 3.75, 'HOSPITAL_RATE': 7.5, 'SYMPTOM_RATE': 12.5,
+           'INFECT_2_HOSPITAL_TIME': 11, 'HOSPITAL_2_ICU_TIME': 4, 'ICU_2_DEATH_TIME': 4, 'ICU_2_RECOVER_TIME': 7,
+           'NOT_ICU_DISCHARGE_TIME': 5},
+}
 
+POPULATION_URL = \
+    'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/UID_ISO_FIPS_LookUp_Table.csv'
+VACCINATION_WORLD_URL = \
+    "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/vaccinations/vaccinations.csv"
+VACCINATION_US_URL = \
+    "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/vaccinations/us_state_vaccinations.csv"
+
+# Downloaded csv files are kept here when enable_data_cache() is called, for batch jobs running many regions
+DATA_CACHE = None
+
+
+def set_params(params):
+    """Set the model rates and times, a dict like DEFAULT_PARAMS['World']"""
+    globals().update(params)
+
+
+def get_params():
+    """Current model rates and times, same keys as DEFAULT_PARAMS"""
+    return {name: globals().get(name) for name in DEFAULT_PARAMS['World']}
+
+
+def enable_data_cache():
+    """Download every data file only once in this process. Do not use in the app, data is refreshed daily"""
+    global DATA_CACHE
+    if DATA_CACHE is None:
+        DATA_CACHE = {}
+
+
+def preload_data(scopes=('World', 'US', 'VN')):
+    """Enable the data cache and download every input of a scope once, before forking batch workers"""
+    enable_data_cache()
+    for scope in scopes:
+        for data_type in ['deaths', 'confirmed']:
+            get_data(scope={'World': 'global'}.get(scope, scope), type=data_type)
+    if 'World' in scopes or 'US' in scopes:
+        read_csv(POPULATION_URL)
+    if 'World' in scopes:
+        read_csv(VACCINATION_WORLD_URL, error_bad_lines=False)
+    if 'US' in scopes:
+        read_csv(VACCINATION_US_URL, error_bad_lines=False)
+
+
+def read_csv(path, **kwargs):
+    if DATA_CACHE is None:
+        with tracing.span('read_csv', path=path):
+            return pd.read_csv(path, **kwargs)
+    key = (path, tuple(sorted(kwargs.items())))
+    if key not in DATA_CACHE:
+        with tracing.span('read_csv', path=path):
+            DATA_CACHE[key] = pd.read_csv(path, **kwargs)
+    return DATA_CACHE[key]
+
+
+class ForecastCancelled(Exception):
+    """Raised from a progress callback to stop a forecast that is no longer needed"""
+
+
+def report_progress(progress, stage):
+    """Tell the caller which stage the forecast pipeline is in: 'fetch', 'fit' or 'derive'.
+    The callback can raise ForecastCancelled to stop the computation at this point"""
+    if progress is not None:
+        progress(stage)
+
+
+@tracing.traced('get_population')
 def get_population(scope='World', local='US', local_sub_level='All'):
     """
     scope: 'World' or 'US'
     local: Country or US State, depend on scope
     local_sub_level: one level below local
     """
-    raw_data = pd.read_csv('https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/UID_ISO_FIPS_LookUp_Table.csv')
+    raw_data = read_csv(POPULATION_URL)
     if scope == 'World':
         if local_sub_level == 'All':
             local_pop = raw_data.query('Combined_Key == "{}"'.format(local))
@@ -61,6 +142,7 @@ def get_population(scope='World', local='US', local_sub_level='All'):
     return int(local_pop.Population.iloc[0])
 
 
+@tracing.traced('get_projected_pct_fully_vaccinated')
 def get_projected_pct_fully_vaccinated(scope='US', local='California', local_sub_level='All', forecast_horizon=60):
     """
     scope: 'World' or 'US'
@@ -71,15 +153,10 @@ def get_projected_pct_fully_vaccinated(scope='US', local='California', local_sub
         local = 'United States'
     if local == 'New York':
         local = 'New York State'
-    world_url = \
-        "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/vaccinations/vaccinations.csv"
-    us_url = \
-        "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/vaccinations/us_state_vaccinations.csv"
-
     if scope == 'World':
-        raw_data = pd.read_csv(world_url, error_bad_lines=False).set_index('date')
+        raw_data = read_csv(VACCINATION_WORLD_URL, error_bad_lines=False).set_index('date')
     else:
-        raw_data = pd.read_csv(us_url, error_bad_lines=False).set_index('date')
+        raw_data = read_csv(VACCINATION_US_URL, error_bad_lines=False).set_index('date')
     vaccinated = raw_data.query('location == "{}"'.format(local)).people_fully_vaccinated_per_hundred
     vaccinated.index = pd.to_datetime(vaccinated.index)
     delay_days = 0
@@ -97,6 +174,7 @@ def get_projected_pct_fully_vaccinated(scope='US', local='California', local_sub
                     .people_fully_vaccinated_per_hundred
 
 
+@tracing.traced('get_data')
 def get_data(file_template='https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_{type}_{scope}.csv',
              type='deaths', scope='global'):
     """
@@ -105,7 +183,7 @@ def get_data(file_template='https://raw.githubusercontent.com/CSSEGISandData/COV
     """
     if scope == 'VN':
         file_template = 'data/time_series_covid19_{type}_{scope}.csv'
-    csv_data = pd.read_csv(file_template.format(type=type, scope=scope), error_bad_lines=False)
+    csv_data = read_csv(file_template.format(type=type, scope=scope), error_bad_lines=False)
     return csv_data.rename(index=str, columns={"Country/Region": "Country",
                                                  "Province/State": "State",
                                                  "Country_Region": "Country",
@@ -121,6 +199,7 @@ def get_US_State_hospital_cap_data(file_template='data/Hospital_Capacity_by_Stat
     return csv_data
 
 
+@tracing.traced('process_local_data')
 def process_local_data(local_data):
     local_data.index = pd.to_datetime(local_data.index)
     # Remove non positive value
@@ -132,21 +211,23 @@ def process_local_data(local_data):
 
 def get_data_by_country(country, state='All', type='deaths'):
     global_data = get_data(scope='global', type=type)
-    if state == 'All':
-        local_data = global_data.query('Country == "{}"'.format(country)).iloc[:,4:].T.sum(axis=1).to_frame()
-    else:
-        local_data = global_data.query('Country == "{}" and State == "{}"'.format(country, state))\
-                         .iloc[:, 4:].T.sum(axis=1).to_frame()
+    with tracing.span('query', type=type):
+        if state == 'All':
+            local_data = global_data.query('Country == "{}"'.format(country)).iloc[:,4:].T.sum(axis=1).to_frame()
+        else:
+            local_data = global_data.query('Country == "{}" and State == "{}"'.format(country, state))\
+                             .iloc[:, 4:].T.sum(axis=1).to_frame()
     return process_local_data(local_data)
 
 
 def get_data_by_state(state, county='All', scope='US', type='deaths'):
     states_data = get_data(scope=scope, type=type)
-    if county == 'All':
-        local_data = states_data.query('State == "{}"'.format(state)).iloc[:, 12:].T.sum(axis=1).to_frame()
-    else:
-        local_data = states_data.query('State == "{}" and County == "{}"'.format(state, county))\
-                         .iloc[:, 12:].T.sum(axis=1).to_frame()
+    with tracing.span('query', type=type):
+        if county == 'All':
+            local_data = states_data.query('State == "{}"'.format(state)).iloc[:, 12:].T.sum(axis=1).to_frame()
+        else:
+            local_data = states_data.query('State == "{}" and County == "{}"'.format(state, county))\
+                             .iloc[:, 12:].T.sum(axis=1).to_frame()
     return process_local_data(local_data)
 
 
@@ -183,6 +264,18 @@ def get_policy_change_dates_by_state_VN(state):
     return policy_change_dates
 
 
+def get_default_policy_change_dates(scope, local):
+    """Curated policy change dates of a region as the app preselects them, sorted list of date"""
+    if scope == 'World':
+        policy_change_dates = get_policy_change_dates_by_country(local)
+    elif scope == 'US':
+        policy_change_dates = get_policy_change_dates_by_state_US(local)
+    else:
+        policy_change_dates = get_policy_change_dates_by_state_VN(local)
+    policy_change_dates = [pd.to_datetime(pdate).date() for pdate in policy_change_dates]
+    return sorted(filter(None, policy_change_dates))
+
+
 def get_daily_data(cum_data):
     return cum_data.diff().fillna(0)
 
@@ -276,19 +369,62 @@ def get_number_ICU_need(daily_local_death_new):
     return ICU_n
 
 
+def get_occupancy_kernel(metric):
+    """Occupancy kernel of death_kernel.get_occupancy_kernel with the current model times and rates"""
+    return dk.get_occupancy_kernel(metric, get_params())
+
+
+def convolve_occupancy(daily_death, kernel):
+    return dk.convolve_occupancy(daily_death, kernel)
+
+
 def remove_outliers(log_daily_death, break_points):
     """ Remove outliers by running robust linear regression in each section"""
-    robust_reg = linear_model.HuberRegressor(fit_intercept=True)
-    outliers = np.array([], dtype=bool)
-    for i in range(len(break_points)-1):
-        data_train = log_daily_death.query('time_idx>={}&time_idx<{}'.format(break_points[i], break_points[i+1]))
-        try:
-            robust_reg.fit(data_train.time_idx.values.reshape(-1, 1), data_train.death)
-            outliers_pw = robust_reg.outliers_
-        except:
-            outliers_pw = np.array([False] * len(data_train), dtype=bool)
-        outliers = np.concatenate((outliers, outliers_pw))
-    return log_daily_death[~outliers]
+    return log_daily_death[~dk.get_outliers(log_daily_death.time_idx.values, log_daily_death.death.values,
+                                            break_points)]
+
+
+def get_policy_effective_dates(policy_change_dates):
+    """Dates a policy change shows in the deaths, the break points of the piecewise linear fit"""
+    return pd.to_datetime(policy_change_dates) + dt.timedelta(
+        INFECT_2_HOSPITAL_TIME + HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME)
+
+
+def get_beta_covariance(regr_pw):
+    return dk.get_beta_covariance(regr_pw)
+
+
+def get_days(index, origin):
+    """Day offsets of dates from origin"""
+    return (pd.DatetimeIndex(index) - origin).days.values
+
+
+def align_pop_ratio(pop_ratio, index):
+    """Population ratio on each date of index, a pop_ratio series is aligned on its dates"""
+    return pop_ratio.reindex(index).values if isinstance(pop_ratio, pd.Series) else pop_ratio
+
+
+def fit_log_daily_death(local_death_data, forecast_horizon=60, policy_change_dates=[], contain_rate=0.8,
+                        pop_ratio=None):
+    """Fit the piecewise linear model of log daily death described in get_log_daily_predicted_death, on the day
+    offsets of the data with death_kernel.fit_log_daily_death.
+    out: dict of the fitted pwlf model regr_pw, model_beta used to forecast (with the default last slope when
+    default_last_slope), break_points and forecast_time_idx in days from the first date of forecast_date_index,
+    beta_cov covariance of the fitted betas, log_predicted_death_pred_var and log_daily_death_orig the fitted data"""
+    origin = local_death_data.index[0]
+    fit = dk.fit_log_daily_death(get_days(local_death_data.index, origin), local_death_data.iloc[:, 0].values,
+                                 forecast_horizon, get_days(get_policy_effective_dates(policy_change_dates), origin),
+                                 contain_rate,
+                                 None if pop_ratio is None else align_pop_ratio(pop_ratio, local_death_data.index))
+    log_daily_death_orig = pd.DataFrame({'death': fit['log_daily_death']},
+                                        index=local_death_data.index[fit['log_daily_death_rows']])
+    return {'regr_pw': fit['regr_pw'], 'model_beta': fit['model_beta'], 'break_points': fit['break_points'],
+            'beta_cov': fit['beta_cov'], 'default_last_slope': fit['default_last_slope'],
+            'forecast_date_index': pd.date_range(start=origin + dt.timedelta(int(fit['start_day'])),
+                                                 periods=len(fit['forecast_time_idx'])),
+            'forecast_time_idx': fit['forecast_time_idx'],
+            'log_predicted_death_pred_var': fit['log_predicted_death_pred_var'],
+            'log_daily_death_orig': log_daily_death_orig}
 
 
 def get_log_daily_predicted_death(local_death_data, forecast_horizon=60, policy_change_dates=[], contain_rate=0.8,
@@ -303,89 +439,21 @@ def get_log_daily_predicted_death(local_death_data, forecast_horizon=60, policy_
     curve only depends on the distribution of time to death since ICU.
     WARNING: if lockdown_date is not provided, we will default to no lockdown to raise awareness of worst case
     if no action. If you have info on lockdown date please use it to make sure the model provide accurate result'''
-    policy_effective_dates = pd.to_datetime(policy_change_dates) + dt.timedelta(
-        INFECT_2_HOSPITAL_TIME + HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME)
-    daily_local_death_new = get_daily_data(local_death_data)
-    daily_local_death_new.columns = ['death']
+    fit = fit_log_daily_death(local_death_data, forecast_horizon, policy_change_dates, contain_rate, pop_ratio)
+    forecast_date_index, log_daily_death_orig = fit['forecast_date_index'], fit['log_daily_death_orig']
+    log_pop_ratio = None if pop_ratio is None else np.log(align_pop_ratio(pop_ratio, forecast_date_index))
+    log_predicted_death_values, log_predicted_death_lower_bound_values, log_predicted_death_upper_bound_values = \
+        dk.predict_log_daily_death(fit, log_pop_ratio)
+
+    log_predicted_death = pd.DataFrame({'predicted_death': log_predicted_death_values}, index=forecast_date_index)
+    log_predicted_death_lower_bound = pd.DataFrame({'lower_bound': log_predicted_death_lower_bound_values},
+                                                   index=forecast_date_index)
+    log_predicted_death_upper_bound = pd.DataFrame({'upper_bound': log_predicted_death_upper_bound_values},
+                                                   index=forecast_date_index)
     if pop_ratio is not None:
-        daily_local_death_new['death'] = daily_local_death_new.death/pop_ratio
-    smoothing_days = 7
-    daily_local_death_avg = daily_local_death_new.rolling(smoothing_days, min_periods=3).mean()
-    # Turn 0 to nan to avoid log of 0
-    daily_local_death_avg[daily_local_death_avg <= 0.01] = np.nan
-    # Because of this smoothing step, we need to time var of prediction by smoothing_days=3.
-    # Rolling set the label at the right edge of the windows, so we need to blank out the first 7 days after
-    # policy effective dates since it mixes before and after change curve
-    for policy_effective_date in policy_effective_dates:
-        daily_local_death_avg = daily_local_death_avg.loc[
-            (daily_local_death_avg.index > policy_effective_date + dt.timedelta(smoothing_days)) |
-            (daily_local_death_avg.index <= policy_effective_date)]
-    #shift ahead 1 day to avoid overfitted due to average of exponential value
-    #daily_local_death_new = daily_local_death_new.shift(1)
-    daily_local_death_avg.columns = ['death']
-    log_daily_death = np.log(daily_local_death_avg)
-    log_daily_death_orig = log_daily_death.copy()
-
-    # log_daily_death.dropna(inplace=True)
-    data_start_date = min(daily_local_death_avg.index)
-    data_end_date = max(daily_local_death_avg.index)
-    forecast_end_date = data_end_date + dt.timedelta(forecast_horizon)
-    forecast_date_index = pd.date_range(start=data_start_date, end=forecast_end_date)
-
-    data_start_date_idx = 0
-    data_end_date_idx = (data_end_date - data_start_date).days
-    forecast_end_date_idx = data_end_date_idx + forecast_horizon
-    forecast_time_idx = (forecast_date_index - data_start_date).days.values
-    data_time_idx = (log_daily_death.index - data_start_date).days.values
-    policy_effective_dates_idx = (policy_effective_dates - data_start_date).days.values
-    log_daily_death['time_idx'] = data_time_idx
-    log_daily_death = log_daily_death.replace([np.inf, -np.inf], np.nan).dropna()
-    break_points = np.array([data_start_date_idx, ] +
-                            policy_effective_dates_idx[(~np.isnan(policy_effective_dates_idx))&
-                                                       (policy_effective_dates_idx < forecast_end_date_idx)].tolist() +
-                            [forecast_end_date_idx, ])
-    log_daily_death = remove_outliers(log_daily_death, break_points)
-    regr_pw = pwlf.PiecewiseLinFit(x=log_daily_death.time_idx.values, y=log_daily_death.death)
-    regr_pw.fit_with_breaks(break_points)
-    model_beta = regr_pw.beta
-    log_predicted_death_pred_var = smoothing_days * regr_pw.prediction_variance(forecast_time_idx)
-
-    # Use default slope when data is not enough to fit last line, less than 4 data point, with contain_rate=1 mean slope
-    # is the same as previous slope (same policy) and 0 mean (relax 100%) slope will be same as before lockdown
-
-    if ((data_end_date_idx-break_points[-2]) < 4) | (model_beta[-1] > max(0.3, abs(model_beta[1]))):
-        if model_beta[-2] < 0:
-            model_beta[-1] = (-model_beta[-2])*(1-contain_rate)
-        else:
-            model_beta[-1] = (-model_beta[-2])*(1+contain_rate)
-        print("Use default last slope due to not enough data")
-        #import pdb; pdb.set_trace()
-        variance = log_predicted_death_pred_var[sum(forecast_time_idx <= break_points[-2])]
-        log_predicted_death_pred_var_oos = variance * (forecast_time_idx[forecast_time_idx > break_points[-2]] -
-                                                       break_points[-2])
-        log_predicted_death_pred_var = np.concatenate(
-                (log_predicted_death_pred_var[:sum(forecast_time_idx <= break_points[-2])],
-                 log_predicted_death_pred_var_oos))
-
-    log_predicted_death_values = regr_pw.predict(forecast_time_idx, beta=model_beta, breaks=break_points)
-
-    log_predicted_death_lower_bound_values = log_predicted_death_values - 1.96 * np.sqrt(log_predicted_death_pred_var)
-    log_predicted_death_upper_bound_values = log_predicted_death_values + 1.96 * np.sqrt(log_predicted_death_pred_var)
-
-    log_predicted_death = pd.DataFrame(log_predicted_death_values, index=forecast_date_index)
-    log_predicted_death_lower_bound = pd.DataFrame(log_predicted_death_lower_bound_values, index=forecast_date_index)
-    log_predicted_death_upper_bound = pd.DataFrame(log_predicted_death_upper_bound_values, index=forecast_date_index)
-    log_predicted_death.columns = ['predicted_death']
-    log_predicted_death_lower_bound.columns = ['lower_bound']
-    log_predicted_death_upper_bound.columns = ['upper_bound']
-    if pop_ratio is not None:
-        log_daily_death_orig['death'] = log_daily_death_orig.death + np.log(pop_ratio)
-        log_predicted_death['predicted_death'] = log_predicted_death.predicted_death + np.log(pop_ratio)
-        log_predicted_death_lower_bound['lower_bound'] = log_predicted_death_lower_bound['lower_bound'] + \
-                                                         np.log(pop_ratio)
-        log_predicted_death_upper_bound['upper_bound'] = log_predicted_death_upper_bound['upper_bound'] + \
-                                                         np.log(pop_ratio)
-    return log_predicted_death, log_predicted_death_lower_bound, log_predicted_death_upper_bound, regr_pw.beta, \
+        log_daily_death_orig['death'] = log_daily_death_orig.death + \
+            np.log(align_pop_ratio(pop_ratio, log_daily_death_orig.index))
+    return log_predicted_death, log_predicted_death_lower_bound, log_predicted_death_upper_bound, fit['model_beta'], \
         log_daily_death_orig
 
 
@@ -406,8 +474,173 @@ def get_cumulative_predicted_death(local_death_data, forecast_horizon=60, policy
     return daily.cumsum(), lb.cumsum(), ub.cumsum(), model_beta
 
 
+def predict_death_piecewise(local_death_data, forecast_horizon=60, policy_change_dates=[], contain_rate=0.8,
+                            pop_ratio=None, population=None, warm_start=None):
+    """Piecewise log linear model of the daily death, see get_log_daily_predicted_death. Engine of MODEL_ENGINES"""
+    daily, lb, ub, model_beta = get_daily_predicted_death(local_death_data, forecast_horizon, policy_change_dates,
+                                                          contain_rate, pop_ratio)
+    return pd.concat([daily, lb, ub], axis=1), model_beta
+
+
+# Days of infections the SEIR model is fitted on, counted back from the last one, and the fewest it needs
+SEIR_FIT_DAYS = 56
+SEIR_MIN_FIT_DAYS = 14
+# Random restarts of a SEIR fit, and added to the previous parameters of the region when warm started. A cold fit stops
+# once SEIR_AGREE restarts reach the best sum of squares within SEIR_TOL
+SEIR_RESTARTS = 8
+SEIR_WARM_RESTARTS = 1
+SEIR_TOL = 1e-3
+SEIR_AGREE = 3
+
+
+def get_seir_fit_data(local_death_data, policy_change_dates=[], population=None):
+    """Cumulative infections implied by the death, DEATH_RATE and the delay from infection to death, that the SEIR
+    model is fitted on. The fit starts after the last policy change with enough data, as the contact rate changes with
+    the policy. Raise ValueError when the implied infections reach the population, DEATH_RATE is too low for the region.
+    out: (infections indexed by infection date, days since the fit start, initial S, E, I, R)"""
+    delay_time = INFECT_2_HOSPITAL_TIME + HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME
+    infected = (100/DEATH_RATE)*local_death_data.iloc[:, 0].astype(np.float64)
+    infected.index = infected.index - dt.timedelta(delay_time)
+    last_infection_date = infected.index[-1]
+    fit_start_date = last_infection_date - dt.timedelta(SEIR_FIT_DAYS - 1)
+    for policy_date in sorted(pd.to_datetime(policy_change_dates), reverse=True):
+        if fit_start_date <= policy_date <= last_infection_date - dt.timedelta(SEIR_MIN_FIT_DAYS - 1):
+            fit_start_date = policy_date
+            break
+    window = infected[(infected.index >= fit_start_date) & (infected > 0)]
+    if len(window) < SEIR_MIN_FIT_DAYS:
+        raise ValueError('Not enough infections to fit SEIR')
+    # S would start or turn negative, the fit then forecasts no death at all
+    if window.iloc[-1] >= population:
+        raise ValueError('Infections implied by the death exceed the population, SEIR cannot fit')
+    t = np.asarray((window.index - window.index[0]).days, dtype=np.float64)
+    # Infected in the week before the fit start are still infectious, the others recovered
+    C0 = window.iloc[0]
+    week_before = infected.asof(window.index[0] - dt.timedelta(7))
+    I0 = C0 if np.isnan(week_before) else max(C0 - week_before, 1)
+    return window, t, [population - C0, 0, I0, C0 - I0]
+
+
+def fit_seir(window, t, y0, population, warm_start=None):
+    """SEIR parameters (logbeta, logkappa, loggamma) and sum of squared residuals of the data of get_seir_fit_data.
+    warm_start: parameters of a previous fit, tried before the random restarts"""
+    params, ssr = seir.minimization(y0, t, window.values, population,
+                                    niter=SEIR_RESTARTS if warm_start is None else SEIR_WARM_RESTARTS,
+                                    seed=0, tol=SEIR_TOL, n_agree=SEIR_AGREE, p0=warm_start)
+    if not np.isfinite(ssr):
+        raise ValueError('SEIR fit failed')
+    return np.asarray(params), ssr
+
+
+def predict_death_seir(local_death_data, forecast_horizon=60, policy_change_dates=[], contain_rate=0.8,
+                       pop_ratio=None, population=None, warm_start=None):
+    """SEIR model fitted on the cumulative infections implied by the death, see get_seir_fit_data. The SEIR dynamics
+    take the depletion of the susceptible over the population into account instead of pop_ratio. Engine of
+    MODEL_ENGINES, no bounds.
+    warm_start: (logbeta, logkappa, loggamma) of a previous fit, tried before the random restarts"""
+    if population is None:
+        raise ValueError('SEIR engine needs the population')
+    delay_time = INFECT_2_HOSPITAL_TIME + HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME
+    window, t, y0 = get_seir_fit_data(local_death_data, policy_change_dates, population)
+    params, _ = fit_seir(window, t, y0, population, warm_start)
+    forecast_end_date = local_death_data.index[-1] + dt.timedelta(forecast_horizon)
+    t_forecast = np.arange((forecast_end_date - dt.timedelta(delay_time) - window.index[0]).days + 1,
+                           dtype=np.float64)
+    states = seir.dynamics(y0, t_forecast, population, *params)
+    daily_infected = np.diff(states[:, 2] + states[:, 3], prepend=np.nan)
+    predicted_death = pd.DataFrame({'predicted_death': (DEATH_RATE/100)*daily_infected,
+                                    'lower_bound': np.nan, 'upper_bound': np.nan},
+                                   index=pd.date_range(window.index[0] + dt.timedelta(delay_time),
+                                                       periods=len(t_forecast)))
+    return predicted_death.iloc[1:], params
+
+
+def predict_death_ensemble(engine_names, local_death_data, forecast_horizon=60, policy_change_dates=[],
+                           contain_rate=0.8, pop_ratio=None, population=None, region=None):
+    """Run the engines concurrently. The predicted death is the mean of their predictions, the bounds cover the bounds
+    and predictions of every engine"""
+    with ThreadPoolExecutor(max_workers=len(engine_names)) as executor:
+        futures = [executor.submit(predict_daily_death, local_death_data, forecast_horizon, policy_change_dates,
+                                   contain_rate, pop_ratio, name, region, population) for name in engine_names]
+        fits = [future.result() for future in futures]
+    predicted = pd.concat([frame.predicted_death for frame, _ in fits], axis=1, sort=True)
+    lower = pd.concat([predicted] + [frame.lower_bound for frame, _ in fits], axis=1, sort=True)
+    upper = pd.concat([predicted] + [frame.upper_bound for frame, _ in fits], axis=1, sort=True)
+    return pd.DataFrame({'predicted_death': predicted.mean(axis=1), 'lower_bound': lower.min(axis=1),
+                         'upper_bound': upper.max(axis=1)}), \
+        {name: params for name, (_, params) in zip(engine_names, fits)}
+
+
+# Engines forecasting the daily death, each a function (local_death_data, forecast_horizon, policy_change_dates,
+# contain_rate, pop_ratio, population, warm_start) -> (frame of predicted_death, lower_bound and upper_bound indexed by
+# date, fitted parameters), with whether it needs the population and uses pop_ratio
+MODEL_ENGINES = {
+    'piecewise': {'predict': predict_death_piecewise, 'needs_population': False, 'uses_pop_ratio': True},
+    'seir': {'predict': predict_death_seir, 'needs_population': True, 'uses_pop_ratio': False},
+}
+# Engines combined by the 'ensemble' engine
+ENSEMBLE_ENGINES = ('piecewise', 'seir')
+ENGINE_CACHE_SIZE = 256
+
+# Fits of this process by engine, region and inputs, least recently used first, and the last parameters fitted by each
+# engine for each region to warm start its next fit
+_engine_fits = OrderedDict()
+_engine_params = {}
+_engine_lock = threading.Lock()
+
+
+def needs_population(engine):
+    names = ENSEMBLE_ENGINES if engine == 'ensemble' else [engine]
+    return any(MODEL_ENGINES[name]['needs_population'] for name in names)
+
+
+def _hash_frame(data):
+    return None if data is None else int(pd.util.hash_pandas_object(pd.DataFrame(data)).sum())
+
+
+def predict_daily_death(local_death_data, forecast_horizon=60, policy_change_dates=[], contain_rate=0.8,
+                        pop_ratio=None, engine='piecewise', region=None, population=None):
+    """Daily death forecast of an engine of MODEL_ENGINES or 'ensemble' of ENSEMBLE_ENGINES.
+    Fits are cached by region and inputs, and the parameters last fitted for region warm start the next fit of a
+    region, e.g. on the next day of data.
+    region: key of the region like (scope, local, local_sub_level), None to neither cache nor warm start
+    out: (frame of predicted_death, lower_bound and upper_bound indexed by date, fitted parameters, a dict by engine
+    for the ensemble)"""
+    with tracing.span('predict_daily_death', engine=engine) as engine_span:
+        if engine == 'ensemble':
+            return predict_death_ensemble(ENSEMBLE_ENGINES, local_death_data, forecast_horizon, policy_change_dates,
+                                          contain_rate, pop_ratio, population, region)
+        model_engine = MODEL_ENGINES[engine]
+        if not model_engine['uses_pop_ratio']:
+            pop_ratio = None
+        key = None
+        if region is not None:
+            key = (engine, region, _hash_frame(local_death_data), forecast_horizon,
+                   tuple(str(date) for date in policy_change_dates), contain_rate, _hash_frame(pop_ratio),
+                   population, tuple(sorted(get_params().items())))
+            with _engine_lock:
+                if key in _engine_fits:
+                    engine_span.set_tag('cached', True)
+                    _engine_fits.move_to_end(key)
+                    predicted_death, params = _engine_fits[key]
+                    return predicted_death.copy(), params
+                warm_start = _engine_params.get((engine, region))
+        else:
+            warm_start = None
+        predicted_death, params = model_engine['predict'](local_death_data, forecast_horizon, policy_change_dates,
+                                                          contain_rate, pop_ratio, population, warm_start)
+        if key is not None:
+            with _engine_lock:
+                _engine_fits[key] = (predicted_death.copy(), params)
+                _engine_params[(engine, region)] = params
+                while len(_engine_fits) > ENGINE_CACHE_SIZE:
+                    _engine_fits.popitem(last=False)
+        return predicted_death, params
+
+
 def get_daily_metrics_from_death_data(local_death_data, forecast_horizon=60, policy_change_dates=[], contain_rate=0.8,
-                                      test_rate=0.2, pop_ratio=None):
+                                      test_rate=0.2, pop_ratio=None, progress=None, engine='piecewise', region=None,
+                                      population=None):
     """test rate is defined as ratio of confirmed positive cases over all infected cases. A test rate=1 mean
     we can catch all infected case. In this case there is no uncertainty on the infected case, it is exactly
     equal confirmed case. When test rate is smaller than 1 the uncertainty is higher. Test rate is estimated
@@ -416,44 +649,27 @@ def get_daily_metrics_from_death_data(local_death_data, forecast_horizon=60, pol
     We will assume that all death due to Covid19 has been tested and counted, so there is no extra uncertainty on the
     number of death lower and upper bound.
     For other metrics derive from death, we need to use this test rate to add uncertainty into their bounds.
-    Due to the definition, standard deviation of the derived metrics gets inflated by 1 over squareroot of test rate"""
-
-    daily_predicted_death, daily_predicted_death_lb, daily_predicted_death_ub, model_beta = \
-        get_daily_predicted_death(local_death_data, forecast_horizon+19, policy_change_dates, contain_rate, pop_ratio)
-    upper_length_death = daily_predicted_death_ub - daily_predicted_death
-    upper_length_derived = (upper_length_death*1/np.sqrt(test_rate)).astype('int', errors='ignore')
-    lower_length_death = daily_predicted_death - daily_predicted_death_lb
-    lower_length_derived = (lower_length_death * 1 / np.sqrt(test_rate)).astype('int', errors='ignore')
-
-    daily_local_death_new = get_daily_data(local_death_data)
-    daily_local_death_new.columns = ['death']
-    smoothing_days = 7
-    daily_local_death_avg = daily_local_death_new.rolling(smoothing_days, min_periods=3).mean()
-    daily_local_death_avg.columns = ['7d_avg_death']
-    data_end_date = max(daily_local_death_avg.index)
-    forecast_end_date = data_end_date + dt.timedelta(forecast_horizon)
-    daily_infected_cases_new = get_infected_cases(daily_predicted_death)
-    daily_symptomatic_cases_new = get_symptomatic_cases(daily_predicted_death)
-    daily_hospitalized_cases_new = get_hospitalized_cases(daily_predicted_death)
-    daily_hospital_beds_need = get_number_hospital_beds_need(daily_predicted_death)
-    daily_ICU_need = get_number_ICU_need(daily_predicted_death)
-
-    # daily_infected_cases_new_lb = daily_infected_cases_new - get_infected_cases(lower_length_derived)
-    # daily_symptomatic_cases_new_lb = daily_symptomatic_cases_new - get_symptomatic_cases(lower_length_derived)
-    # daily_hospitalized_cases_new_lb = daily_hospitalized_cases_new - get_hospitalized_cases(lower_length_derived)
-    # daily_hospital_beds_need_lb = daily_hospital_beds_need - get_number_hospital_beds_need(lower_length_derived)
-    # daily_ICU_need_lb = daily_hospital_beds_need - get_number_ICU_need(lower_length_derived)
-
-    return pd.concat([daily_local_death_new,
-                      daily_local_death_avg,
-                      daily_predicted_death,
-                      daily_predicted_death_lb,
-                      daily_predicted_death_ub,
-                      daily_infected_cases_new,
-                      daily_symptomatic_cases_new,
-                      daily_hospitalized_cases_new,
-                      daily_hospital_beds_need,
-                      daily_ICU_need], axis=1, sort=True).loc[:forecast_end_date], model_beta
+    Due to the definition, standard deviation of the derived metrics gets inflated by 1 over squareroot of test rate.
+    engine, region, population: see predict_daily_death, model_beta is the parameters of the engine"""
+
+    report_progress(progress, 'fit')
+    predicted_death, model_beta = predict_daily_death(local_death_data, forecast_horizon+dk.EXTRA_DAYS,
+                                                      policy_change_dates, contain_rate, pop_ratio, engine, region,
+                                                      population)
+    report_progress(progress, 'derive')
+    origin = local_death_data.index[0]
+    first_date = predicted_death.index[0]
+    predicted_death = predicted_death[['predicted_death', 'lower_bound', 'upper_bound']]\
+        .reindex(pd.date_range(first_date, predicted_death.index[-1]))
+    metrics = dk.get_daily_metric_arrays(get_days(local_death_data.index, origin), local_death_data.iloc[:, 0].values,
+                                         (first_date - origin).days, predicted_death.values.T, forecast_horizon,
+                                         get_params())
+    with tracing.span('concat'):
+        rows = metrics['rows']
+        index = pd.date_range(origin + dt.timedelta(int(metrics['first_day'])), periods=len(rows))
+        daily_metrics = pd.DataFrame({column: metrics[column][rows] for column in dk.DAILY_COLUMNS},
+                                     index=index if rows.all() else index[rows])
+    return daily_metrics, model_beta
 
 
 def get_cumulative_metrics_from_death_data(local_death_data, forecast_horizon=60, policy_change_dates=[], contain_rate=0.8,
@@ -477,95 +693,91 @@ def get_cumulative_metrics_from_death_data(local_death_data, forecast_horizon=60
     return cumulative_metrics, model_beta
 
 
-#TODO debug Thailand strange peak
-def get_metrics_by_country(country, state='All', scope='global', forecast_horizon=60, policy_change_dates=[],
-                           contain_rate=0.8,
-                           test_rate=0.2, back_test=False, last_data_date=dt.date.today(), pop_ratio=None,
-                           use_vaccine_data=True):
-    local_death_data = get_data_by_country(country, state, type='deaths')
-    local_death_data_original = local_death_data.copy()
-    daily_local_death_data_original = get_daily_data(local_death_data_original)
-    if back_test:
-        local_death_data = local_death_data[local_death_data.index.date <= last_data_date]
-    local_confirmed_data = get_data_by_country(country, state, type='confirmed')
-    daily_local_confirmed_data = get_daily_data(local_confirmed_data)
-    daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon,
-                                                                  policy_change_dates, contain_rate, test_rate,
-                                                                  pop_ratio)
-    daily_metrics['confirmed'] = daily_local_confirmed_data
-    if back_test:
-        daily_metrics['death'] = daily_local_death_data_original
-        daily_metrics['7d_avg_death'] = daily_local_death_data_original.rolling(7, min_periods=3).mean()
-
-    cumulative_metrics = daily_metrics.drop(columns=['ICU', 'hospital_beds']).cumsum()
-    if pop_ratio is None and use_vaccine_data:
-        population = get_population(scope='World', local=country, local_sub_level=state)
-        delay_time = INFECT_2_HOSPITAL_TIME + HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME
-        vaccinated_ratio = get_projected_pct_fully_vaccinated(scope='World', local=country,
-                                                              forecast_horizon=forecast_horizon)
-        vaccinated_ratio = pd.Series(
-            data=vaccinated_ratio,
-            index=cumulative_metrics.tshift(delay_time).index
-        ).fillna(0)
-        pop_ratio = (((population - cumulative_metrics.infected.tshift(delay_time)) / population) *
-                     (1 - 0.95*vaccinated_ratio/100)).clip(upper=1, lower=0.0001)
-
+# Share of the fully vaccinated counted as immune, by population data scope
+VACCINE_EFFICACY = {'World': 0.95, 'US': 0.9}
+
+
+def get_metrics_from_series(local_death_data, local_confirmed_data, population_scope, local, local_sub_level='All',
+                            forecast_horizon=60, policy_change_dates=[], contain_rate=0.8, test_rate=0.2,
+                            last_data_date=None, pop_ratio=None, use_vaccine_data=True, progress=None,
+                            engine='piecewise'):
+    """Forecast metrics from cumulative death and confirmed series already fetched, see get_metrics_by_country.
+    last_data_date: fit only the data up to this date and keep the realized deaths after it (back test)
+    population_scope: 'World' or 'US', where to look up the population and vaccination of local
+    engine: 'piecewise', 'seir' or 'ensemble' of both, see predict_daily_death"""
+    with tracing.span('get_metrics', scope=population_scope, local=local, local_sub_level=local_sub_level,
+                      forecast_horizon=forecast_horizon, contain_rate=contain_rate, test_rate=test_rate,
+                      policy_change_dates=[str(date) for date in policy_change_dates], engine=engine,
+                      last_data_date=None if last_data_date is None else str(last_data_date)):
+        back_test = last_data_date is not None
+        region = (population_scope, local, local_sub_level)
+        population = get_population(population_scope, local, local_sub_level) if needs_population(engine) else None
+        daily_local_death_data_original = get_daily_data(local_death_data)
+        if back_test:
+            local_death_data = local_death_data[local_death_data.index.date <= last_data_date]
+        daily_local_confirmed_data = get_daily_data(local_confirmed_data)
         daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon,
                                                                       policy_change_dates, contain_rate, test_rate,
-                                                                      pop_ratio)
+                                                                      pop_ratio, progress, engine, region, population)
         daily_metrics['confirmed'] = daily_local_confirmed_data
         if back_test:
             daily_metrics['death'] = daily_local_death_data_original
             daily_metrics['7d_avg_death'] = daily_local_death_data_original.rolling(7, min_periods=3).mean()
+
         cumulative_metrics = daily_metrics.drop(columns=['ICU', 'hospital_beds']).cumsum()
+        if pop_ratio is None and use_vaccine_data:
+            population = get_population(scope=population_scope, local=local, local_sub_level=local_sub_level)
+            delay_time = INFECT_2_HOSPITAL_TIME + HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME
+            vaccinated_ratio = get_projected_pct_fully_vaccinated(scope=population_scope, local=local,
+                                                                  forecast_horizon=forecast_horizon)
+            vaccinated_ratio = pd.Series(
+                data=vaccinated_ratio,
+                index=cumulative_metrics.tshift(delay_time).index
+            ).fillna(0)
+            pop_ratio = (((population - cumulative_metrics.infected.tshift(delay_time)) / population) *
+                         (1 - VACCINE_EFFICACY[population_scope]*vaccinated_ratio/100)).clip(upper=1, lower=0.0001)
+
+            daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon,
+                                                                          policy_change_dates, contain_rate, test_rate,
+                                                                          pop_ratio, progress, engine, region,
+                                                                          population)
+            daily_metrics['confirmed'] = daily_local_confirmed_data
+            if back_test:
+                daily_metrics['death'] = daily_local_death_data_original
+                daily_metrics['7d_avg_death'] = daily_local_death_data_original.rolling(7, min_periods=3).mean()
+            cumulative_metrics = daily_metrics.drop(columns=['ICU', 'hospital_beds']).cumsum()
+
+        cumulative_metrics['ICU'] = daily_metrics['ICU']
+        cumulative_metrics['hospital_beds'] = daily_metrics['hospital_beds']
+        return daily_metrics, cumulative_metrics, model_beta
 
-    cumulative_metrics['ICU'] = daily_metrics['ICU']
-    cumulative_metrics['hospital_beds'] = daily_metrics['hospital_beds']
-    return daily_metrics, cumulative_metrics, model_beta
+
+#TODO debug Thailand strange peak
+def get_metrics_by_country(country, state='All', scope='global', forecast_horizon=60, policy_change_dates=[],
+                           contain_rate=0.8,
+                           test_rate=0.2, back_test=False, last_data_date=dt.date.today(), pop_ratio=None,
+                           use_vaccine_data=True, progress=None, engine='piecewise'):
+    report_progress(progress, 'fetch')
+    with tracing.span('fetch', scope='World', local=country, local_sub_level=state):
+        local_death_data = get_data_by_country(country, state, type='deaths')
+        local_confirmed_data = get_data_by_country(country, state, type='confirmed')
+    return get_metrics_from_series(local_death_data, local_confirmed_data, 'World', country, state,
+                                   forecast_horizon, policy_change_dates, contain_rate, test_rate,
+                                   last_data_date if back_test else None, pop_ratio, use_vaccine_data, progress,
+                                   engine)
 
 
 def get_metrics_by_state(state, county='All',  scope='US', forecast_horizon=60, policy_change_dates=[], contain_rate=0.8,
                             test_rate=0.2, back_test=False, last_data_date=dt.date.today(), pop_ratio=None,
-                            use_vaccine_data=True):
-    local_death_data = get_data_by_state(state, county, scope=scope, type='deaths')
-    local_death_data_original = local_death_data.copy()
-    daily_local_death_data_original = get_daily_data(local_death_data_original)
-    if back_test:
-        local_death_data = local_death_data[local_death_data.index.date <= last_data_date]
-    local_confirmed_data = get_data_by_state(state, county, scope=scope, type='confirmed')
-    daily_local_confirmed_data = get_daily_data(local_confirmed_data)
-    daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon,
-                                                                  policy_change_dates, contain_rate, test_rate,
-                                                                  pop_ratio)
-    daily_metrics['confirmed'] = daily_local_confirmed_data
-    if back_test:
-        daily_metrics['death'] = daily_local_death_data_original
-        daily_metrics['7d_avg_death'] = daily_local_death_data_original.rolling(7, min_periods=3).mean()
-
-    cumulative_metrics = daily_metrics.drop(columns=['ICU', 'hospital_beds']).cumsum()
-    if pop_ratio is None and use_vaccine_data:
-        population = get_population(scope='US', local=state, local_sub_level=county)
-        delay_time = INFECT_2_HOSPITAL_TIME + HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME
-        vaccinated_ratio = get_projected_pct_fully_vaccinated(scope='US', local=state,
-                                                              forecast_horizon=forecast_horizon)
-        vaccinated_ratio = pd.Series(
-            data=vaccinated_ratio,
-            index=cumulative_metrics.tshift(delay_time).index
-        ).fillna(0)
-        pop_ratio = (((population - cumulative_metrics.infected.tshift(delay_time)) / population) *
-                     (1 - 0.9*vaccinated_ratio/100)).clip(upper=1, lower=0.0001)
-        daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon,
-                                                                      policy_change_dates, contain_rate, test_rate,
-                                                                      pop_ratio)
-        daily_metrics['confirmed'] = daily_local_confirmed_data
-        if back_test:
-            daily_metrics['death'] = daily_local_death_data_original
-            daily_metrics['7d_avg_death'] = daily_local_death_data_original.rolling(7, min_periods=3).mean()
-        cumulative_metrics = daily_metrics.drop(columns=['ICU', 'hospital_beds']).cumsum()
-
-    cumulative_metrics['ICU'] = daily_metrics['ICU']
-    cumulative_metrics['hospital_beds'] = daily_metrics['hospital_beds']
-    return daily_metrics, cumulative_metrics, model_beta
+                            use_vaccine_data=True, progress=None, engine='piecewise'):
+    report_progress(progress, 'fetch')
+    with tracing.span('fetch', scope=scope, local=state, local_sub_level=county):
+        local_death_data = get_data_by_state(state, county, scope=scope, type='deaths')
+        local_confirmed_data = get_data_by_state(state, county, scope=scope, type='confirmed')
+    return get_metrics_from_series(local_death_data, local_confirmed_data, 'US', state, county,
+                                   forecast_horizon, policy_change_dates, contain_rate, test_rate,
+                                   last_data_date if back_test else None, pop_ratio, use_vaccine_data, progress,
+                                   engine)
 
 
 def get_log_daily_predicted_death_by_country(country, state='All',   scope='global', forecast_horizon=60,
@@ -602,22 +814,72 @@ def get_log_daily_predicted_death_by_state(state, county='All', scope='US', fore
 
 
 def append_row_2_logs(row, log_file='logs/model_params_logs.csv'):
-    # Open file in append mode
-    with open(log_file, 'a+', newline='') as write_obj:
-        # Create a writer object from csv module
-        csv_writer = writer(write_obj)
-        # Add contents of list as last row in the csv file
-        csv_writer.writerow(row)
-
-
-def get_table_download_link(df, filename="data.csv"):
-    """Generates a link allowing the data in a given panda dataframe to be downloaded
+    """Queue a row to be appended to the csv log file. Writing is done in batches by a background thread,
+    see log_writer.LogWriter, so this call does not block on disk I/O"""
+    get_log_writer().write(row, log_file)
+
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'csv.gz': 'application/gzip', 'parquet': 'application/octet-stream'}
+
+
+def iter_table_chunks(df, file_format='csv', chunk_rows=5000):
+    """Encode a dataframe for download chunk by chunk, so the whole file is never held as one string
+    file_format: enum('csv', 'csv.gz', 'parquet'), parquet needs pyarrow
+    out: generator of bytes"""
+    if file_format == 'parquet':
+        yield from _iter_parquet_chunks(df, chunk_rows)
+        return
+    if file_format == 'csv.gz':
+        import zlib
+        compressor = zlib.compressobj(wbits=31)  # 31 is gzip container
+    elif file_format != 'csv':
+        raise ValueError('Unknown export format {}'.format(file_format))
+    for start in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start:start+chunk_rows].to_csv(index=True, header=(start == 0)).encode()
+        if file_format == 'csv.gz':
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+    if file_format == 'csv.gz':
+        yield compressor.flush()
+
+
+def _iter_parquet_chunks(df, chunk_rows):
+    import io
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Parquet export needs pyarrow, install requirements.txt')
+    buffer = io.BytesIO()
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    with pq.ParquetWriter(buffer, table.schema, compression='snappy') as parquet_writer:
+        for batch in table.to_batches(max_chunksize=chunk_rows):
+            parquet_writer.write_table(pa.Table.from_batches([batch], schema=table.schema))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def get_table_download_link(df, filename="data.csv", file_format='csv'):
+    """Generates a link allowing the data in a given panda dataframe to be downloaded.
+    Only call this when the user asks for the file, the encoded data is embedded in the page
     in:  dataframe
     out: href string
     """
     import base64
-    csv = df.to_csv(index=True)
-    b64 = base64.b64encode(csv.encode()).decode()  # some strings <-> bytes conversions necessary here
-    href = f'<a href="data:file/csv;base64,{b64}" download="{filename}" >Download csv file</a>'
+    encoder = base64.b64encode
+    # Encode 3-byte aligned pieces so the concatenated base64 strings equal encoding the whole file
+    b64_parts = []
+    rest = b''
+    for chunk in iter_table_chunks(df, file_format):
+        chunk = rest + chunk
+        aligned = len(chunk) - len(chunk) % 3
+        b64_parts.append(encoder(chunk[:aligned]).decode())
+        rest = chunk[aligned:]
+    b64_parts.append(encoder(rest).decode())
+    b64 = ''.join(b64_parts)
+    href = f'<a href="data:{EXPORT_FORMATS[file_format]};base64,{b64}" download="{filename}" >' \
+           f'Download {file_format} file</a>'
     return href
-
@@ -0,0 +1,131 @@
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+import plotly.graph_objects as go
+import tracing
+
+BAND_FILL_COLOR = 'rgba(66, 164, 245,0.1)'
+BAND_LINE_COLOR = 'rgba(128,128,128,0)'
+# Long histories are thinned for display, the most recent days and the forecast keep every point
+MAX_DISPLAY_POINTS = 500
+FULL_RESOLUTION_DAYS = 180
+FIGURE_CACHE_SIZE = 256
+
+
+def get_display_index(n_points, max_points=MAX_DISPLAY_POINTS, full_resolution_days=FULL_RESOLUTION_DAYS):
+    """Positions of the points to draw out of n_points daily values"""
+    if n_points <= max_points:
+        return np.arange(n_points)
+    recent_start = max(n_points - max(full_resolution_days, 1), 0)
+    n_old = max(max_points - (n_points - recent_start), 1)
+    stride = int(np.ceil(recent_start / n_old))
+    return np.concatenate((np.arange(0, recent_start, stride), np.arange(recent_start, n_points)))
+
+
+def line_figure(x, columns, names=None, hidden=()):
+    """Figure with one line per column
+    x: array of dates
+    columns: dict of column name to array of values, in trace order
+    names: dict of column name to legend name, default to the column name
+    hidden: column names only shown when clicked in the legend"""
+    names = {} if names is None else names
+    fig = go.Figure()
+    for column, values in columns.items():
+        fig.add_trace(go.Scatter(
+            x=x,
+            y=values,
+            mode='lines',
+            name=names.get(column, column),
+            visible='legendonly' if column in hidden else True))
+    return fig
+
+
+def add_bound_band(fig, x, y_lower, y_upper, legendgroup='CI', showlegend=True):
+    """Shade the confidence interval between lower and upper bound"""
+    fig.add_trace(go.Scatter(
+        x=x,
+        y=y_upper,
+        fill=None,
+        line_color=BAND_LINE_COLOR,
+        legendgroup=legendgroup,
+        showlegend=showlegend,
+        name='Cận trên'))
+    fig.add_trace(go.Scatter(
+        x=x,
+        y=y_lower,
+        fill='tonexty',
+        fillcolor=BAND_FILL_COLOR,
+        line_color=BAND_LINE_COLOR,
+        legendgroup=legendgroup,
+        showlegend=showlegend,
+        name='Cận dưới'))
+    return fig
+
+
+def add_last_data_marker(fig, last_data_date, max_y, name='Dùng dữ liệu đến ngày'):
+    """Vertical line at the last date of data used by a back test"""
+    fig.add_trace(go.Scatter(
+        x=[last_data_date, last_data_date],
+        y=[0, max_y],
+        opacity=0.5,
+        line_color='grey',
+        mode='lines',
+        hovertext=str(last_data_date),
+        hoverinfo="x+name",
+        name=name))
+    return fig
+
+
+def add_constant_line(fig, x, value, name):
+    """Flat line such as a hospital bed capacity, hidden until clicked in the legend"""
+    fig.add_trace(go.Scatter(
+        x=[x[0], x[-1]],
+        y=[value, value],
+        mode='lines',
+        visible='legendonly',
+        name=name))
+    return fig
+
+
+def forecast_figure(frame, columns, names=None, hidden=(), bounds=None, last_data_date=None,
+                    last_data_name='Dùng dữ liệu đến ngày'):
+    """Lines of the given frame columns, with an optional confidence band and back test marker.
+    bounds: (lower, upper) column names of the band"""
+    display_index = get_display_index(len(frame))
+    x = frame.index.values[display_index]
+    columns = [column for column in columns if column in frame.columns]
+    fig = line_figure(x, {column: frame[column].values[display_index] for column in columns}, names, hidden)
+    if bounds is not None:
+        add_bound_band(fig, x, frame[bounds[0]].values[display_index], frame[bounds[1]].values[display_index])
+    if last_data_date is not None:
+        y_max = frame[bounds[1]].values if bounds is not None else frame[columns].values
+        add_last_data_marker(fig, last_data_date, np.nanmax(y_max), last_data_name)
+    return fig
+
+
+class FigureCache(object):
+    """Serialized figures keyed by the forecast result, shared by all sessions.
+    Figures are kept as json so a cached figure can not be changed by the session using it"""
+
+    def __init__(self, max_size=FIGURE_CACHE_SIZE):
+        self.max_size = max_size
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build_fun):
+        with self._lock:
+            fig_json = self._figures.get(key)
+            if fig_json is not None:
+                self._figures.move_to_end(key)
+        if fig_json is None:
+            with tracing.span('build_figure', figure=str(key[0])):
+                fig_json = build_fun().to_json()
+            with self._lock:
+                self._figures[key] = fig_json
+                while len(self._figures) > self.max_size:
+                    self._figures.popitem(last=False)
+        return go.Figure(json.loads(fig_json))
+
+
+figure_cache = FigureCache()
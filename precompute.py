@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Nightly batch: forecast every region with the app default settings and store the results,
+so the app only computes customized runs. Run after each data refresh."""
+import argparse
+import time
+import datetime as dt
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import model_utils as mu
+import tracing
+import forecast_store as fs
+import forecast_archive as fa
+
+DEFAULT_FORECAST_HORIZON = 60
+
+
+def get_regions(scope):
+    """(local, local_sub_level) of every region the app offers for a scope"""
+    if scope == 'World':
+        death_data = mu.get_data(scope='global', type='deaths')
+        local_col, sub_col = 'Country', 'State'
+    else:
+        death_data = mu.get_data(scope=scope, type='deaths')
+        local_col, sub_col = 'State', 'County'
+    regions = []
+    for local in death_data[local_col].unique():
+        regions.append((local, 'All'))
+        sub_levels = death_data.loc[death_data[local_col] == local, sub_col].dropna().unique()
+        regions.extend((local, sub_level) for sub_level in sub_levels)
+    return regions
+
+
+@tracing.flushed
+def forecast_region(scope, local, local_sub_level):
+    mu.set_params(mu.DEFAULT_PARAMS[scope])
+    forecast_fun = mu.get_metrics_by_country if scope == 'World' else mu.get_metrics_by_state
+    policy_change_dates = mu.get_default_policy_change_dates(scope, local)
+    start = time.time()
+    daily, cumulative, model_beta = forecast_fun(local, local_sub_level,
+                                                 scope=scope,
+                                                 forecast_horizon=DEFAULT_FORECAST_HORIZON,
+                                                 policy_change_dates=policy_change_dates,
+                                                 back_test=False, last_data_date=dt.date.today(),
+                                                 use_vaccine_data=(scope != 'VN'))
+    breaks = mu.get_policy_effective_dates(policy_change_dates)
+    return daily, cumulative, model_beta, breaks, time.time() - start
+
+
+def precompute(scopes=('World', 'US', 'VN'), n_jobs=None, store_file=fs.STORE_FILE, archive_dir=fa.ARCHIVE_DIR):
+    run_date = dt.date.today()
+    mu.preload_data(scopes)
+    tasks = [(scope, local, local_sub_level) for scope in scopes for local, local_sub_level in get_regions(scope)]
+    print('Forecasting {} regions'.format(len(tasks)))
+    failed = []
+    archive_rows = []
+    conn = fs.connect(store_file)
+    # fork so the workers inherit the preloaded data instead of downloading it again
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {executor.submit(forecast_region, *task): task for task in tasks}
+        for future in as_completed(futures):
+            scope, local, local_sub_level = futures[future]
+            try:
+                daily, cumulative, model_beta, breaks, seconds = future.result()
+            except (ValueError, IndexError, KeyError) as e:
+                failed.append((scope, local, local_sub_level, repr(e)))
+                continue
+            fs.save_forecast(conn, scope, local, local_sub_level, run_date, daily, cumulative, model_beta)
+            archive_rows.append(fa.to_row(scope, local, local_sub_level, run_date, daily, model_beta, breaks))
+            print('{}, {}, {}: {:.1f}s'.format(scope, local, local_sub_level, seconds))
+    conn.close()
+    fa.append_forecasts(archive_rows, archive_dir)
+    print('Stored {} regions, {} failed'.format(len(tasks) - len(failed), len(failed)))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute default forecasts for every region')
+    parser.add_argument('-s', '--scopes', nargs='+', default=['World', 'US', 'VN'], choices=['World', 'US', 'VN'])
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes, default to CPUs')
+    parser.add_argument('--store', default=fs.STORE_FILE, help='sqlite file the app reads from')
+    parser.add_argument('--archive', default=fa.ARCHIVE_DIR, help='directory of the forecast archive')
+    args = parser.parse_args()
+    precompute(scopes=args.scopes, n_jobs=args.jobs, store_file=args.store, archive_dir=args.archive)
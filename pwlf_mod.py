@@ -29,6 +29,7 @@ from scipy.optimize import fmin_l_bfgs_b
 from scipy import linalg
 from scipy import stats
 from pyDOE import lhs
+import tracing
 
 # piecewise linear fit library
 
@@ -241,6 +242,7 @@ class PiecewiseLinFit(object):
         self.intercepts = None
         self.se = None
 
+    @tracing.traced('pwlf.assemble_regression_matrix')
     def assemble_regression_matrix(self, breaks, x):
         r"""
         Assemble the linear regression matrix A
@@ -304,6 +306,7 @@ class PiecewiseLinFit(object):
         self.n_parameters = A.shape[1]
         return A
 
+    @tracing.traced('pwlf.fit_with_breaks')
     def fit_with_breaks(self, breaks):
         r"""
         A function which fits a continuous piecewise linear function
@@ -454,6 +457,7 @@ class PiecewiseLinFit(object):
         L = self.conlstsq(A)
         return L
 
+    @tracing.traced('pwlf.predict')
     def predict(self, x, beta=None, breaks=None):
         r"""
         Evaluate the fitted continuous piecewise linear function at untested
@@ -1240,6 +1244,7 @@ class PiecewiseLinFit(object):
         except linalg.LinAlgError:
             raise linalg.LinAlgError('Singular matrix')
 
+    @tracing.traced('pwlf.prediction_variance')
     def prediction_variance(self, x):
         r"""
         Calculate the prediction variance for each specified x location. The
@@ -1473,6 +1478,7 @@ class PiecewiseLinFit(object):
         p = 2.0 * stats.t.sf(np.abs(t), df=n-k-1)
         return p
 
+    @tracing.traced('pwlf.lstsq')
     def lstsq(self, A):
         r"""
         Perform the least squares fit for A matrix.
@@ -0,0 +1,114 @@
+"""Response surface of the death forecast over the relax date of the last policy and the contain rate after it, for
+demos where these change with a slider. The model is fitted once; every relax date and contain rate of the grid is then
+predicted in one batch, and a slider change is a lookup of the relax date and an interpolation of the contain rate"""
+import threading
+import datetime as dt
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import model_utils as mu
+import simulation as sim
+
+RELAX_DAYS = np.arange(1, 61)
+CONTAIN_RATES = np.linspace(0, 1, 21)
+MAX_FORECAST_HORIZON = 180
+SURFACE_CACHE_SIZE = 16
+
+
+def build_surface(local_death_data, policy_change_dates=[], relax_dates=None, contain_rates=CONTAIN_RATES,
+                  forecast_horizon=MAX_FORECAST_HORIZON):
+    """Log daily death forecast for every relax date and contain rate, as get_log_daily_predicted_death with the relax
+    date added to the policy change dates would give.
+    A relax date shows in the deaths after the last data, so its segment has no data and uses the default last slope:
+    it does not change the fit, only the last slope, linear in the contain rate, and the variance after it.
+    relax_dates: dates the last policy ends, after the last data date minus the delay to death, default RELAX_DAYS
+    after the last data date
+    out: dict of the forecast dates, data_end_date, relax_dates, contain_rates, log_predicted_death (relax dates x
+    contain rates x dates), log_predicted_death_sd (relax dates x dates), model_beta (contain rates x betas, relax slope
+    last) and log_daily_death the fitted data"""
+    relax_dates = pd.to_datetime(local_death_data.index[-1] + pd.to_timedelta(RELAX_DAYS, unit='D')
+                                 if relax_dates is None else relax_dates)
+    # Any relax date of the grid gives the same fit, with the relax slope of the contain rate last
+    fit = mu.fit_log_daily_death(local_death_data, forecast_horizon + sim.EXTRA_DAYS,
+                                 list(policy_change_dates) + [relax_dates[0].date()], contain_rates[0])
+    regr_pw, break_points, forecast_time_idx = fit['regr_pw'], fit['break_points'], fit['forecast_time_idx']
+    data_end_date_idx = forecast_time_idx[-1] - forecast_horizon - sim.EXTRA_DAYS
+    relax_idx = (mu.get_policy_effective_dates(relax_dates) - fit['forecast_date_index'][0]).days.values
+    if relax_idx[0] != break_points[-2] or relax_idx.min() <= data_end_date_idx:
+        raise ValueError('Relax dates must show in the deaths after the last data date')
+    betas = fit['model_beta'][:-1]
+    previous_slope = betas[-1]
+    relax_slopes = -previous_slope*(1 - contain_rates if previous_slope < 0 else 1 + contain_rates)
+
+    A = regr_pw.assemble_regression_matrix(break_points, forecast_time_idx)[:, :-1]
+    ramps = np.clip(forecast_time_idx[None, :] - relax_idx[:, None], 0, None)
+    log_predicted_death = np.dot(A, betas)[None, None, :] + ramps[:, None, :]*relax_slopes[None, :, None]
+    # Same variance as get_log_daily_predicted_death: the fitted one up to the relax break, then growing with the days
+    # after it from its value on the first day after the break
+    pred_var = 7*regr_pw.prediction_variance(forecast_time_idx)
+    first_after = np.searchsorted(forecast_time_idx, relax_idx, side='right')
+    log_predicted_death_var = np.where(ramps > 0, pred_var[first_after][:, None]*ramps, pred_var[None, :])
+    return {'dates': fit['forecast_date_index'], 'data_end_date': fit['forecast_date_index'][data_end_date_idx],
+            'relax_dates': relax_dates, 'contain_rates': contain_rates,
+            'log_predicted_death': log_predicted_death, 'log_predicted_death_sd': np.sqrt(log_predicted_death_var),
+            'model_beta': np.column_stack([np.repeat(betas[None, :], len(contain_rates), axis=0), relax_slopes]),
+            'log_daily_death': fit['log_daily_death_orig']}
+
+
+def lookup(surface, relax_date, contain_rate):
+    """Log daily death forecast of one relax date of the grid and any contain rate in its range, interpolated
+    linearly between the two nearest grid rates, exact as the forecast is linear in the contain rate.
+    out: (frame of predicted_death, lower_bound and upper_bound indexed by date, model_beta)"""
+    relax = surface['relax_dates'].get_loc(pd.Timestamp(relax_date))
+    contain_rates = surface['contain_rates']
+    if not contain_rates[0] <= contain_rate <= contain_rates[-1]:
+        raise ValueError('contain_rate {} out of the surface range'.format(contain_rate))
+    upper = min(max(np.searchsorted(contain_rates, contain_rate), 1), len(contain_rates) - 1)
+    weight = (contain_rate - contain_rates[upper - 1])/(contain_rates[upper] - contain_rates[upper - 1])
+    log_predicted_death = (1 - weight)*surface['log_predicted_death'][relax, upper - 1] + \
+        weight*surface['log_predicted_death'][relax, upper]
+    model_beta = (1 - weight)*surface['model_beta'][upper - 1] + weight*surface['model_beta'][upper]
+    log_sd = surface['log_predicted_death_sd'][relax]
+    return pd.DataFrame({'predicted_death': log_predicted_death,
+                         'lower_bound': log_predicted_death - 1.96*log_sd,
+                         'upper_bound': log_predicted_death + 1.96*log_sd}, index=surface['dates']), model_beta
+
+
+def get_daily_metrics(log_predicted_death, test_rate=0.2):
+    """Daily metrics derived from a lookup like get_daily_metrics_from_death_data. Each metric has its lower and upper
+    bound, derived from the death bounds and inflated by 1/sqrt(test_rate) except for the death.
+    out: frame indexed by date with columns (metric, 'value', 'lower_bound' or 'upper_bound')"""
+    daily_death = np.exp(log_predicted_death[['lower_bound', 'predicted_death', 'upper_bound']].values.T)
+    frames = []
+    for metric, (first_date, paths) in sim.get_path_metrics(daily_death, log_predicted_death.index[0],
+                                                            test_rate).items():
+        frames.append(pd.DataFrame(paths.T, index=pd.date_range(first_date, periods=paths.shape[1]),
+                                   columns=pd.MultiIndex.from_product([[metric],
+                                                                       ['lower_bound', 'value', 'upper_bound']])))
+    return pd.concat(frames, axis=1, sort=True)
+
+
+class SurfaceCache(object):
+    """Surfaces by region, policy change dates, model parameters and day, shared by all sessions"""
+
+    def __init__(self, max_size=SURFACE_CACHE_SIZE):
+        self.max_size = max_size
+        self._surfaces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build_fun):
+        key = key + (dt.date.today(), tuple(sorted(mu.get_params().items())))
+        with self._lock:
+            surface = self._surfaces.get(key)
+            if surface is not None:
+                self._surfaces.move_to_end(key)
+        if surface is None:
+            surface = build_fun()
+            with self._lock:
+                self._surfaces[key] = surface
+                while len(self._surfaces) > self.max_size:
+                    self._surfaces.popitem(last=False)
+        return surface
+
+
+surface_cache = SurfaceCache()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Score archived quantile submissions of forecast_utils against the deaths reported later: weighted interval score
+(WIS), coverage of each quantile and central interval, and absolute error of the point forecast"""
+import argparse
+import glob
+import numpy as np
+import pandas as pd
+import model_utils as mu
+import epiweek_utils as ew
+import forecast_utils as fu
+
+SUBMISSION_FILES = 'data_processed/*-AIpert-pwllnod.csv'
+KEY_COLUMNS = ['forecast_date', 'location', 'target', 'target_end_date']
+# Quantile columns of the score matrix, the median is in the middle with matching lower and upper quantiles around it
+QUANTILES = np.concatenate([fu.LOWER_QUANTILES, [0.5], fu.UPPER_QUANTILES])
+# Central interval between each lower quantile and its symmetric upper quantile leaves out ALPHAS of the distribution
+ALPHAS = 2*fu.LOWER_QUANTILES
+
+
+def load_submissions(files=SUBMISSION_FILES):
+    """Rows of every submission file matching the glob pattern, or list of files"""
+    files = sorted(glob.glob(files)) if isinstance(files, str) else files
+    files = [file for file in files if not file.endswith('-timings.csv')]
+    if not files:
+        raise ValueError('No submission file found in {}'.format(files))
+    submissions = pd.concat([pd.read_csv(file, dtype={'location': str}) for file in files], ignore_index=True)
+    submissions['forecast_date'] = pd.to_datetime(submissions.forecast_date)
+    submissions['target_end_date'] = pd.to_datetime(submissions.target_end_date)
+    return submissions
+
+
+def get_weekly_truth(scopes=('US',)):
+    """Incident and cumulative deaths reported at each epiweek end date, by submission location:
+    FIPS code of the US states and US for the whole country, name of the countries.
+    out: frame of location, target_end_date, target_aggr ('inc' or 'cum') and truth"""
+    weekly = []
+    for scope in scopes:
+        if scope == 'US':
+            deaths = mu.get_data(scope='US', type='deaths')
+            by_local = deaths.groupby('State')[deaths.columns[12:]].sum()
+            by_local.loc['US'] = by_local.sum()
+            codes = fu.fips.drop_duplicates('location_name').set_index('location_name').location
+            by_local = by_local[by_local.index.isin(codes.index)]
+            by_local.index = codes[by_local.index].values
+        else:
+            deaths = mu.get_data(scope='global', type='deaths')
+            by_local = deaths.groupby('Country')[deaths.columns[4:]].sum()
+        dates = ew.to_days(by_local.columns)
+        is_week_end = ew.get_epiweek_enddates(dates) == dates
+        cum = by_local.values[:, is_week_end].astype(np.float64)
+        inc = np.concatenate([np.full((len(cum), 1), np.nan), np.diff(cum, axis=1)], axis=1)
+        week_ends = pd.to_datetime(dates[is_week_end])
+        for target_aggr, values in [('inc', inc), ('cum', cum)]:
+            weekly.append(pd.DataFrame({'location': np.repeat(by_local.index.values, len(week_ends)),
+                                        'target_end_date': np.tile(week_ends, len(by_local)),
+                                        'target_aggr': target_aggr,
+                                        'truth': values.ravel()}))
+    return pd.concat(weekly, ignore_index=True).dropna(subset=['truth'])
+
+
+def score_forecasts(submissions, truth):
+    """Score every target of the submissions that has a reported value.
+    out: one row per forecast_date, location and target with its horizon in weeks, the truth, the point and median
+    forecast, wis with its dispersion, underprediction and overprediction parts, abs_error of the point forecast,
+    coverage_<level> of each central interval (1 if the truth is inside) and below_<quantile> of each quantile
+    (1 if the truth is at or below it)"""
+    is_quantile = submissions['type'].values == 'quantile'
+    quantiles = submissions[is_quantile].set_index(KEY_COLUMNS + ['quantile']).value.unstack('quantile')
+    quantiles = quantiles.reindex(columns=QUANTILES).dropna()
+    point = submissions[~is_quantile].set_index(KEY_COLUMNS).value.rename('point')
+    scores = quantiles.index.to_frame(index=False)
+    target_parts = scores.target.str.extract(r'(\d+) wk ahead (\w+) ')
+    scores['horizon'] = target_parts[0].astype(int).values
+    scores['target_aggr'] = target_parts[1].values
+    scores['point'] = point.reindex(quantiles.index).values
+    scores = scores.merge(truth, on=['location', 'target_end_date', 'target_aggr'], how='left')
+    has_truth = scores.truth.notna().values
+    scores = scores[has_truth].reset_index(drop=True)
+    values = quantiles.values[has_truth]
+
+    y = scores.truth.values[:, None]
+    median = values[:, len(fu.LOWER_QUANTILES)]
+    lower = values[:, :len(fu.LOWER_QUANTILES)]
+    upper = values[:, :len(fu.LOWER_QUANTILES):-1]
+    # WIS = (|y - median|/2 + sum of alpha/2 * interval score) / (K + 1/2), interval score split in its three parts
+    weights = ALPHAS/2
+    n_weights = len(ALPHAS) + 0.5
+    scores['dispersion'] = ((upper - lower)*weights).sum(axis=1)/n_weights
+    scores['underprediction'] = ((y - upper).clip(min=0)*2/ALPHAS*weights).sum(axis=1)/n_weights + \
+        (scores.truth.values - median).clip(min=0)/2/n_weights
+    scores['overprediction'] = ((lower - y).clip(min=0)*2/ALPHAS*weights).sum(axis=1)/n_weights + \
+        (median - scores.truth.values).clip(min=0)/2/n_weights
+    scores['wis'] = scores.dispersion + scores.underprediction + scores.overprediction
+    scores['median'] = median
+    scores['abs_error'] = np.abs(scores.point.values - scores.truth.values)
+    coverage = ((lower <= y) & (y <= upper)).astype(np.float64)
+    below = (y <= values).astype(np.float64)
+    return pd.concat([scores,
+                      pd.DataFrame(coverage, columns=['coverage_{:g}'.format(100*(1-alpha)) for alpha in ALPHAS]),
+                      pd.DataFrame(below, columns=['below_{:g}'.format(quantile) for quantile in QUANTILES])],
+                     axis=1)
+
+
+def summarize_scores(scores, by=('location',)):
+    """Mean of every score by group, with the number of targets scored"""
+    by = list(by)
+    columns = ['wis', 'dispersion', 'underprediction', 'overprediction', 'abs_error'] + \
+        [column for column in scores.columns if column.startswith(('coverage_', 'below_'))]
+    summary = scores.groupby(by)[columns].mean()
+    summary.insert(0, 'n_targets', scores.groupby(by).size())
+    return summary.reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score archived forecast submissions against reported deaths')
+    parser.add_argument('-f', '--files', default=SUBMISSION_FILES, help='glob pattern of the submission files')
+    parser.add_argument('-s', '--scopes', nargs='+', default=['US'], choices=['US', 'World'])
+    parser.add_argument('-b', '--by', nargs='+', default=['location'],
+                        choices=['location', 'horizon', 'forecast_date', 'target_aggr', 'target_end_date'])
+    parser.add_argument('-o', '--output', default=None, help='csv file for the scores of every target')
+    args = parser.parse_args()
+    scores = score_forecasts(load_submissions(args.files), get_weekly_truth(args.scopes))
+    if args.output is not None:
+        scores.to_csv(args.output, index=False)
+    print(summarize_scores(scores, args.by).to_string(index=False))
@@ -0,0 +1,105 @@
+"""Sensitivity of the forecast to the policy change dates: refit the death model with each policy date shifted by up to
+max_shift days and compare the fits. All variants are solved together on the data prepared for the given dates"""
+import itertools
+import numpy as np
+import pandas as pd
+import model_utils as mu
+
+MAX_VARIANTS = 20000
+
+
+def get_regression_matrices(breaks, x):
+    """Piecewise linear regression matrices of pwlf for many break point sets at once.
+    breaks: array variants x break points, x: days
+    out: array variants x len(x) x number of betas"""
+    x = np.asarray(x, dtype=np.float64)[None, :, None]
+    inner_breaks = breaks[:, None, 1:-1]
+    return np.concatenate([np.ones((len(breaks), x.shape[1], 1)),
+                           x - breaks[:, None, :1],
+                           np.where(x > inner_breaks, x - inner_breaks, 0.0)], axis=2)
+
+
+def get_shifted_breaks(break_points, max_shift=7, step=1):
+    """Every combination of the inner break points shifted by -max_shift to max_shift days.
+    out: (shifts, array variants x inner break points; breaks, array variants x break points)"""
+    n_inner = len(break_points) - 2
+    day_shifts = np.arange(-max_shift, max_shift + 1, step)
+    n_variants = len(day_shifts)**n_inner
+    if n_variants > MAX_VARIANTS:
+        raise ValueError('{} variants to fit, reduce max_shift or increase step'.format(n_variants))
+    shifts = np.array(list(itertools.product(day_shifts, repeat=n_inner)), dtype=np.float64).reshape(n_variants,
+                                                                                                      n_inner)
+    breaks = np.repeat(np.asarray(break_points, dtype=np.float64)[None, :], n_variants, axis=0)
+    breaks[:, 1:-1] += shifts
+    return shifts, breaks
+
+
+def sweep_policy_dates(local_death_data, forecast_horizon=60, policy_change_dates=[], contain_rate=0.8,
+                       pop_ratio=None, max_shift=7, step=1):
+    """Fit the death model for every combination of policy dates shifted by -max_shift to max_shift days.
+    The data are prepared once for the given dates, outliers removed and days after each change left out, and
+    shared by all variants so their sums of squared residuals compare.
+    out: (variants frame, one row per variant with the shift and policy date of each change, ssr and whether the
+    default last slope is used, sorted by ssr; dict of predicted_death, lower_bound and upper_bound frames indexed by
+    date with one column per variant)"""
+    fit = mu.fit_log_daily_death(local_death_data, forecast_horizon, policy_change_dates, contain_rate, pop_ratio)
+    regr_pw = fit['regr_pw']
+    x, y = regr_pw.x_data, regr_pw.y_data
+    forecast_time_idx = fit['forecast_time_idx']
+    data_end_date_idx = forecast_time_idx[-1] - forecast_horizon
+    shifts, breaks = get_shifted_breaks(fit['break_points'], max_shift, step)
+    # A break at or before the first day or not in increasing order leaves a segment without meaning
+    is_valid = (np.diff(breaks, axis=1) > 0).all(axis=1)
+
+    A = get_regression_matrices(breaks, x)
+    AtA_inv = np.linalg.pinv(np.einsum('vnp,vnq->vpq', A, A))
+    betas = np.einsum('vpq,vnq,n->vp', AtA_inv, A, y)
+    residuals = y[None, :] - np.einsum('vnp,vp->vn', A, betas)
+    ssr = (residuals**2).sum(axis=1)
+    smoothing_days = 7
+    variance = smoothing_days*ssr/(len(y) - betas.shape[1])
+
+    A_forecast = get_regression_matrices(breaks, forecast_time_idx)
+    pred_var = variance[:, None]*np.einsum('vtp,vpq,vtq->vt', A_forecast, AtA_inv, A_forecast)
+    # Same default last slope rule as get_log_daily_predicted_death, applied to each variant
+    default_last_slope = ((data_end_date_idx - breaks[:, -2]) < 4) | \
+        (betas[:, -1] > np.maximum(0.3, np.abs(betas[:, 1])))
+    previous_slope = betas[:, -2]
+    betas[:, -1] = np.where(default_last_slope,
+                            -previous_slope*np.where(previous_slope < 0, 1 - contain_rate, 1 + contain_rate),
+                            betas[:, -1])
+    last_break = breaks[:, -2:-1]
+    after_last_break = forecast_time_idx[None, :] > last_break
+    last_break_var = np.take_along_axis(pred_var, (forecast_time_idx[None, :] <= last_break).sum(axis=1,
+                                                                                                keepdims=True)
+                                        .clip(max=len(forecast_time_idx) - 1), axis=1)
+    pred_var = np.where(default_last_slope[:, None] & after_last_break,
+                        last_break_var*(forecast_time_idx[None, :] - last_break), pred_var)
+    log_predicted_death = np.einsum('vtp,vp->vt', A_forecast, betas)
+    if pop_ratio is not None:
+        log_predicted_death += np.log(pd.Series(pop_ratio).reindex(fit['forecast_date_index']).values)
+    log_predicted_death[~is_valid] = np.nan
+
+    delay = mu.INFECT_2_HOSPITAL_TIME + mu.HOSPITAL_2_ICU_TIME + mu.ICU_2_DEATH_TIME
+    data_start_date = fit['forecast_date_index'][0]
+    variants = pd.DataFrame({'ssr': np.where(is_valid, ssr, np.nan), 'default_last_slope': default_last_slope})
+    for i in range(shifts.shape[1]):
+        variants['shift_{}'.format(i + 1)] = shifts[:, i].astype(int)
+        variants['policy_date_{}'.format(i + 1)] = data_start_date + pd.to_timedelta(breaks[:, i + 1] - delay,
+                                                                                     unit='D')
+    forecasts = {name: pd.DataFrame(np.exp(values).T, index=fit['forecast_date_index'])
+                 for name, values in [('predicted_death', log_predicted_death),
+                                      ('lower_bound', log_predicted_death - 1.96*np.sqrt(pred_var)),
+                                      ('upper_bound', log_predicted_death + 1.96*np.sqrt(pred_var))]}
+    return variants.sort_values('ssr', kind='mergesort'), forecasts
+
+
+def get_forecast_envelope(variants, forecasts, n_best=None):
+    """Lowest lower bound, highest upper bound and range of the predicted death of the n_best variants by ssr,
+    default all variants"""
+    best = variants.index[:n_best] if n_best is not None else variants.index
+    predicted = forecasts['predicted_death'][best]
+    return pd.DataFrame({'predicted_death_min': predicted.min(axis=1),
+                         'predicted_death_max': predicted.max(axis=1),
+                         'lower_bound': forecasts['lower_bound'][best].min(axis=1),
+                         'upper_bound': forecasts['upper_bound'][best].max(axis=1)})
@@ -0,0 +1,65 @@
+"""Monte Carlo uncertainty of every metric: sample the betas of the death model from their fitted covariance, predict
+all death paths with one matrix product and derive the other metrics of each path in batch"""
+import numpy as np
+import pandas as pd
+import model_utils as mu
+import death_kernel as dk
+
+DEFAULT_N_SAMPLES = 2000
+DEFAULT_QUANTILES = (0.025, 0.25, 0.5, 0.75, 0.975)
+# Days added to the horizon so occupancy at the end of the horizon counts patients who die later,
+# as get_daily_metrics_from_death_data does
+EXTRA_DAYS = dk.EXTRA_DAYS
+
+
+def sample_betas(fit, n_samples=DEFAULT_N_SAMPLES, contain_rate=0.8, seed=None):
+    """Betas drawn from the fitted covariance, centered on the betas used to forecast.
+    When the forecast uses the default last slope, each sample gets the default slope of its own previous slope
+    out: array n_samples x number of betas"""
+    betas = np.random.RandomState(seed).multivariate_normal(fit['model_beta'], fit['beta_cov'], size=n_samples)
+    if fit['default_last_slope']:
+        previous_slope = betas[:, -2]
+        betas[:, -1] = -previous_slope*np.where(previous_slope < 0, 1 - contain_rate, 1 + contain_rate)
+    return betas
+
+
+def simulate_daily_death(fit, betas, pop_ratio=None):
+    """Daily death paths of beta samples, array n_samples x days of fit['forecast_date_index']"""
+    A = fit['regr_pw'].assemble_regression_matrix(fit['break_points'], fit['forecast_time_idx'])
+    log_paths = np.dot(betas, A.T)
+    if pop_ratio is not None:
+        log_paths += np.log(pd.Series(pop_ratio).reindex(fit['forecast_date_index']).values)
+    return np.exp(log_paths)
+
+
+def get_path_metrics(daily_death, start_date, test_rate=0.2):
+    """Metrics derived from death paths like get_daily_metrics_from_death_data, each as (first date, paths).
+    Spread of derived metrics around their median path is inflated by 1/sqrt(test_rate)"""
+    metrics = {'predicted_death': (start_date, daily_death)}
+    for metric, (offset, paths) in dk.derive_metrics(daily_death, mu.get_params()).items():
+        metrics[metric] = (start_date + pd.Timedelta(days=offset), paths)
+    for metric, (first_date, paths) in metrics.items():
+        if metric != 'predicted_death':
+            median = np.nanmedian(paths, axis=0)
+            metrics[metric] = (first_date, median + (paths - median)/np.sqrt(test_rate))
+    return metrics
+
+
+def simulate_daily_metrics(local_death_data, forecast_horizon=60, policy_change_dates=[], contain_rate=0.8,
+                           test_rate=0.2, pop_ratio=None, n_samples=DEFAULT_N_SAMPLES, quantiles=DEFAULT_QUANTILES,
+                           seed=None):
+    """Empirical quantiles of every daily metric over n_samples simulated paths.
+    out: frame indexed by date with columns (metric, quantile), for the metrics of get_daily_metrics_from_death_data
+    derived from predicted death, and the fitted model_beta"""
+    fit = mu.fit_log_daily_death(local_death_data, forecast_horizon+EXTRA_DAYS, policy_change_dates, contain_rate,
+                                 pop_ratio)
+    betas = sample_betas(fit, n_samples, contain_rate, seed)
+    daily_death = simulate_daily_death(fit, betas, pop_ratio)
+    forecast_end_date = fit['forecast_date_index'][-1] - pd.Timedelta(days=EXTRA_DAYS)
+    frames = []
+    for metric, (first_date, paths) in get_path_metrics(daily_death, fit['forecast_date_index'][0],
+                                                        test_rate).items():
+        frames.append(pd.DataFrame(np.nanquantile(paths, quantiles, axis=0).T,
+                                   index=pd.date_range(first_date, periods=paths.shape[1]),
+                                   columns=pd.MultiIndex.from_product([[metric], quantiles])))
+    return pd.concat(frames, axis=1, sort=True).loc[:forecast_end_date], fit['model_beta']
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+"""Timing spans of the forecast pipeline stages.
+Tracing is off by default and a span then costs one global lookup. Turn it on with enable() or by setting the
+TRACE_FILE environment variable to a JSON lines file, '{pid}' in the name is replaced by the process id. Finished spans
+are kept in memory until flush() appends them to the file, at exit, every FLUSH_SPANS spans and after each call of a
+function decorated with flushed, the tasks of the process pools whose workers do not run exit handlers.
+Each span has its name, start and duration in microseconds, process, thread, parent span and tags, the tags of the
+enclosing spans included (region, forecast parameters..). Run this module to merge JSON lines files into a Chrome trace
+that chrome://tracing or https://ui.perfetto.dev can open.
+In memory mode, enable(memory=True) or TRACE_MEMORY set to the number of traceback frames to keep, spans also record
+the memory allocated by Python with tracemalloc and the resident set size sampled every RSS_INTERVAL seconds: allocated
+and still held at the end of the span, peak above the start and peak RSS, in KB. Spans named in SNAPSHOT_SPANS also
+list the call sites of the memory they still hold at their end, biggest first. Running this module with budgets fails
+when a span goes over them."""
+import os
+import json
+import time
+import atexit
+import argparse
+import functools
+import threading
+import tracemalloc
+
+TRACE_ENV = 'TRACE_FILE'
+MEMORY_ENV = 'TRACE_MEMORY'
+# Frames of the traceback of each allocation kept by tracemalloc by default. The call site of an allocation is its
+# innermost frame in the files of SITE_DIR, the line in pandas or numpy when no frame is kept that deep. Each frame
+# makes the allocations slower, 5 frames is about 4 times as slow as 1 in pandas heavy stages
+MEMORY_FRAMES = 1
+SITE_DIR = os.path.dirname(os.path.abspath(__file__))
+RSS_INTERVAL = 0.01
+SNAPSHOT_SPANS = ('forecast_location', 'get_metrics')
+TOP_SITES = 10
+# Finished spans kept in memory before they are appended to the trace file, long running processes such as the app
+# server would otherwise hold them all until they exit
+FLUSH_SPANS = 1000
+
+_enabled = False
+_trace_file = None
+_spans = []
+_spans_lock = threading.Lock()
+_memory = False
+# Spans of every thread measuring memory, tracemalloc and RSS are per process
+_memory_spans = []
+_memory_lock = threading.Lock()
+_sampler = None
+# Traced bytes of the snapshots held by open spans
+_snapshot_bytes = 0
+# Open spans of each thread, innermost last
+_local = threading.local()
+
+
+class _NoSpan(object):
+    """Span returned when tracing is off, does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set_tag(self, key, value):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Span(object):
+    __slots__ = ('name', 'tags', 'parent', 'start', 'memory')
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack else None
+        if self.parent is not None:
+            self.tags = dict(self.parent.tags, **self.tags)
+        stack.append(self)
+        self.memory = _start_memory(self) if _memory else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _local.stack.pop()
+        record = {'name': self.name,
+                  'start_us': int((self.start - _clock_offset)*1e6),
+                  'duration_us': int(duration*1e6),
+                  'pid': os.getpid(),
+                  'thread': threading.current_thread().name,
+                  'parent': None if self.parent is None else self.parent.name,
+                  'tags': self.tags}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        if self.memory is not None:
+            record['memory'] = _end_memory(self)
+        with _spans_lock:
+            _spans.append(record)
+            n_spans = len(_spans)
+        if n_spans >= FLUSH_SPANS and _trace_file is not None:
+            flush()
+        return False
+
+    def set_tag(self, key, value):
+        self.tags[key] = value
+
+
+def get_rss_kb():
+    """Resident set size of this process, the peak one where /proc is missing"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')//1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Peak of the traced memory since the last reset, since tracing started before Python 3.9
+_reset_peak = getattr(tracemalloc, 'reset_peak', lambda: None)
+
+
+def _update_peaks():
+    """Fold the traced and RSS peaks since the last call into every open span, with _memory_lock held.
+    Snapshots held by open spans are left out of the traced memory"""
+    current, peak = tracemalloc.get_traced_memory()
+    _reset_peak()
+    rss = get_rss_kb()
+    for open_span in _memory_spans:
+        open_span.memory[1] = max(open_span.memory[1], peak - _snapshot_bytes)
+        open_span.memory[3] = max(open_span.memory[3], rss)
+    return current - _snapshot_bytes, rss
+
+
+def _take_snapshot():
+    """Snapshot of the traced memory and the bytes it takes, with _memory_lock held. The peak while taking it is
+    dropped"""
+    before = tracemalloc.get_traced_memory()[0]
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                          tracemalloc.Filter(False, __file__)])
+    size = tracemalloc.get_traced_memory()[0] - before
+    _reset_peak()
+    return snapshot, size
+
+
+def _start_memory(span):
+    """[traced bytes at start, traced peak, RSS KB at start, RSS peak, (snapshot at start, its bytes) or None]"""
+    global _snapshot_bytes
+    with _memory_lock:
+        _update_peaks()
+        snapshot = None
+        if span.name in SNAPSHOT_SPANS:
+            snapshot = _take_snapshot()
+            _snapshot_bytes += snapshot[1]
+        current, rss = _update_peaks()
+        span.memory = [current, current, rss, rss, snapshot]
+        _memory_spans.append(span)
+    return span.memory
+
+
+def _end_memory(span):
+    global _snapshot_bytes
+    with _memory_lock:
+        current, rss = _update_peaks()
+        _memory_spans.remove(span)
+        start, peak, start_rss, rss_peak, snapshot = span.memory
+        memory = {'alloc_kb': (current - start)//1024, 'peak_kb': (peak - start)//1024, 'rss_kb': rss,
+                  'rss_peak_kb': rss_peak, 'rss_start_kb': start_rss}
+        if snapshot is not None:
+            end_snapshot, _ = _take_snapshot()
+            memory['top_sites'] = get_sites(end_snapshot.compare_to(snapshot[0], 'traceback'))
+            _snapshot_bytes -= snapshot[1]
+            span.memory = end_snapshot = snapshot = None
+    return memory
+
+
+def get_sites(stats, n=TOP_SITES):
+    """Biggest positive size differences of tracemalloc statistics by call site.
+    out: list of [site 'file:line', KB, number of blocks]"""
+    sites = {}
+    for stat in stats:
+        if stat.size_diff <= 0:
+            continue
+        frame = next((frame for frame in reversed(stat.traceback) if frame.filename.startswith(SITE_DIR)),
+                     stat.traceback[-1])
+        site = '{}:{}'.format(os.path.relpath(frame.filename, SITE_DIR) if frame.filename.startswith(SITE_DIR)
+                              else frame.filename, frame.lineno)
+        size, count = sites.get(site, (0, 0))
+        sites[site] = (size + stat.size_diff, count + stat.count_diff)
+    return [[site, size//1024, count]
+            for site, (size, count) in sorted(sites.items(), key=lambda item: -item[1][0])[:n]]
+
+
+def _sample_rss():
+    while _memory:
+        with _memory_lock:
+            if _memory_spans:
+                rss = get_rss_kb()
+                for open_span in _memory_spans:
+                    open_span.memory[3] = max(open_span.memory[3], rss)
+        time.sleep(RSS_INTERVAL)
+
+
+def _start_sampler():
+    global _sampler
+    _sampler = threading.Thread(target=_sample_rss, name='rss_sampler', daemon=True)
+    _sampler.start()
+
+
+def _reset_memory():
+    """Threads do not survive a fork, forked workers sample their own RSS"""
+    global _memory_lock
+    _memory_lock = threading.Lock()
+    del _memory_spans[:]
+    if _memory:
+        _start_sampler()
+
+
+def _after_fork():
+    """Forked workers record and flush their own spans from a clean state, the unflushed spans of the parent are its
+    to flush and would be written twice otherwise"""
+    global _spans, _spans_lock
+    _spans, _spans_lock = [], threading.Lock()
+    _local.stack = []
+    _reset_memory()
+
+
+# perf_counter has no fixed origin, spans are reported in microseconds since the epoch so processes line up
+_clock_offset = time.perf_counter() - time.time()
+
+
+def span(name, **tags):
+    """Context manager timing the enclosed stage, tags are values to filter or group spans by"""
+    if not _enabled:
+        return NO_SPAN
+    return Span(name, tags)
+
+
+def traced(name=None):
+    """Decorator timing every call of a function, as a span named name or module.function"""
+    def decorator(fun):
+        span_name = name or '{}.{}'.format(fun.__module__, fun.__qualname__)
+
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fun(*args, **kwargs)
+            with Span(span_name, {}):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def flushed(fun):
+    """Decorator of the tasks of process pools, flushing the spans of each call when it returns or raises: pool
+    workers do not run exit handlers"""
+    @functools.wraps(fun)
+    def wrapper(*args, **kwargs):
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            flush()
+    return wrapper
+
+
+def enable(trace_file=None, memory=False):
+    """Start recording spans, flushed to trace_file if given, with their memory use if memory, True or the number of
+    frames of the allocation tracebacks"""
+    global _enabled, _trace_file, _memory
+    _trace_file = trace_file
+    _enabled = True
+    if memory and not _memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_FRAMES if memory is True else int(memory))
+        _memory = True
+        _start_sampler()
+
+
+def disable():
+    global _enabled, _memory
+    _enabled = False
+    if _memory:
+        _memory = False
+        _sampler.join()
+        tracemalloc.stop()
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_spans(clear=False):
+    """Finished spans of this process not flushed yet"""
+    global _spans
+    with _spans_lock:
+        spans = _spans
+        if clear:
+            _spans = []
+        else:
+            spans = list(spans)
+    return spans
+
+
+def flush(trace_file=None):
+    """Append the finished spans to trace_file, default the file given to enable, as JSON lines.
+    One write per flush so processes sharing a file do not mix their lines"""
+    trace_file = trace_file or _trace_file
+    if trace_file is None:
+        return
+    spans = get_spans(clear=True)
+    if not spans:
+        return
+    path = trace_file.format(pid=os.getpid())
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    data = ''.join(json.dumps(record, default=str) + '\n' for record in spans).encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def read_spans(files):
+    spans = []
+    for file in files:
+        with open(file) as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+    return spans
+
+
+def to_chrome_trace(spans):
+    """Chrome trace event format of spans, complete events with the tags as arguments"""
+    return {'traceEvents': [{'name': record['name'], 'cat': record['name'].split('.')[0], 'ph': 'X',
+                             'ts': record['start_us'], 'dur': record['duration_us'], 'pid': record['pid'],
+                             'tid': record['thread'], 'args': record['tags']} for record in spans],
+            'displayTimeUnit': 'ms'}
+
+
+def summarize_memory(spans, by=('name',)):
+    """Number of calls, max and mean KB allocated and held at the end, max peak KB above the start and max RSS peak
+    of spans recorded in memory mode, by name or tags, biggest peak first"""
+    import pandas as pd
+    frame = pd.DataFrame([dict(record['tags'], name=record['name'], **record['memory'])
+                          for record in spans if 'memory' in record])
+    if frame.empty:
+        return frame
+    summary = frame.groupby(list(by)).agg(calls=('alloc_kb', 'count'), alloc_kb_max=('alloc_kb', 'max'),
+                                          alloc_kb_mean=('alloc_kb', 'mean'), peak_kb_max=('peak_kb', 'max'),
+                                          rss_peak_kb_max=('rss_peak_kb', 'max'))
+    return summary.sort_values('peak_kb_max', ascending=False).reset_index()
+
+
+def get_top_sites(spans, n=TOP_SITES):
+    """Call sites holding the most memory at the end of the snapshot spans, summed over the spans of each name.
+    Nested snapshot spans count their sites again in their parents, compare sites of the same span name"""
+    import pandas as pd
+    frame = pd.DataFrame([(record['name'], site, size_kb, count) for record in spans
+                          for site, size_kb, count in record.get('memory', {}).get('top_sites', [])],
+                         columns=['name', 'site', 'size_kb', 'count'])
+    top_sites = frame.groupby(['name', 'site'], as_index=False)[['size_kb', 'count']].sum()
+    return top_sites.sort_values('size_kb', ascending=False).groupby('name').head(n).reset_index(drop=True)
+
+
+def check_budgets(spans, budgets=None, rss_budget_mb=None):
+    """Spans over their memory budget: peak above their start over budgets[name] MB, or RSS peak over rss_budget_mb
+    out: list of (name, tags, 'peak' or 'rss', MB)"""
+    over = []
+    for record in spans:
+        memory = record.get('memory')
+        if memory is None:
+            continue
+        budget_mb = (budgets or {}).get(record['name'])
+        if budget_mb is not None and memory['peak_kb']/1024 > budget_mb:
+            over.append((record['name'], record['tags'], 'peak', memory['peak_kb']/1024))
+        if rss_budget_mb is not None and memory['rss_peak_kb']/1024 > rss_budget_mb:
+            over.append((record['name'], record['tags'], 'rss', memory['rss_peak_kb']/1024))
+    return over
+
+
+def summarize_spans(spans, by=('name',)):
+    """Number of calls and total, mean and max milliseconds of spans by name or tags, slowest total first"""
+    import pandas as pd
+    frame = pd.DataFrame([dict(record['tags'], name=record['name'], ms=record['duration_us']/1000)
+                          for record in spans])
+    summary = frame.groupby(list(by)).ms.agg(['count', 'sum', 'mean', 'max'])
+    summary.columns = ['calls', 'total_ms', 'mean_ms', 'max_ms']
+    return summary.sort_values('total_ms', ascending=False).reset_index()
+
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV], memory=int(os.environ.get(MEMORY_ENV) or 0))
+atexit.register(flush)
+os.register_at_fork(after_in_child=_after_fork)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge JSON lines span files into a Chrome trace and summarize them')
+    parser.add_argument('files', nargs='+', help='JSON lines files written with TRACE_FILE')
+    parser.add_argument('-o', '--output', default=None, help='Chrome trace json file')
+    parser.add_argument('-b', '--by', nargs='+', default=['name'], help='name and tags to summarize by')
+    parser.add_argument('--budget', nargs='+', default=[], metavar='NAME=MB',
+                        help='memory budgets of spans, peak MB allocated above their start')
+    parser.add_argument('--rss-budget', type=float, default=None, help='RSS budget in MB of every span')
+    args = parser.parse_args()
+    spans = read_spans(args.files)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(to_chrome_trace(spans), f)
+    print(summarize_spans(spans, args.by).to_string(index=False))
+    memory = summarize_memory(spans, args.by)
+    if not memory.empty:
+        print()
+        print(memory.to_string(index=False))
+        print()
+        print(get_top_sites(spans).to_string(index=False))
+    budgets = {name: float(mb) for name, mb in (budget.split('=') for budget in args.budget)}
+    over = check_budgets(spans, budgets, args.rss_budget)
+    for name, tags, kind, mb in over:
+        print('Over budget: {} {} {} {:.1f}MB'.format(name, tags, kind, mb))
+    if over:
+        raise SystemExit(1)
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import closing
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue(object):
+    """Tasks shared by workers on several machines through one sqlite file on shared storage.
+    A worker leases a task for lease_seconds and has to renew the lease while working on it. When a worker dies its
+    lease expires and the task is given to the next worker asking. The storage must support file locking"""
+
+    def __init__(self, queue_file):
+        self.queue_file = queue_file
+        os.makedirs(os.path.dirname(queue_file) or '.', exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+                                batch_id TEXT NOT NULL,
+                                task_id TEXT NOT NULL,
+                                position INTEGER NOT NULL,
+                                payload TEXT NOT NULL,
+                                status TEXT NOT NULL,
+                                worker_id TEXT,
+                                lease_expires REAL,
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                error TEXT,
+                                PRIMARY KEY (batch_id, task_id))''')
+            conn.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (batch_id, status, lease_expires)')
+            conn.commit()
+
+    def _connect(self):
+        # Autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE to take the write lock first
+        return sqlite3.connect(self.queue_file, timeout=60, isolation_level=None)
+
+    def add_tasks(self, batch_id, payloads):
+        """Add tasks numbered in the order given, tasks already in the queue are kept as they are"""
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR IGNORE INTO tasks (batch_id, task_id, position, payload, status) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             [(batch_id, '{:05d}'.format(position), position, json.dumps(payload), PENDING)
+                              for position, payload in enumerate(payloads)])
+            conn.execute('COMMIT')
+
+    def lease(self, batch_id, worker_id, lease_seconds):
+        """Next pending task, or a task whose lease expired. out: (task_id, payload) or None when nothing is left"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT task_id, payload FROM tasks WHERE batch_id=? AND '
+                               '(status=? OR (status=? AND lease_expires<?)) ORDER BY position LIMIT 1',
+                               (batch_id, PENDING, LEASED, now)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE tasks SET status=?, worker_id=?, lease_expires=?, attempts=attempts+1 '
+                             'WHERE batch_id=? AND task_id=?',
+                             (LEASED, worker_id, now + lease_seconds, batch_id, row[0]))
+            conn.execute('COMMIT')
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def renew(self, batch_id, task_id, worker_id, lease_seconds):
+        """Extend the lease, False if the task was given to another worker meanwhile"""
+        with closing(self._connect()) as conn:
+            updated = conn.execute('UPDATE tasks SET lease_expires=? WHERE batch_id=? AND task_id=? AND worker_id=? '
+                                   'AND status=?',
+                                   (time.time() + lease_seconds, batch_id, task_id, worker_id, LEASED)).rowcount
+        return updated == 1
+
+    def complete(self, batch_id, task_id, worker_id):
+        self._finish(batch_id, task_id, worker_id, DONE, None)
+
+    def fail(self, batch_id, task_id, worker_id, error, max_attempts=3):
+        """Record the error, the task goes back to pending until it failed max_attempts times"""
+        with closing(self._connect()) as conn:
+            attempts = conn.execute('SELECT attempts FROM tasks WHERE batch_id=? AND task_id=?',
+                                    (batch_id, task_id)).fetchone()[0]
+        self._finish(batch_id, task_id, worker_id, FAILED if attempts >= max_attempts else PENDING, error)
+
+    def _finish(self, batch_id, task_id, worker_id, status, error):
+        with closing(self._connect()) as conn:
+            conn.execute('UPDATE tasks SET status=?, error=?, lease_expires=NULL WHERE batch_id=? AND task_id=? '
+                         'AND worker_id=?', (status, error, batch_id, task_id, worker_id))
+
+    def tasks(self, batch_id):
+        """(task_id, payload, status, worker_id, attempts, error) of every task in order"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT task_id, payload, status, worker_id, attempts, error FROM tasks '
+                                'WHERE batch_id=? ORDER BY position', (batch_id,)).fetchall()
+        return [(task_id, json.loads(payload), status, worker_id, attempts, error)
+                for task_id, payload, status, worker_id, attempts, error in rows]
+
+    def status(self, batch_id):
+        """Number of tasks by status"""
+        with closing(self._connect()) as conn:
+            return dict(conn.execute('SELECT status, COUNT(*) FROM tasks WHERE batch_id=? GROUP BY status',
+                                     (batch_id,)).fetchall())
+
+
+def get_worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class LeaseKeeper(object):
+    """Renew a task lease from a background thread while the task runs"""
+
+    def __init__(self, queue, batch_id, task_id, worker_id, lease_seconds):
+        self.queue = queue
+        self.args = (batch_id, task_id, worker_id, lease_seconds)
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        lease_seconds = self.args[-1]
+        while not self._stop.wait(lease_seconds / 3):
+            if not self.queue.renew(*self.args):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()